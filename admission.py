@@ -0,0 +1,255 @@
+# admission.py - очередь запросов к Gemini в пределах квоты API
+import asyncio
+import heapq
+import itertools
+import logging
+import math
+import time
+from config import (GEMINI_RPM_LIMIT, GEMINI_TPM_LIMIT, ADMISSION_MAX_WAIT, ADMISSION_PRIORITY,
+                    ADMISSION_THROTTLE, ADMISSION_THROTTLE_MAX, ADMISSION_THROTTLE_WINDOW,
+                    ADMISSION_NOTIFY_INTERVAL)
+
+logger = logging.getLogger(__name__)
+
+# Пока недавних запросов меньше, доля 429 считается от этого числа:
+# один 429 сразу после запуска - ещё не повод для долгой паузы
+MIN_RATE_SAMPLES = 10
+
+
+class AdmissionTimeout(Exception):
+    """Запрос простоял в очереди дольше max_wait"""
+
+
+class TokenBucket:
+    """
+    Ведро токенов: rate_per_minute пополнение, ёмкость - минутная квота
+    (или capacity, если всплеск должен быть меньше)
+    
+    Пока ждут через wait_time, ведро не уходит в минус; take без ожидания
+    берёт в долг, и следующим придётся ждать дольше.
+    """
+    
+    def __init__(self, rate_per_minute: float, capacity: float = None):
+        self.capacity = float(capacity or rate_per_minute)
+        self.rate = rate_per_minute / 60
+        self.level = self.capacity
+        self._updated = time.monotonic()
+    
+    def _refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self._updated) * self.rate)
+        self._updated = now
+    
+    def wait_time(self, amount: float, now: float) -> float:
+        """Через сколько секунд в ведре будет amount (0 - уже есть)"""
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        return max(0.0, (amount - self.level) / self.rate)
+    
+    def take(self, amount: float, now: float):
+        self._refill(now)
+        self.level -= min(amount, self.capacity)
+    
+    def drain(self, now: float):
+        """Квота закончилась раньше, чем мы думали - начинаем копить заново"""
+        self._refill(now)
+        self.level = 0.0
+
+
+class AdmissionController:
+    """
+    Допуск запросов к Gemini: ведро на запросы и на токены в минуту,
+    очередь с приоритетом по тарифу
+    
+    Пока квота есть и очередь пуста, запрос проходит сразу. Иначе он
+    встаёт в очередь: vip впереди premium, premium впереди pro и т.д.,
+    внутри тарифа - по времени прихода. Дольше max_wait никто не ждёт -
+    AdmissionTimeout. После 429 от API допуск приостанавливается, а не
+    сжигает повторы в уже известный лимит: на сколько просит API
+    (Retry-After), а если не сказал - от throttle до throttle_max секунд
+    по доле 429 среди запросов примерно за throttle_window. Редкий 429
+    так стоит около секунды, а кончившаяся квота - полную паузу.
+    """
+    
+    def __init__(self, rpm: int = GEMINI_RPM_LIMIT, tpm: int = GEMINI_TPM_LIMIT,
+                 max_wait: float = ADMISSION_MAX_WAIT, priorities: dict = ADMISSION_PRIORITY,
+                 throttle: float = ADMISSION_THROTTLE, throttle_max: float = ADMISSION_THROTTLE_MAX,
+                 throttle_window: float = ADMISSION_THROTTLE_WINDOW,
+                 notify_interval: float = ADMISSION_NOTIFY_INTERVAL):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.max_wait = max_wait
+        self.priorities = priorities
+        self.throttle_for = throttle
+        self.throttle_max = throttle_max
+        self.throttle_window = throttle_window
+        self.notify_interval = notify_interval
+        self._recent_admitted = 0.0      # допущено и получено 429 недавно -
+        self._recent_limited = 0.0       # счётчики затухают за throttle_window
+        self._recent_at = time.monotonic()
+        self._queue = []                 # куча [приоритет, номер, токены, Future]
+        self._order = itertools.count()
+        self._paused_until = 0.0
+        self._wakeup = None
+        self._task = None
+        self.admitted = 0
+        self.queued = 0
+        self.timeouts = 0
+        self.throttled = 0
+    
+    @property
+    def depth(self) -> int:
+        """Сколько запросов ждут в очереди"""
+        return sum(1 for entry in self._queue if not entry[3].done())
+    
+    def priority(self, plan: str) -> int:
+        """Меньше - раньше; неизвестный тариф и фоновые задачи - в самом конце"""
+        return self.priorities.get(plan, len(self.priorities))
+    
+    async def acquire(self, plan: str, tokens: int, on_queued=None) -> float:
+        """
+        Дождаться допуска запроса
+        
+        Args:
+            plan: тариф пользователя (None - фоновая задача)
+            tokens: оценка токенов запроса
+            on_queued: async (позиция) -> None, вызывается при постановке
+                в очередь и раз в notify_interval, если позиция сменилась
+        
+        Returns:
+            float: сколько секунд простояли в очереди
+        
+        Raises:
+            AdmissionTimeout: не дождались за max_wait
+        """
+        now = time.monotonic()
+        if not self._queue and self._delay(tokens, now) == 0:
+            self._take(tokens, now)
+            return 0.0
+        
+        future = asyncio.get_running_loop().create_future()
+        entry = [self.priority(plan), next(self._order), tokens, future]
+        heapq.heappush(self._queue, entry)
+        self.queued += 1
+        self._kick()
+        
+        deadline = now + self.max_wait
+        position = None
+        try:
+            while not future.done():
+                current = self._position(entry)
+                if on_queued and current != position:
+                    position = current
+                    await on_queued(position)
+                
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    await asyncio.wait_for(asyncio.shield(future), min(remaining, self.notify_interval))
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            if not future.done():
+                # Отменённую запись диспетчер просто выкинет из кучи
+                future.cancel()
+        
+        if future.cancelled():
+            self.timeouts += 1
+            logger.warning(f"⏳ Запрос ({plan}) не дождался очереди за {self.max_wait} сек")
+            raise AdmissionTimeout(f"очередь к Gemini дольше {self.max_wait} сек")
+        return time.monotonic() - now
+    
+    def try_acquire(self, tokens: int) -> bool:
+        """Пропустить запрос, только если квота есть прямо сейчас (без очереди)"""
+        now = time.monotonic()
+        if self._queue or self._delay(tokens, now) > 0:
+            return False
+        self._take(tokens, now)
+        return True
+    
+    def throttle(self, seconds: float = None):
+        """
+        API ответил 429 - приостановить допуск и опустошить вёдра
+        
+        Args:
+            seconds: Retry-After от API (None - пауза по доле недавних 429)
+        """
+        now = time.monotonic()
+        self._decay(now)
+        self._recent_limited += 1
+        rate = min(1.0, self._recent_limited / max(self._recent_admitted, MIN_RATE_SAMPLES))
+        if seconds is None:
+            seconds = self.throttle_for + (self.throttle_max - self.throttle_for) * rate
+        
+        self._paused_until = max(self._paused_until, now + seconds)
+        self.requests.drain(now)
+        self.tokens.drain(now)
+        self.throttled += 1
+        logger.warning(f"🚦 Лимит Gemini: пауза допуска {seconds:.1f} сек (доля 429: {rate:.0%})")
+        self._kick()
+    
+    async def stop(self):
+        """Остановить диспетчер; ждущие получат AdmissionTimeout по своим срокам"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+    
+    def _delay(self, tokens: int, now: float) -> float:
+        return max(self._paused_until - now,
+                   self.requests.wait_time(1, now),
+                   self.tokens.wait_time(tokens, now))
+    
+    def _take(self, tokens: int, now: float):
+        self.requests.take(1, now)
+        self.tokens.take(tokens, now)
+        self.admitted += 1
+        self._decay(now)
+        self._recent_admitted += 1
+    
+    def _decay(self, now: float):
+        factor = math.exp((self._recent_at - now) / self.throttle_window)
+        self._recent_admitted *= factor
+        self._recent_limited *= factor
+        self._recent_at = now
+    
+    def _position(self, entry: list) -> int:
+        """Место в очереди, начиная с 1"""
+        return 1 + sum(1 for other in self._queue
+                       if other[:2] < entry[:2] and not other[3].done())
+    
+    def _kick(self):
+        """Разбудить диспетчер (и запустить, если ещё не работает)"""
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.ensure_future(self._dispatch())
+        self._wakeup.set()
+    
+    async def _dispatch(self):
+        """Выпускает голову очереди, как только на неё хватает квоты"""
+        while True:
+            while self._queue and self._queue[0][3].done():
+                heapq.heappop(self._queue)
+            
+            self._wakeup.clear()
+            if not self._queue:
+                await self._wakeup.wait()
+                continue
+            
+            head = self._queue[0]
+            now = time.monotonic()
+            delay = self._delay(head[2], now)
+            if delay > 0:
+                # Новый запрос с более высоким приоритетом или пауза разбудят раньше
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            
+            heapq.heappop(self._queue)
+            self._take(head[2], now)
+            head[3].set_result(None)
@@ -0,0 +1,177 @@
+# benchmarks/bench_text.py - микробенчмарки utils.chunker, utils.formatter и utils.renderer
+#
+#   python -m benchmarks.bench_text              # замер и сравнение с baseline.json
+#   python -m benchmarks.bench_text --save       # записать новый baseline
+#   python -m benchmarks.bench_text --only split_message --threshold 0.6
+import argparse
+import gc
+import json
+import os
+import sys
+import time
+import timeit
+import tracemalloc
+from benchmarks.corpus import build_corpus
+from utils.chunker import split_message, split_by_code_blocks
+from utils.formatter import format_code, escape_markdown, clean_response
+from utils.renderer import render_chunks
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), "baseline.json")
+
+# Что меряем: имя -> функция от текста
+FUNCTIONS = {
+    "split_message": split_message,
+    "split_by_code_blocks": split_by_code_blocks,
+    "format_code": format_code,
+    "escape_markdown": escape_markdown,
+    "clean_response": clean_response,
+    "render_chunks": render_chunks,
+}
+
+# Допустимое замедление относительно baseline (0.4 = +40%). Меньше нельзя: на общей
+# машине лучший из 7 замеров между запусками гуляет на 10-35%
+DEFAULT_THRESHOLD = 0.4
+
+# Замеров на бенчмарк (берётся лучший)
+DEFAULT_REPEAT = 7
+
+# Сколько раз перемерить подозрительный результат, прежде чем считать его регрессией
+RECHECKS = 3
+
+
+def workload():
+    """
+    Эталонная нагрузка
+    
+    Результаты хранятся в единицах её времени, поэтому baseline, снятый
+    на одной машине, можно сравнивать на другой.
+    """
+    text = "абв " * 2000
+    return sum(len(part) for part in text.split(" ")) + len(text.encode("utf-8"))
+
+
+def measure(func, text: str, repeat: int) -> dict:
+    """
+    Время одного вызова (лучшее из repeat), оно же в единицах эталона,
+    и пик выделенной памяти
+    
+    Замеры функции и эталона чередуются, так что лучшие из них взяты за
+    один и тот же отрезок времени. Отношение отдельных пар не годится:
+    короткий эталон шумит сильнее самой функции.
+    """
+    timer = timeit.Timer(lambda: func(text))
+    number, _ = timer.autorange()
+    unit_timer = timeit.Timer(workload)
+    unit_number, _ = unit_timer.autorange()
+    
+    best_seconds = best_unit = float("inf")
+    for _ in range(repeat):
+        best_unit = min(best_unit, unit_timer.timeit(unit_number) / unit_number)
+        best_seconds = min(best_seconds, timer.timeit(number) / number)
+    
+    gc.collect()
+    tracemalloc.start()
+    func(text)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    
+    return {"seconds": best_seconds, "units": best_seconds / best_unit, "peak_bytes": peak}
+
+
+def run(only: list = None, repeat: int = DEFAULT_REPEAT, seed: int = 42) -> dict:
+    corpus = build_corpus(seed)
+    results = {}
+    
+    for func_name, func in FUNCTIONS.items():
+        if only and func_name not in only:
+            continue
+        for corpus_name, text in corpus.items():
+            results[f"{func_name}/{corpus_name}"] = measure(func, text, repeat)
+    
+    return {"seed": seed, "results": results}
+
+
+def recheck(current: dict, names: list, repeat: int):
+    """Перемерить выбранные бенчмарки, оставив лучший результат"""
+    corpus = build_corpus(current["seed"])
+    for name in names:
+        func_name, corpus_name = name.split("/")
+        stats = measure(FUNCTIONS[func_name], corpus[corpus_name], repeat)
+        if stats["units"] < current["results"][name]["units"]:
+            current["results"][name] = stats
+
+
+def compare(current: dict, baseline: dict, threshold: float) -> list:
+    """Замедления сверх threshold: [(бенчмарк, было, стало), ...]"""
+    regressions = []
+    for name, stats in current["results"].items():
+        base = baseline["results"].get(name)
+        if base and stats["units"] > base["units"] * (1 + threshold):
+            regressions.append((name, base["units"], stats["units"]))
+    return regressions
+
+
+def print_table(current: dict, baseline: dict = None):
+    print(f"{'Бенчмарк':<44} {'мкс':>10} {'пик, КБ':>9} {'к baseline':>11}")
+    for name, stats in current["results"].items():
+        base = baseline["results"].get(name) if baseline else None
+        ratio = f"{stats['units'] / base['units']:.2f}x" if base else "-"
+        print(f"{name:<44} {stats['seconds'] * 1e6:>10.1f} {stats['peak_bytes'] / 1024:>9.1f} {ratio:>11}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарки utils.chunker, utils.formatter и utils.renderer")
+    parser.add_argument("--save", action="store_true", help="записать результат как baseline")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="допустимое замедление (0.4 = +40%%)")
+    parser.add_argument("--only", nargs="*", help="только эти функции")
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT, help="замеров на бенчмарк (берётся лучший)")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    args = parser.parse_args()
+    
+    started = time.perf_counter()
+    current = run(args.only, args.repeat)
+    
+    baseline = None
+    if os.path.exists(args.baseline) and not args.save:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+    
+    print_table(current, baseline)
+    print(f"\n⏱️ {time.perf_counter() - started:.1f} сек")
+    
+    if args.save:
+        # С --only обновляем только свои строки, остальной baseline не трогаем
+        if args.only and os.path.exists(args.baseline):
+            with open(args.baseline, encoding="utf-8") as f:
+                saved = json.load(f)
+            saved["results"].update(current["results"])
+            current = saved
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(current, f, ensure_ascii=False, indent=2, sort_keys=True)
+        print(f"💾 Baseline сохранён: {args.baseline}")
+        return
+    
+    if baseline is None:
+        print("⚠️ Baseline нет - запусти с --save")
+        return
+    
+    regressions = compare(current, baseline, args.threshold)
+    for _ in range(RECHECKS):
+        if not regressions:
+            break
+        # Единичный выброс - не регрессия
+        recheck(current, [name for name, _, _ in regressions], args.repeat * 2)
+        regressions = compare(current, baseline, args.threshold)
+    
+    if regressions:
+        print(f"\n❌ Замедление больше {args.threshold:.0%}:")
+        for name, before, after in regressions:
+            print(f"   {name}: {after / before:.2f}x")
+        sys.exit(1)
+    
+    print(f"\n✅ Регрессий нет (порог {args.threshold:.0%})")
+
+
+if __name__ == "__main__":
+    main()
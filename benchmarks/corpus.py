@@ -0,0 +1,93 @@
+# benchmarks/corpus.py - генератор реалистичных текстов для бенчмарков
+import random
+
+WORDS = [
+    "футбол", "матч", "гол", "тренер", "сезон", "лига", "чемпион", "защита", "атака", "прессинг",
+    "football", "match", "goal", "season", "league", "transfer", "stats", "xG", "assist",
+    "Месси", "Роналду", "Барселона", "Реал", "Ливерпуль", "функция", "код", "данные", "ответ",
+]
+EMOJI = ["🔥", "⚽", "🏆", "💪", "🎯", "✨", "👍", "😄", "🇦🇷", "👨‍👩‍👧"]
+CODE_LINES = [
+    "def goals(stats):",
+    "    return sum(s['goals'] for s in stats if s.get('season') == 2024)",
+    "for player in squad:",
+    "    print(f\"{player.name}: {player.goals} ⚽\")",
+    "class Match:",
+    "    def __init__(self, home, away):",
+    "        self.home, self.away = home, away",
+    "# комментарий на русском с *звёздочками* и _подчёркиваниями_",
+    "result = {'home': 2, 'away': 1}  # [ссылка](http://example.com)",
+]
+
+
+def _sentence(rng: random.Random, words: int) -> str:
+    text = " ".join(rng.choice(WORDS) for _ in range(words))
+    if rng.random() < 0.5:
+        text += " " + rng.choice(EMOJI)
+    return text.capitalize() + rng.choice([".", "!", "?", "…"])
+
+
+def _paragraph(rng: random.Random) -> str:
+    return " ".join(_sentence(rng, rng.randint(6, 18)) for _ in range(rng.randint(3, 8)))
+
+
+def _code_block(rng: random.Random) -> str:
+    lines = [rng.choice(CODE_LINES) for _ in range(rng.randint(4, 30))]
+    return f"```{rng.choice(['python', 'js', ''])}\n" + "\n".join(lines) + "\n```"
+
+
+def paragraphs(size: int, rng: random.Random) -> str:
+    """Обычный ответ: абзацы через пустую строку"""
+    parts = []
+    while sum(len(p) + 2 for p in parts) < size:
+        parts.append(_paragraph(rng))
+    return "\n\n".join(parts)[:size]
+
+
+def giant_sentence(size: int, rng: random.Random) -> str:
+    """Одно огромное предложение без переносов и точек"""
+    parts = []
+    while sum(len(p) + 1 for p in parts) < size:
+        parts.append(rng.choice(WORDS + EMOJI))
+    return " ".join(parts)[:size]
+
+
+def code_heavy(size: int, rng: random.Random) -> str:
+    """Много блоков кода вперемешку с пояснениями"""
+    parts = []
+    while sum(len(p) + 2 for p in parts) < size:
+        parts.append(_code_block(rng) if rng.random() < 0.6 else _paragraph(rng))
+    return "\n\n".join(parts)
+
+
+def emoji_cyrillic(size: int, rng: random.Random) -> str:
+    """Кириллица с плотными эмодзи (суррогатные пары и ZWJ-последовательности)"""
+    parts = []
+    while sum(len(p) + 1 for p in parts) < size:
+        word = rng.choice(WORDS)
+        parts.append(word + "".join(rng.choice(EMOJI) for _ in range(rng.randint(0, 3))))
+        if rng.random() < 0.1:
+            parts.append("\n")
+    return " ".join(parts)[:size]
+
+
+GENERATORS = {
+    "paragraphs": paragraphs,
+    "giant_sentence": giant_sentence,
+    "code_heavy": code_heavy,
+    "emoji_cyrillic": emoji_cyrillic,
+}
+SIZES = (10_000, 50_000)
+
+
+def build_corpus(seed: int = 42, sizes: tuple = SIZES) -> dict:
+    """
+    Набор текстов: (вид)_(размер в КБ) -> текст
+    
+    Один и тот же seed всегда даёт один и тот же корпус.
+    """
+    corpus = {}
+    for name, generator in GENERATORS.items():
+        for size in sizes:
+            corpus[f"{name}_{size // 1000}k"] = generator(size, random.Random(f"{seed}-{name}-{size}"))
+    return corpus
@@ -2,8 +2,12 @@
 import logging
 from telegram import Update
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
-from config import TELEGRAM_TOKEN
+from config import (TELEGRAM_TOKEN, RETENTION_INTERVAL, BOT_MODE, WEBHOOK_URL, WEBHOOK_LISTEN, WEBHOOK_PORT,
+                    WEBHOOK_PATH, WEBHOOK_SECRET, WEBHOOK_MAX_CONNECTIONS, WORKER_PROCESSES, METRICS_ENABLED)
 from handlers import BotHandlers
+from metrics import TimedRequest, start_server
+from retention import retention_job
+from update_processor import PerUserUpdateProcessor
 
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -11,14 +15,16 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Какие апдейты нужны каждому типу обработчика (остальные Telegram даже не присылает)
+HANDLER_UPDATES = {
+    CommandHandler: [Update.MESSAGE],
+    MessageHandler: [Update.MESSAGE],
+    CallbackQueryHandler: [Update.CALLBACK_QUERY],
+}
 
-def main():
-    """Запуск бота"""
-    logger.info("🚀 Запуск бота v2.0 с PRO тарифом...")
-    
-    app = Application.builder().token(TELEGRAM_TOKEN).build()
-    handlers = BotHandlers()
-    
+
+def add_handlers(app: Application, handlers):
+    """Команды, кнопки и текст"""
     # Основные команды
     app.add_handler(CommandHandler("start", handlers.start))
     app.add_handler(CommandHandler("promo", handlers.promo_activate))
@@ -38,13 +44,97 @@ def main():
     
     # Обработка текста
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handlers.handle_message))
+
+
+def build_application(handlers: BotHandlers, builder=None, retention: bool = True) -> Application:
+    """
+    Приложение с зарегистрированными обработчиками
+    
+    Args:
+        handlers: обработчики бота
+        builder: свой ApplicationBuilder (нагрузочный тест, процесс-обработчик),
+            по умолчанию - с TELEGRAM_TOKEN
+        retention: запускать фоновую чистку истории (в режиме нескольких
+            процессов - только в одном из них)
+    """
+    builder = builder or Application.builder().token(TELEGRAM_TOKEN)
+    if METRICS_ENABLED:
+        # Размер пула - как у HTTPXRequest, который builder создал бы сам
+        builder = builder.request(TimedRequest(connection_pool_size=256))
+    app = (
+        builder
+        .concurrent_updates(PerUserUpdateProcessor())
+        .post_init(handlers.startup)
+        .post_shutdown(handlers.shutdown)
+        .build()
+    )
+    add_handlers(app, handlers)
+    
+    # 🧹 Фоновая чистка истории
+    if retention and app.job_queue:
+        app.job_queue.run_repeating(retention_job, interval=RETENTION_INTERVAL,
+                                    first=60, data=handlers.db)
+    elif retention:
+        logger.warning("⚠️ JobQueue недоступна: pip install \"python-telegram-bot[job-queue]\"")
+    
+    return app
+
+
+def allowed_updates(app: Application) -> list:
+    """Типы апдейтов, для которых зарегистрированы обработчики"""
+    updates = []
+    for group in app.handlers.values():
+        for handler in group:
+            for update_type in HANDLER_UPDATES.get(type(handler), Update.ALL_TYPES):
+                if update_type not in updates:
+                    updates.append(update_type)
+    return updates
+
+
+def webhook_options() -> dict:
+    """Параметры run_webhook/start_webhook из config.py"""
+    if not WEBHOOK_URL:
+        raise ValueError("BOT_MODE = 'webhook', но WEBHOOK_URL не задан в config.py")
+    if not WEBHOOK_SECRET:
+        # Без секрета апдейты от кого угодно неотличимы от апдейтов Telegram
+        raise ValueError("BOT_MODE = 'webhook', но WEBHOOK_SECRET не задан в config.py")
+    return {
+        "listen": WEBHOOK_LISTEN,
+        "port": WEBHOOK_PORT,
+        "url_path": WEBHOOK_PATH,
+        "webhook_url": WEBHOOK_URL,
+        "secret_token": WEBHOOK_SECRET,
+        "max_connections": WEBHOOK_MAX_CONNECTIONS,
+    }
+
+
+def main():
+    """Запуск бота"""
+    logger.info("🚀 Запуск бота v2.0 с PRO тарифом...")
+    
+    # Ошибку в настройках webhook видно сразу, до запуска обработчиков
+    webhook = webhook_options() if BOT_MODE == "webhook" else None
+    
+    if WORKER_PROCESSES > 1:
+        # Здесь только приём апдейтов, обработка - в процессах workers.py
+        from workers import build_ingest
+        app, updates = build_ingest()
+    else:
+        handlers = BotHandlers()
+        app = build_application(handlers)
+        updates = allowed_updates(app)
+    start_server()
     
     logger.info("✅ Бот запущен!")
     logger.info("⚽ Футбольные команды активны")
     logger.info("🔥 PRO тариф активен")
     logger.info("📝 Ctrl+C для остановки")
     
-    app.run_polling(allowed_updates=Update.ALL_TYPES)
+    if webhook:
+        logger.info(f"🌐 Webhook: {WEBHOOK_URL} -> {WEBHOOK_LISTEN}:{WEBHOOK_PORT}/{WEBHOOK_PATH}")
+        app.run_webhook(allowed_updates=updates, **webhook)
+    else:
+        app.run_polling(allowed_updates=updates)
 
 
 if __name__ == '__main__':
@@ -69,9 +69,149 @@ BOT_PERSONALITY = [
 
 GEMINI_MODEL = "models/gemini-2.5-flash"  # ✅ РЕКОМЕНДУЕТСЯ для стабильной работы
 MAX_HISTORY = 6  # меньше истории = меньше токенов = меньше ошибок
+HISTORY_CACHE_USERS = 5000  # сколько пользователей держать с историей в памяти
+
+# Бюджет токенов на весь промпт (правила + история + сообщение)
+CONTEXT_TOKEN_BUDGET = {
+    "free": 1500,
+    "pro": 2500,
+    "premium": 4000,
+    "vip": 6000,
+}
 MAX_MESSAGE_LENGTH = 2500  # максимальная длина ответа
 
+# Сводка старой части диалога (долгая память, см. summarizer.py)
+SUMMARY_ENABLED = True
+SUMMARY_TRIGGER_MESSAGES = 10   # сколько старых сообщений копим до обновления сводки
+SUMMARY_BATCH_MESSAGES = 40     # максимум сообщений за одно обновление
+SUMMARY_MAX_CHARS = 600         # длина сводки (~150-300 токенов в промпте)
+SUMMARY_CACHE_USERS = 5000      # сколько сводок держать в памяти
+
+# Кэш статического начала промпта (правила бота + шаблон команды), см. gemini_backend.py
+PREFIX_CACHE_ENABLED = True
+PREFIX_CACHE_TTL = 3600             # сколько живёт префикс в API (сек)
+PREFIX_CACHE_REFRESH_MARGIN = 300   # продлеваем, когда до истечения меньше (сек)
+PREFIX_CACHE_MIN_TOKENS = 1024      # короче - API не кэширует, шлём целиком (минимум gemini-2.5-flash)
+# ⚠️ Сейчас правила бота ~400 токенов, с шаблоном команды ~540-620 - меньше минимума,
+# так что кэш префиксов пока ничего не делает. Заработает сам, когда правила и шаблоны
+# вырастут (тариф в префикс не входит - одна запись на шаблон)
+PREFIX_CACHE_RETRY_AFTER = 600      # после ошибки создания не пробуем столько (сек)
+
+# ===========================================
+# ПОВТОРЫ И ЗАЩИТА ОТ СБОЕВ GEMINI
+# ===========================================
+GEMINI_MAX_RETRIES = 3
+RETRY_BASE_DELAY = 1.0           # пауза перед повтором - случайная до base * 2^попытка (сек)
+RETRY_MAX_DELAY = 8.0            # ... но не больше (сек)
+CIRCUIT_FAILURE_THRESHOLD = 5    # сбоев подряд (таймауты, 5xx), после которых перестаём ходить в модель
+CIRCUIT_RESET_TIMEOUT = 30       # сколько не ходим, потом - пробный запрос (сек)
+CIRCUIT_HALF_OPEN_PROBES = 1     # пробных запросов одновременно
+HEDGE_ENABLED = True             # второй запрос, если первый отвечает дольше обычного
+HEDGE_PERCENTILE = 95            # "дольше обычного" - дольше этого перцентиля
+HEDGE_MIN_SAMPLES = 20           # пока замеров меньше - не хеджируем
+HEDGE_MIN_DELAY = 1.0            # и не раньше, чем через столько секунд
+
+# ===========================================
+# ОЧЕРЕДЬ ЗАПРОСОВ К GEMINI
+# ===========================================
+ADMISSION_ENABLED = True
+GEMINI_RPM_LIMIT = 1000          # квота API: запросов в минуту
+GEMINI_TPM_LIMIT = 1000000       # квота API: входных токенов в минуту
+ADMISSION_MAX_WAIT = 30          # дольше в очереди не держим (сек)
+ADMISSION_THROTTLE = 1           # пауза допуска после 429, если API не сказал Retry-After (сек)...
+ADMISSION_THROTTLE_MAX = 20      # ...растёт с долей 429 среди недавних запросов до этой при 100% (сек)
+ADMISSION_THROTTLE_WINDOW = 60   # "недавние" - примерно за это время (сек)
+ADMISSION_NOTIFY_INTERVAL = 5    # как часто обновлять пользователю место в очереди (сек)
+# Кто проходит первым (меньше - раньше)
+ADMISSION_PRIORITY = {
+    "vip": 0,
+    "premium": 1,
+    "pro": 2,
+    "free": 3,
+}
+
+# ===========================================
+# СТРИМИНГ ОТВЕТОВ
+# ===========================================
+STREAM_RESPONSES = True  # показывать ответ по мере генерации
+STREAM_EDIT_INTERVAL = 1.5  # секунд между правками сообщения (лимиты Telegram)
+STREAM_EDIT_RATE = 20  # сообщений и правок потока в секунду на весь бот (общий лимит Telegram ~30/сек)
+STREAM_EDIT_BURST = 5  # ... и сколько сверх этого можно разом (пик за секунду - RATE + BURST)
+
+# ===========================================
+# ПОЛУЧЕНИЕ АПДЕЙТОВ
+# ===========================================
+BOT_MODE = "polling"  # "polling" или "webhook"
+# Webhook: Telegram шлёт апдейты на WEBHOOK_URL, перед ботом - nginx/балансировщик с HTTPS,
+# сам бот слушает WEBHOOK_LISTEN:WEBHOOK_PORT/WEBHOOK_PATH
+WEBHOOK_URL = ""  # например https://bot.example.com/telegram
+WEBHOOK_LISTEN = "127.0.0.1"
+WEBHOOK_PORT = 8443
+WEBHOOK_PATH = "telegram"
+WEBHOOK_SECRET = ""  # заголовок X-Telegram-Bot-Api-Secret-Token; обязателен, без него webhook не запустится
+WEBHOOK_MAX_CONNECTIONS = 40  # сколько одновременных соединений держит Telegram (1-100)
+
+# ===========================================
+# ОБРАБОТКА АПДЕЙТОВ
+# ===========================================
+# Сколько апдейтов разных пользователей обрабатывать одновременно
+# (апдейты одного пользователя всегда идут по очереди)
+CONCURRENT_UPDATES = 64
+
+# ===========================================
+# НЕСКОЛЬКО ПРОЦЕССОВ
+# ===========================================
+# 1 - всё в одном процессе. Больше - один процесс принимает апдейты (polling
+# или webhook) и раздаёт их WORKER_PROCESSES процессам-обработчикам по user_id
+WORKER_PROCESSES = 1
+WORKER_RESTART_DELAY = 1.0  # пауза перед перезапуском упавшего обработчика (сек)
+WORKER_RESTART_MAX_DELAY = 60.0  # ... удваивается, если он падает сразу после старта, но не больше
+WORKER_STOP_TIMEOUT = 30  # сколько ждать, пока обработчики доделают начатое при остановке (сек)
+
+# ===========================================
+# МЕТРИКИ
+# ===========================================
+METRICS_ENABLED = True
+METRICS_HOST = "127.0.0.1"  # только локально: снаружи метрики забирает Prometheus/агент на этой машине
+METRICS_PORT = 9464  # GET /metrics; в режиме нескольких процессов обработчик N слушает METRICS_PORT + N
+
 # ===========================================
 # БАЗА ДАННЫХ
 # ===========================================
-DATABASE_PATH = "bot_database.db"
\ No newline at end of file
+DATABASE_PATH = "bot_database.db"
+DB_BUSY_TIMEOUT_MS = 5000  # сколько ждать занятую базу, мс
+DB_CACHE_SIZE_KB = 20000  # кэш страниц SQLite (~20 МБ)
+DB_SYNCHRONOUS = "NORMAL"  # в режиме WAL безопасно и без fsync на каждый коммит
+DB_STATEMENT_CACHE = 128  # кэш подготовленных запросов на соединение
+WRITE_BATCH_SIZE = 200  # сообщений в одной пачке записи
+WRITE_FLUSH_INTERVAL = 0.5  # секунд, не дольше которых сообщение ждёт записи
+
+# ===========================================
+# ХРАНЕНИЕ ИСТОРИИ
+# ===========================================
+RETENTION_KEEP_MESSAGES = 50  # сколько последних сообщений хранить на пользователя
+RETENTION_ARCHIVE = True  # переносить старые сообщения в conversations_archive
+RETENTION_BATCH_SIZE = 500  # сообщений за одну транзакцию удаления
+RETENTION_SCAN_USERS = 1000  # пользователей за один запрос подсчёта сообщений
+RETENTION_INTERVAL = 3600  # секунд между запусками чистки
+RETENTION_VACUUM_PAGES = 2000  # страниц, возвращаемых системе за запуск
+
+# ===========================================
+# КЭШ ПОЛЬЗОВАТЕЛЕЙ
+# ===========================================
+USER_CACHE_SIZE = 10000  # сколько пользователей держать в памяти (LRU)
+USER_CACHE_FLUSH_INTERVAL = 2.0  # секунд между записями изменений в базу
+
+# ===========================================
+# КЭШ ОТВЕТОВ (футбольные команды)
+# ===========================================
+# Сколько секунд хранить ответ. Команды не из списка не кэшируются
+# (/predict - прогноз на конкретный матч, каждый раз заново)
+RESPONSE_CACHE_TTL = {
+    "player": 6 * 3600,
+    "club": 12 * 3600,
+    "match": 3 * 3600,
+    "compare": 6 * 3600,
+}
+RESPONSE_CACHE_MAX_BYTES = 20 * 1024 * 1024  # память под кэш (~20 МБ)
+RESPONSE_CACHE_PERSISTENT = True  # дублировать в SQLite (переживает перезапуск)
\ No newline at end of file
@@ -0,0 +1,168 @@
+# db_migrations.py - версионные миграции схемы базы
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+# ===========================================
+# МИГРАЦИИ (строго по возрастанию версии!)
+# ===========================================
+# Каждая миграция: (версия, описание, [SQL...])
+# Уже применённые миграции не меняем - только добавляем новые.
+MIGRATIONS = [
+    (1, "Базовые таблицы", [
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            plan TEXT DEFAULT 'free',
+            premium_expires TEXT,
+            daily_requests INTEGER DEFAULT 0,
+            last_request_date TEXT,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS promocodes (
+            code TEXT PRIMARY KEY,
+            type TEXT,
+            days INTEGER,
+            requests INTEGER,
+            uses_left INTEGER,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS used_promocodes (
+            user_id INTEGER,
+            code TEXT,
+            used_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (user_id, code)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS conversations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            role TEXT,
+            content TEXT,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+    ]),
+    
+    # История: WHERE user_id = ? ORDER BY id DESC, очистка по user_id
+    # Статистика: COUNT(*) WHERE user_id = ? AND role = 'user'
+    (2, "Индексы для истории и статистики", [
+        "CREATE INDEX IF NOT EXISTS idx_conversations_user_id ON conversations (user_id, id)",
+        "CREATE INDEX IF NOT EXISTS idx_conversations_user_role ON conversations (user_id, role)",
+        "ANALYZE conversations",
+    ]),
+    
+    # Кэш ответов футбольных команд (второй уровень ResponseCache)
+    (3, "Кэш ответов", [
+        """
+        CREATE TABLE IF NOT EXISTS response_cache (
+            key TEXT PRIMARY KEY,
+            command TEXT,
+            response TEXT,
+            expires_at REAL
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_response_cache_expires ON response_cache (expires_at)",
+    ]),
+    
+    # Архив старых сообщений (см. retention.py)
+    (4, "Архив истории", [
+        """
+        CREATE TABLE IF NOT EXISTS conversations_archive (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER,
+            role TEXT,
+            content TEXT,
+            created_at TEXT,
+            archived_at TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+    ]),
+    
+    # Сводка старой части диалога (см. summarizer.py)
+    (5, "Сводки диалогов", [
+        """
+        CREATE TABLE IF NOT EXISTS user_summaries (
+            user_id INTEGER PRIMARY KEY,
+            summary TEXT,
+            last_message_id INTEGER,
+            updated_at TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+    ]),
+]
+
+
+def get_schema_version(conn) -> int:
+    """Текущая версия схемы (0 - пустая база)"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT,
+            applied_at TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    row = conn.execute("SELECT MAX(version) FROM schema_version").fetchone()
+    return row[0] or 0
+
+
+def apply_migrations(conn) -> int:
+    """
+    Довести схему до последней версии
+    
+    Каждая миграция - отдельная транзакция BEGIN IMMEDIATE: если база
+    открыта несколькими процессами, миграцию применит только один,
+    остальные увидят новую версию и пропустят её.
+    
+    Returns:
+        int: версия схемы после обновления
+    """
+    version = get_schema_version(conn)
+    conn.commit()
+    
+    for target, description, statements in MIGRATIONS:
+        if target <= version:
+            continue
+        
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # Пока ждали блокировку, миграцию мог применить другой процесс
+            if get_schema_version(conn) >= target:
+                conn.rollback()
+                continue
+            
+            for sql in statements:
+                conn.execute(sql)
+            
+            conn.execute(
+                "INSERT INTO schema_version (version, description) VALUES (?, ?)",
+                (target, description)
+            )
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            logger.error(f"❌ Миграция {target} не применена: {description}")
+            raise
+        
+        version = target
+        logger.info(f"🔧 Миграция {target}: {description}")
+    
+    return version
+
+
+if __name__ == "__main__":
+    # Обновление существующей базы без запуска бота
+    import sqlite3
+    from config import DATABASE_PATH
+    
+    logging.basicConfig(level=logging.INFO)
+    conn = sqlite3.connect(DATABASE_PATH)
+    print(f"✅ Версия схемы: {apply_migrations(conn)}")
+    conn.close()
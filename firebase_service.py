@@ -1,72 +1,85 @@
 # firebase_service.py - база данных с поддержкой PRO тарифа
 import sqlite3
+import threading
+from contextlib import contextmanager
 from datetime import datetime, timedelta
-from config import DATABASE_PATH, FREE_DAILY_LIMIT, PRO_DAILY_LIMIT, MAX_HISTORY
+from config import (DATABASE_PATH, FREE_DAILY_LIMIT, PRO_DAILY_LIMIT, MAX_HISTORY,
+                    DB_BUSY_TIMEOUT_MS, DB_CACHE_SIZE_KB, DB_SYNCHRONOUS, DB_STATEMENT_CACHE)
+from db_migrations import apply_migrations
+from history_buffer import HistoryBuffer
+from metrics import DB_SECONDS, timed_methods
+from write_queue import WriteBehindQueue
 import logging
 
 logger = logging.getLogger(__name__)
 
 
+@timed_methods(DB_SECONDS)
 class DatabaseService:
-    def __init__(self):
+    def __init__(self, db_path: str = DATABASE_PATH):
         """Инициализация базы данных"""
-        self.db_path = DATABASE_PATH
+        self.db_path = db_path
+        self._lock = threading.RLock()
+        self._depth = 0  # вложенность транзакций
+        self._conn = self._connect()
+        self.history = HistoryBuffer()
+        self.writes = WriteBehindQueue(self._insert_messages)
         self._init_database()
     
-    def _init_database(self):
-        """Создание таблиц"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        # Таблица пользователей
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                username TEXT,
-                plan TEXT DEFAULT 'free',
-                premium_expires TEXT,
-                daily_requests INTEGER DEFAULT 0,
-                last_request_date TEXT,
-                created_at TEXT DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        
-        # Таблица промокодов
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS promocodes (
-                code TEXT PRIMARY KEY,
-                type TEXT,
-                days INTEGER,
-                requests INTEGER,
-                uses_left INTEGER,
-                created_at TEXT DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
+    def _connect(self):
+        """Одно долгоживущее соединение с настроенными PRAGMA"""
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=DB_BUSY_TIMEOUT_MS / 1000,
+            check_same_thread=False,
+            cached_statements=DB_STATEMENT_CACHE
+        )
+        conn.row_factory = sqlite3.Row
         
-        # Таблица использованных промокодов
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS used_promocodes (
-                user_id INTEGER,
-                code TEXT,
-                used_at TEXT DEFAULT CURRENT_TIMESTAMP,
-                PRIMARY KEY (user_id, code)
-            )
-        """)
+        # Действует только для новой базы; старую переводит retention.py --vacuum
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
         
-        # Таблица истории диалогов
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS conversations (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                role TEXT,
-                content TEXT,
-                created_at TEXT DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
+        # WAL: читатели не ждут писателя, коммит без fsync всей базы
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute(f"PRAGMA synchronous = {DB_SYNCHRONOUS}")
+        conn.execute(f"PRAGMA cache_size = -{DB_CACHE_SIZE_KB}")
+        conn.execute(f"PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS}")
+        conn.execute("PRAGMA temp_store = MEMORY")
+        return conn
+    
+    @contextmanager
+    def _transaction(self):
+        """
+        Курсор на общем соединении
+        
+        Коммит делает только самая внешняя транзакция, поэтому методы
+        можно вызывать друг из друга (например, activate_promocode).
+        """
+        with self._lock:
+            self._depth += 1
+            try:
+                yield self._conn.cursor()
+                if self._depth == 1:
+                    self._conn.commit()
+            except Exception:
+                if self._depth == 1:
+                    self._conn.rollback()
+                raise
+            finally:
+                self._depth -= 1
+    
+    def close(self):
+        """Закрыть соединение"""
+        with self._lock:
+            self._conn.close()
+        logger.info("✅ База данных закрыта")
+    
+    def _init_database(self):
+        """Создание таблиц и обновление схемы"""
+        with self._lock:
+            version = apply_migrations(self._conn)
         
-        conn.commit()
-        conn.close()
-        logger.info("✅ База данных инициализирована")
+        logger.info(f"✅ База данных инициализирована (схема v{version})")
     
     # ========================================
     # ПОЛЬЗОВАТЕЛИ
@@ -74,127 +87,136 @@ class DatabaseService:
     
     def get_user(self, user_id: int):
         """Получить пользователя"""
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        
-        cursor.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
-        user = cursor.fetchone()
-        conn.close()
+        with self._transaction() as cursor:
+            cursor.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
+            user = cursor.fetchone()
         
         return dict(user) if user else None
     
     def create_user(self, user_id: int, username: str):
         """Создать пользователя"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
         today = datetime.now().strftime("%Y-%m-%d")
-        cursor.execute("""
-            INSERT OR IGNORE INTO users (user_id, username, last_request_date, daily_requests)
-            VALUES (?, ?, ?, 0)
-        """, (user_id, username, today))
+        with self._transaction() as cursor:
+            cursor.execute("""
+                INSERT OR IGNORE INTO users (user_id, username, last_request_date, daily_requests)
+                VALUES (?, ?, ?, 0)
+            """, (user_id, username, today))
         
-        conn.commit()
-        conn.close()
         logger.info(f"✅ Новый пользователь: {user_id}")
     
     def update_user_plan(self, user_id: int, plan: str, days: int = None):
         """Обновить тарифный план (с поддержкой PRO)"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        if plan == 'vip':
-            cursor.execute("""
-                UPDATE users SET plan = 'vip', premium_expires = NULL
-                WHERE user_id = ?
-            """, (user_id,))
-        
-        elif plan in ['premium', 'pro'] and days:  # 🔥 PRO добавлен
-            expires = (datetime.now() + timedelta(days=days)).isoformat()
-            cursor.execute("""
-                UPDATE users SET plan = ?, premium_expires = ?
-                WHERE user_id = ?
-            """, (plan, expires, user_id))
-        
-        else:
-            cursor.execute("""
-                UPDATE users SET plan = 'free', premium_expires = NULL
+        with self._transaction() as cursor:
+            if plan == 'vip':
+                cursor.execute("""
+                    UPDATE users SET plan = 'vip', premium_expires = NULL
+                    WHERE user_id = ?
+                """, (user_id,))
+            
+            elif plan in ['premium', 'pro'] and days:  # 🔥 PRO добавлен
+                expires = (datetime.now() + timedelta(days=days)).isoformat()
+                cursor.execute("""
+                    UPDATE users SET plan = ?, premium_expires = ?
+                    WHERE user_id = ?
+                """, (plan, expires, user_id))
+            
+            else:
+                cursor.execute("""
+                    UPDATE users SET plan = 'free', premium_expires = NULL
+                    WHERE user_id = ?
+                """, (user_id,))
+    
+    def save_user_states(self, rows: list):
+        """
+        Записать пачку состояний пользователей (из UserCache)
+        
+        Args:
+            rows: [(plan, premium_expires, daily_requests, last_request_date, user_id), ...]
+        """
+        with self._transaction() as cursor:
+            cursor.executemany("""
+                UPDATE users SET plan = ?, premium_expires = ?,
+                    daily_requests = ?, last_request_date = ?
                 WHERE user_id = ?
-            """, (user_id,))
-        
-        conn.commit()
-        conn.close()
-    
-    def get_remaining_requests(self, user_id: int) -> int:
-        """Получить оставшиеся запросы (с поддержкой PRO)"""
-        user = self.get_user(user_id)
-        if not user:
-            return 0
-        
-        plan = user['plan']
-        
-        # VIP - бесконечно
-        if plan == 'vip':
-            return 999999
-        
-        # Premium - проверяем срок
-        if plan == 'premium':
-            if user['premium_expires']:
-                expires = datetime.fromisoformat(user['premium_expires'])
-                if expires > datetime.now():
-                    return 999999
-                else:
-                    self.update_user_plan(user_id, 'free')
-        
-        # 🔥 PRO - 20 запросов/день
-        if plan == 'pro':
-            if user['premium_expires']:
-                expires = datetime.fromisoformat(user['premium_expires'])
-                if expires > datetime.now():
-                    # Проверяем дневной лимит PRO
-                    today = datetime.now().strftime("%Y-%m-%d")
-                    if user['last_request_date'] != today:
-                        self._reset_daily_requests(user_id)
-                        return PRO_DAILY_LIMIT
-                    return max(0, PRO_DAILY_LIMIT - user['daily_requests'])
-                else:
-                    self.update_user_plan(user_id, 'free')
-        
-        # FREE - 10 запросов/день
-        today = datetime.now().strftime("%Y-%m-%d")
-        if user['last_request_date'] != today:
-            self._reset_daily_requests(user_id)
-            return FREE_DAILY_LIMIT
-        
-        return max(0, FREE_DAILY_LIMIT - user['daily_requests'])
+            """, rows)
     
-    def _reset_daily_requests(self, user_id: int):
-        """Сброс дневного счётчика"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        today = datetime.now().strftime("%Y-%m-%d")
-        cursor.execute("""
-            UPDATE users SET daily_requests = 0, last_request_date = ?
-            WHERE user_id = ?
-        """, (today, user_id))
-        
-        conn.commit()
-        conn.close()
+    # ========================================
+    # КВОТА ЗАПРОСОВ
+    # ========================================
     
-    def use_request(self, user_id: int):
-        """Использовать один запрос"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            UPDATE users SET daily_requests = daily_requests + 1
-            WHERE user_id = ?
-        """, (user_id,))
-        
-        conn.commit()
-        conn.close()
+    def reserve_request(self, user_id: int):
+        """
+        Атомарно занять один запрос
+        
+        Один UPDATE ... RETURNING: истечение тарифа, сброс дневного
+        счётчика, проверка лимита и списание. Параллельные сообщения
+        одного пользователя не могут вместе превысить лимит.
+        
+        Returns:
+            dict | None: резерв (тариф и счётчик после списания)
+                или None, если лимит исчерпан
+        """
+        now = datetime.now()
+        params = {
+            "user_id": user_id,
+            "now": now.isoformat(),
+            "today": now.strftime("%Y-%m-%d"),
+            "free_limit": FREE_DAILY_LIMIT,
+            "pro_limit": PRO_DAILY_LIMIT,
+        }
+        
+        expired = "(plan IN ('premium', 'pro') AND premium_expires IS NOT NULL AND premium_expires <= :now)"
+        unlimited = "(plan = 'vip' OR (plan = 'premium' AND premium_expires > :now))"
+        used = "(CASE WHEN last_request_date = :today THEN daily_requests ELSE 0 END)"
+        limit = "(CASE WHEN plan = 'pro' AND premium_expires > :now THEN :pro_limit ELSE :free_limit END)"
+        
+        with self._transaction() as cursor:
+            cursor.execute(f"""
+                UPDATE users SET
+                    plan = CASE WHEN {expired} THEN 'free' ELSE plan END,
+                    premium_expires = CASE WHEN {expired} THEN NULL ELSE premium_expires END,
+                    daily_requests = CASE WHEN {unlimited} THEN {used} ELSE {used} + 1 END,
+                    last_request_date = :today
+                WHERE user_id = :user_id AND ({unlimited} OR {used} < {limit})
+                RETURNING plan, premium_expires, daily_requests, last_request_date,
+                    NOT {unlimited} AS counted
+            """, params)
+            row = cursor.fetchone()
+        
+        if not row:
+            return None
+        
+        reservation = dict(row)
+        reservation.update(user_id=user_id, counted=bool(row['counted']), committed=False)
+        return reservation
+    
+    def commit_request(self, reservation: dict):
+        """
+        Подтвердить резерв после успешного ответа
+        
+        Запрос уже списан в reserve_request, поэтому в базу ничего
+        не пишется - резерв просто закрывается и вернуть его нельзя.
+        """
+        reservation['committed'] = True
+    
+    def refund_request(self, reservation: dict) -> bool:
+        """
+        Вернуть резерв, если ответ не получен
+        
+        Returns:
+            bool: был ли запрос возвращён
+        """
+        if reservation['committed'] or not reservation['counted']:
+            return False
+        reservation['committed'] = True
+        
+        # Если наступил новый день, счётчик уже сброшен - возвращать нечего
+        with self._transaction() as cursor:
+            cursor.execute("""
+                UPDATE users SET daily_requests = daily_requests - 1
+                WHERE user_id = ? AND last_request_date = ?
+            """, (reservation['user_id'], reservation['last_request_date']))
+            return cursor.rowcount > 0
     
     # ========================================
     # ПРОМОКОДЫ
@@ -203,64 +225,54 @@ class DatabaseService:
     def create_promocode(self, code: str, promo_type: str, days: int = None, 
                         requests: int = None, uses: int = 1):
         """Создать промокод"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            INSERT OR REPLACE INTO promocodes (code, type, days, requests, uses_left)
-            VALUES (?, ?, ?, ?, ?)
-        """, (code.upper(), promo_type, days, requests, uses))
+        with self._transaction() as cursor:
+            cursor.execute("""
+                INSERT OR REPLACE INTO promocodes (code, type, days, requests, uses_left)
+                VALUES (?, ?, ?, ?, ?)
+            """, (code.upper(), promo_type, days, requests, uses))
         
-        conn.commit()
-        conn.close()
         logger.info(f"✅ Промокод создан: {code}")
     
     def activate_promocode(self, user_id: int, code: str):
         """Активировать промокод (с поддержкой PRO)"""
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        
         code = code.upper()
         
-        cursor.execute("SELECT * FROM promocodes WHERE code = ?", (code,))
-        promo = cursor.fetchone()
-        
-        if not promo:
-            conn.close()
-            return {"success": False, "error": "Промокод не найден"}
-        
-        cursor.execute("SELECT * FROM used_promocodes WHERE user_id = ? AND code = ?", 
-                      (user_id, code))
-        if cursor.fetchone():
-            conn.close()
-            return {"success": False, "error": "Уже использован"}
-        
-        if promo['uses_left'] <= 0:
-            conn.close()
-            return {"success": False, "error": "Промокод исчерпан"}
-        
-        # Активация
-        if promo['type'] == 'vip':
-            self.update_user_plan(user_id, 'vip')
-        
-        elif promo['type'] == 'premium':
-            self.update_user_plan(user_id, 'premium', promo['days'])
-        
-        elif promo['type'] == 'pro':  # 🔥 НОВЫЙ PRO
-            self.update_user_plan(user_id, 'pro', promo['days'])
-        
-        elif promo['type'] == 'requests':
-            cursor.execute("UPDATE users SET daily_requests = daily_requests - ? WHERE user_id = ?", 
-                          (promo['requests'], user_id))
-        
-        cursor.execute("INSERT INTO used_promocodes (user_id, code) VALUES (?, ?)", 
-                      (user_id, code))
-        cursor.execute("UPDATE promocodes SET uses_left = uses_left - 1 WHERE code = ?", 
-                      (code,))
-        
-        conn.commit()
-        conn.close()
+        # Одна транзакция: проверки, смена тарифа и списание использования
+        with self._transaction() as cursor:
+            cursor.execute("SELECT * FROM promocodes WHERE code = ?", (code,))
+            promo = cursor.fetchone()
+            
+            if not promo:
+                return {"success": False, "error": "Промокод не найден"}
+            
+            cursor.execute("SELECT * FROM used_promocodes WHERE user_id = ? AND code = ?", 
+                          (user_id, code))
+            if cursor.fetchone():
+                return {"success": False, "error": "Уже использован"}
+            
+            # Списываем использование первым же UPDATE с условием: он берёт блокировку
+            # записи, и два процесса не потратят последнее использование дважды
+            cursor.execute("UPDATE promocodes SET uses_left = uses_left - 1 WHERE code = ? AND uses_left > 0",
+                          (code,))
+            if cursor.rowcount == 0:
+                return {"success": False, "error": "Промокод исчерпан"}
+            
+            # Активация
+            if promo['type'] == 'vip':
+                self.update_user_plan(user_id, 'vip')
+            
+            elif promo['type'] == 'premium':
+                self.update_user_plan(user_id, 'premium', promo['days'])
+            
+            elif promo['type'] == 'pro':  # 🔥 НОВЫЙ PRO
+                self.update_user_plan(user_id, 'pro', promo['days'])
+            
+            elif promo['type'] == 'requests':
+                cursor.execute("UPDATE users SET daily_requests = daily_requests - ? WHERE user_id = ?", 
+                              (promo['requests'], user_id))
+            
+            cursor.execute("INSERT INTO used_promocodes (user_id, code) VALUES (?, ?)", 
+                          (user_id, code))
         
         return {"success": True, "promo": dict(promo)}
     
@@ -269,58 +281,215 @@ class DatabaseService:
     # ========================================
     
     def save_message(self, user_id: int, role: str, content: str):
-        """Сохранить сообщение"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            INSERT INTO conversations (user_id, role, content)
-            VALUES (?, ?, ?)
-        """, (user_id, role, content))
-        
-        conn.commit()
-        conn.close()
+        """Сохранить сообщение (в базу попадёт со следующей пачкой)"""
+        self.writes.add((user_id, role, content))
+        self.history.append(user_id, role, content)
+    
+    def _insert_messages(self, rows: list):
+        """Записать пачку сообщений одной транзакцией"""
+        with self._transaction() as cursor:
+            cursor.executemany("""
+                INSERT INTO conversations (user_id, role, content)
+                VALUES (?, ?, ?)
+            """, rows)
     
     def get_conversation_history(self, user_id: int, limit: int = MAX_HISTORY):
-        """Получить историю"""
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
+        """Получить историю (из памяти, при промахе - из базы)"""
+        cached = self.history.get(user_id, limit)
+        if cached is not None:
+            return cached
+        
+        # Читаем сразу на весь буфер, чтобы следующие сообщения шли из памяти
+        self.writes.flush()
+        with self._transaction() as cursor:
+            cursor.execute("""
+                SELECT role, content FROM conversations
+                WHERE user_id = ?
+                ORDER BY id DESC
+                LIMIT ?
+            """, (user_id, max(limit, self.history.max_turns)))
+            
+            messages = cursor.fetchall()
+        
+        history = [(msg['role'], msg['content']) for msg in reversed(messages)]
+        if limit <= self.history.max_turns:
+            self.history.fill(user_id, history)
+        return history[-limit:] if limit else []
+    
+    def clear_history(self, user_id: int):
+        """Очистить историю"""
+        self.writes.discard(lambda row: row[0] == user_id)
+        with self._transaction() as cursor:
+            cursor.execute("DELETE FROM conversations WHERE user_id = ?", (user_id,))
+            cursor.execute("DELETE FROM user_summaries WHERE user_id = ?", (user_id,))
         
-        cursor.execute("""
-            SELECT role, content FROM conversations
-            WHERE user_id = ?
-            ORDER BY id DESC
-            LIMIT ?
-        """, (user_id, limit))
+        self.history.drop(user_id)
+        logger.info(f"🗑️ История очищена для {user_id}")
+    
+    def get_summary(self, user_id: int):
+        """Сводка старой части диалога"""
+        with self._transaction() as cursor:
+            cursor.execute("""
+                SELECT summary, last_message_id FROM user_summaries
+                WHERE user_id = ?
+            """, (user_id,))
+            row = cursor.fetchone()
         
-        messages = cursor.fetchall()
-        conn.close()
+        return dict(row) if row else None
+    
+    def save_summary(self, user_id: int, summary: str, last_message_id: int):
+        """Сохранить сводку"""
+        with self._transaction() as cursor:
+            cursor.execute("""
+                INSERT OR REPLACE INTO user_summaries (user_id, summary, last_message_id, updated_at)
+                VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+            """, (user_id, summary, last_message_id))
+    
+    def get_unsummarized_messages(self, user_id: int, after_id: int, skip_recent: int, limit: int):
+        """
+        Сообщения, которые ещё не вошли в сводку
+        
+        Последние skip_recent сообщений не берём - они и так идут
+        в промпт как история.
+        """
+        self.writes.flush()
+        with self._transaction() as cursor:
+            cursor.execute("""
+                SELECT id, role, content FROM conversations
+                WHERE user_id = ? AND id > ? AND id <= (
+                    SELECT id FROM conversations
+                    WHERE user_id = ?
+                    ORDER BY id DESC
+                    LIMIT 1 OFFSET ?
+                )
+                ORDER BY id
+                LIMIT ?
+            """, (user_id, after_id, user_id, skip_recent, limit))
+            return [dict(row) for row in cursor.fetchall()]
+    
+    def users_over_history_limit(self, keep: int, after_user_id: int, limit: int) -> tuple:
+        """
+        Пользователи, у которых сообщений больше keep - одна страница
+        
+        Смотрит только limit следующих user_id после after_user_id, чтобы
+        не держать блокировку на подсчёте по всей таблице.
         
-        return [(msg['role'], msg['content']) for msg in reversed(messages)]
+        Returns:
+            tuple: (список user_id, последний просмотренный user_id или None - дальше никого)
+        """
+        with self._transaction() as cursor:
+            cursor.execute("""
+                SELECT MAX(user_id) AS last FROM (
+                    SELECT DISTINCT user_id FROM conversations
+                    WHERE user_id > ?
+                    ORDER BY user_id
+                    LIMIT ?
+                )
+            """, (after_user_id, limit))
+            last = cursor.fetchone()['last']
+            if last is None:
+                return [], None
+            
+            cursor.execute("""
+                SELECT user_id FROM conversations
+                WHERE user_id > ? AND user_id <= ?
+                GROUP BY user_id
+                HAVING COUNT(*) > ?
+            """, (after_user_id, last, keep))
+            return [row['user_id'] for row in cursor.fetchall()], last
     
-    def clear_history(self, user_id: int):
-        """Очистить историю"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+    def trim_history(self, user_id: int, keep: int, batch_size: int, archive: bool) -> int:
+        """
+        Удалить одну пачку старых сообщений пользователя
         
-        cursor.execute("DELETE FROM conversations WHERE user_id = ?", (user_id,))
+        Оставляет keep последних сообщений. Одна короткая транзакция,
+        чтобы не держать блокировку записи надолго.
         
-        conn.commit()
-        conn.close()
-        logger.info(f"🗑️ История очищена для {user_id}")
+        Returns:
+            int: сколько сообщений удалено (0 - больше нечего)
+        """
+        with self._transaction() as cursor:
+            cursor.execute("""
+                SELECT id FROM conversations
+                WHERE user_id = ?
+                ORDER BY id DESC
+                LIMIT 1 OFFSET ?
+            """, (user_id, keep))
+            row = cursor.fetchone()
+            if not row:
+                return 0
+            
+            cursor.execute("""
+                SELECT id FROM conversations
+                WHERE user_id = ? AND id <= ?
+                ORDER BY id
+                LIMIT ?
+            """, (user_id, row['id'], batch_size))
+            ids = [(r['id'],) for r in cursor.fetchall()]
+            
+            if archive:
+                cursor.executemany("""
+                    INSERT OR IGNORE INTO conversations_archive (id, user_id, role, content, created_at)
+                    SELECT id, user_id, role, content, created_at FROM conversations WHERE id = ?
+                """, ids)
+            cursor.executemany("DELETE FROM conversations WHERE id = ?", ids)
+        
+        return len(ids)
+    
+    def incremental_vacuum(self, pages: int) -> bool:
+        """Вернуть системе до pages свободных страниц"""
+        with self._lock:
+            if self._conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+                return False
+            self._conn.execute(f"PRAGMA incremental_vacuum({int(pages)})").fetchall()
+            return True
+    
+    def vacuum(self):
+        """Полное сжатие базы с переводом в режим incremental vacuum (долго!)"""
+        self.writes.flush()
+        with self._lock:
+            self._conn.commit()
+            self._conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            self._conn.execute("VACUUM")
     
     def get_user_stats(self, user_id: int):
         """Статистика"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            SELECT COUNT(*) as total FROM conversations
-            WHERE user_id = ? AND role = 'user'
-        """, (user_id,))
+        self.writes.flush()
+        with self._transaction() as cursor:
+            cursor.execute("""
+                SELECT COUNT(*) as total FROM conversations
+                WHERE user_id = ? AND role = 'user'
+            """, (user_id,))
+            
+            total = cursor.fetchone()[0]
         
-        total = cursor.fetchone()[0]
-        conn.close()
+        return {"total_messages": total}
+    
+    # ========================================
+    # КЭШ ОТВЕТОВ
+    # ========================================
+    
+    def get_cached_response(self, key: str, now: float):
+        """Непросроченный ответ из кэша"""
+        with self._transaction() as cursor:
+            cursor.execute("""
+                SELECT response, expires_at FROM response_cache
+                WHERE key = ? AND expires_at > ?
+            """, (key, now))
+            row = cursor.fetchone()
         
-        return {"total_messages": total}
\ No newline at end of file
+        return dict(row) if row else None
+    
+    def save_cached_response(self, key: str, command: str, response: str, expires_at: float):
+        """Сохранить ответ в кэш"""
+        with self._transaction() as cursor:
+            cursor.execute("""
+                INSERT OR REPLACE INTO response_cache (key, command, response, expires_at)
+                VALUES (?, ?, ?, ?)
+            """, (key, command, response, expires_at))
+    
+    def purge_expired_responses(self, now: float) -> int:
+        """Удалить просроченные ответы"""
+        with self._transaction() as cursor:
+            cursor.execute("DELETE FROM response_cache WHERE expires_at <= ?", (now,))
+            return cursor.rowcount
\ No newline at end of file
@@ -1,144 +1,562 @@
 # gemini_api.py - с улучшенной обработкой ошибок
-import google.generativeai as genai
-from config import GEMINI_API_KEY, GEMINI_MODEL, BOT_PERSONALITY, MAX_MESSAGE_LENGTH
+from config import (GEMINI_MODEL, BOT_PERSONALITY, MAX_MESSAGE_LENGTH, CONTEXT_TOKEN_BUDGET,
+                    SUMMARY_MAX_CHARS, PREFIX_CACHE_ENABLED, ADMISSION_ENABLED, GEMINI_MAX_RETRIES,
+                    HEDGE_ENABLED)
+from admission import AdmissionController, AdmissionTimeout
+from gemini_backend import GenaiBackend, PrefixCache, PrefixEvicted
+from metrics import GEMINI_SECONDS, GEMINI_ERRORS, GEMINI_RETRIES, ADMISSION_WAIT
+from resilience import (CircuitBreaker, CircuitOpen, LatencyTracker, backoff_delay, classify, hedged,
+                        retry_after, RATE_LIMIT, NOT_FOUND, TIMEOUT, INVALID, OPEN)
+from utils.context_builder import build_contents, estimate_tokens
+import asyncio
 import logging
 import time
 
 logger = logging.getLogger(__name__)
 
+# Инструкция для сводки старой части диалога
+SUMMARY_INSTRUCTION = (
+    "Обнови краткую память о пользователе по диалогу, который пришлют. "
+    "Сохрани имя, предпочтения, важные факты и незакрытые вопросы. "
+    "Пиши сжато, по пунктам, не длиннее {max_chars} символов. "
+    "Верни только саму сводку."
+)
+
+# Что увидит пользователь, если ответа так и нет
+EMPTY_REPLY = "😔 Не смог сгенерировать ответ. Попробуй /clear и напиши снова!"
+RETRIES_EXHAUSTED = ("😔 Ошибка после {max_retries} попыток. Попробуй:\n1️⃣ /clear - очистить историю\n"
+                     "2️⃣ Написать короче\n3️⃣ Подождать минуту")
+# Тариф идёт в последнее сообщение, а не в system_instruction: так правила
+# бота одинаковы для всех тарифов и кэшируются одним префиксом
+PLAN_NOTE = "[ИНФОРМАЦИЯ: Тариф '{plan}']"
+INTERRUPTED = "\n\n...(ответ прерван)"  # дописывается к уже показанной части потока
+
+
+class GenerationFailed(Exception):
+    """
+    Ответа от модели нет - в reply текст для пользователя
+    
+    Признак ошибки идёт исключением, а не по тексту: такой ответ не
+    попадает в историю и кэш, а запрос возвращается в лимит.
+    """
+    
+    def __init__(self, reply: str, kind: str = None):
+        super().__init__(reply)
+        self.reply = reply
+        self.kind = kind  # класс ошибки (resilience.classify) или "empty"
+
+
+class _QueueWatchers:
+    """
+    Место в очереди для всех, кто ждёт одну генерацию
+    
+    Генерация стоит в очереди один раз, а сообщение «ты в очереди»
+    нужно каждому присоединившемуся.
+    """
+    
+    def __init__(self, on_queued=None):
+        self.callbacks = []
+        self.add(on_queued)
+    
+    def add(self, on_queued):
+        if on_queued:
+            self.callbacks.append(on_queued)
+    
+    def discard(self, on_queued):
+        if on_queued in self.callbacks:
+            self.callbacks.remove(on_queued)
+    
+    async def __call__(self, position: int):
+        # Ошибка показа одному ожидающему не должна ронять генерацию остальным
+        await asyncio.gather(*(callback(position) for callback in list(self.callbacks)), return_exceptions=True)
+
+
+class _SharedStream:
+    """
+    Один поток генерации на несколько получателей
+    
+    Куски копятся в списке, поэтому подключившийся позже получатель
+    сначала догоняет уже готовый текст, а потом читает вместе со всеми.
+    """
+    
+    def __init__(self, source):
+        self.chunks = []
+        self.done = False
+        self.error = None
+        self._changed = asyncio.Event()
+        self.task = asyncio.ensure_future(self._pump(source))
+    
+    async def _pump(self, source):
+        try:
+            async for chunk in source:
+                self.chunks.append(chunk)
+                self._notify()
+        except Exception as e:
+            self.error = e
+        finally:
+            self.done = True
+            self._notify()
+    
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+    
+    async def subscribe(self):
+        position = 0
+        while True:
+            while position < len(self.chunks):
+                yield self.chunks[position]
+                position += 1
+            
+            if self.done:
+                if self.error:
+                    raise self.error
+                return
+            
+            await self._changed.wait()
+
 
 class GeminiAPI:
-    def __init__(self):
-        """Инициализация Gemini"""
-        genai.configure(api_key=GEMINI_API_KEY)
+    def __init__(self, backend=None):
+        """
+        Инициализация Gemini
         
+        Args:
+            backend: GenaiBackend (по умолчанию) или FakeBackend для проверок без сети
+        """
         # Настройки генерации
-        generation_config = {
+        self.generation_config = {
             "temperature": 0.9,
             "top_p": 0.95,
             "top_k": 40,
             "max_output_tokens": 2048,
         }
         
-        # Создаём модель
-        self.model = genai.GenerativeModel(
-            GEMINI_MODEL,
-            generation_config=generation_config
-        )
-        
         # Системный промпт
         self.system_prompt = "\n".join(BOT_PERSONALITY)
+        self.summary_instruction = SUMMARY_INSTRUCTION.format(max_chars=SUMMARY_MAX_CHARS)
+        
+        self.backend = backend or GenaiBackend(GEMINI_MODEL, self.generation_config)
+        
+        # Статичное начало промпта кэшируется на стороне API
+        self.prefixes = PrefixCache(self.backend) if PREFIX_CACHE_ENABLED else None
+        
+        # Очередь по тарифам в пределах квоты API
+        self.admission = AdmissionController() if ADMISSION_ENABLED else None
+        
+        # Сбои модели: предохранитель и время ответа для хеджирования
+        self.breaker = CircuitBreaker(GEMINI_MODEL)
+        self.latency = LatencyTracker()
+        self.hedges = 0
+        
+        # Выполняющиеся запросы: (coalesce_key, тариф) -> (Future/_SharedStream, _QueueWatchers)
+        self._inflight = {}
         logger.info(f"✅ Gemini API инициализирован (модель: {GEMINI_MODEL})")
     
-    def generate_response(self, message: str, history: list = None, user_plan: str = "free") -> str:
+    async def generate_response(self, message: str, history: list = None, user_plan: str = "free",
+                                coalesce_key: str = None, summary: str = None,
+                                template: str = None, on_queued=None) -> str:
         """
-        Генерация ответа с retry логикой
+        Асинхронная генерация ответа с retry логикой
+        
+        Не блокирует event loop: пока один пользователь ждёт ответа
+        или паузы между попытками, остальные чаты обрабатываются.
         
         Args:
             message: сообщение пользователя
             history: история диалога [(role, content), ...]
             user_plan: тарифный план
+            coalesce_key: ключ для объединения одинаковых запросов
+                (только шаблоны команд, не личный диалог); объединяются
+                только запросы одного тарифа - тариф есть в промпте и
+                задаёт приоритет в очереди
+            summary: краткая память о более старом диалоге
+            template: статичный шаблон команды (кэшируется вместе с правилами)
+            on_queued: async (место в очереди) -> None, если запросу пришлось ждать квоту
         
         Returns:
             str: ответ AI
+        
+        Raises:
+            GenerationFailed: ответа нет (в reply - что сказать пользователю)
         """
-        max_retries = 3
-        retry_delay = 2
+        if coalesce_key is None:
+            return await self._generate(message, history, user_plan, summary, template, on_queued)
+        
+        # Такой же запрос уже выполняется - ждём его результат
+        key = (coalesce_key, user_plan)
+        inflight = self._inflight.get(key)
+        if inflight is None:
+            watchers = _QueueWatchers(on_queued)
+            future = asyncio.ensure_future(self._generate(message, history, user_plan, summary, template,
+                                                          watchers))
+            self._track_inflight(key, (future, watchers), future)
+        else:
+            future, watchers = inflight
+            watchers.add(on_queued)
+            logger.info(f"🔗 Присоединились к запросу: {coalesce_key}")
+        
+        # shield: отмена одного ожидающего не отменяет генерацию для остальных
+        try:
+            return await asyncio.shield(future)
+        finally:
+            watchers.discard(on_queued)
+    
+    async def _generate(self, message: str, history: list, user_plan: str, summary: str = None,
+                        template: str = None, on_queued=None) -> str:
+        """Одна генерация с повторами"""
+        max_retries = GEMINI_MAX_RETRIES
+        
+        # Формируем контекст (одинаковый для всех попыток)
+        contents = self._build_context(message, history, user_plan, summary, template)
         
         for attempt in range(max_retries):
             try:
-                # Формируем контекст
-                full_context = self._build_context(message, history, user_plan)
-                
                 logger.info(f"📝 Попытка {attempt + 1}/{max_retries} - Запрос к Gemini")
                 
                 # Генерация с таймаутом
-                response = self.model.generate_content(
-                    full_context,
-                    request_options={'timeout': 30}
-                )
+                response = await self._request(user_plan, contents, template, on_queued=on_queued,
+                                               attempt=attempt)
                 
                 if not response or not response.text:
                     logger.warning(f"⚠️ Пустой ответ на попытке {attempt + 1}")
                     if attempt < max_retries - 1:
-                        time.sleep(retry_delay)
+                        GEMINI_RETRIES.inc("empty")
+                        await asyncio.sleep(backoff_delay(attempt))
                         continue
-                    return "😔 Не смог сгенерировать ответ. Попробуй /clear и напиши снова!"
-                
-                ai_response = response.text.strip()
-                
-                # Очистка артефактов
-                ai_response = self._clean_response(ai_response)
-                
-                # Обрезка
-                if len(ai_response) > MAX_MESSAGE_LENGTH:
-                    ai_response = ai_response[:MAX_MESSAGE_LENGTH] + "\n\n...(обрезано)"
+                    raise GenerationFailed(EMPTY_REPLY, "empty")
                 
+                ai_response = self._finalize_response(response.text)
                 logger.info(f"✅ Ответ получен (длина: {len(ai_response)})")
                 return ai_response
-                
+            
+            except GenerationFailed:
+                raise
+            
             except Exception as e:
-                error_msg = str(e)
-                logger.error(f"❌ Ошибка на попытке {attempt + 1}: {error_msg}")
+                error_reply = self._error_reply(e, attempt, max_retries)
+                if error_reply:
+                    raise GenerationFailed(error_reply, classify(e)) from e
                 
-                # Проверяем тип ошибки
-                if "429" in error_msg or "quota" in error_msg.lower():
-                    return "😔 Превышен лимит запросов к Gemini API. Попробуй через минуту! ⏰"
+                # Если не последняя попытка - пробуем снова
+                if attempt < max_retries - 1:
+                    GEMINI_RETRIES.inc(classify(e))
+                    delay = backoff_delay(attempt)
+                    logger.info(f"🔄 Повтор через {delay:.1f} сек...")
+                    await asyncio.sleep(delay)
+                    continue
+        
+        # Все попытки исчерпаны
+        logger.error(f"❌ Все {max_retries} попытки исчерпаны")
+        raise GenerationFailed(RETRIES_EXHAUSTED.format(max_retries=max_retries))
+    
+    async def stream_response(self, message: str, history: list = None, user_plan: str = "free",
+                              coalesce_key: str = None, summary: str = None, template: str = None,
+                              on_queued=None):
+        """
+        Потоковая генерация: отдаёт текст кусками по мере готовности
+        
+        Повтор возможен, только пока пользователю ещё ничего не отдано.
+        Ошибки - исключением GenerationFailed, как в generate_response;
+        если поток оборвался на середине, reply дописывается к уже
+        отданному тексту.
+        Одинаковые потоки с coalesce_key (и тарифом) читают одну генерацию.
+        
+        Yields:
+            str: очередной кусок ответа
+        """
+        if coalesce_key is None:
+            async for chunk in self._stream(message, history, user_plan, summary, template, on_queued):
+                yield chunk
+            return
+        
+        key = ("stream", coalesce_key, user_plan)
+        inflight = self._inflight.get(key)
+        if inflight is None:
+            watchers = _QueueWatchers(on_queued)
+            shared = _SharedStream(self._stream(message, history, user_plan, summary, template, watchers))
+            self._track_inflight(key, (shared, watchers), shared.task)
+        else:
+            shared, watchers = inflight
+            watchers.add(on_queued)
+            logger.info(f"🔗 Присоединились к потоку: {coalesce_key}")
+        
+        try:
+            async for chunk in shared.subscribe():
+                yield chunk
+        finally:
+            watchers.discard(on_queued)
+    
+    async def _stream(self, message: str, history: list, user_plan: str, summary: str = None,
+                      template: str = None, on_queued=None):
+        """Один поток генерации с повторами"""
+        max_retries = GEMINI_MAX_RETRIES
+        
+        contents = self._build_context(message, history, user_plan, summary, template)
+        
+        for attempt in range(max_retries):
+            produced = 0
+            response = None
+            try:
+                logger.info(f"📝 Попытка {attempt + 1}/{max_retries} - Потоковый запрос к Gemini")
                 
-                elif "404" in error_msg:
-                    return f"😔 Модель {GEMINI_MODEL} не найдена. Проверь config.py!"
+                response = await self._request(user_plan, contents, template, stream=True, on_queued=on_queued,
+                                               attempt=attempt)
                 
-                elif "timeout" in error_msg.lower():
-                    logger.warning(f"⏱️ Таймаут на попытке {attempt + 1}")
-                    if attempt < max_retries - 1:
-                        time.sleep(retry_delay)
+                async for chunk in response:
+                    text = chunk.text
+                    if not text:
                         continue
-                    return "😔 Превышено время ожидания. Попробуй /clear или напиши короче!"
+                    
+                    # Обрезка
+                    if produced + len(text) > MAX_MESSAGE_LENGTH:
+                        yield text[:MAX_MESSAGE_LENGTH - produced] + "\n\n...(обрезано)"
+                        produced = MAX_MESSAGE_LENGTH
+                        break
+                    
+                    produced += len(text)
+                    yield text
                 
-                # Если не последняя попытка - пробуем снова
+                if produced:
+                    logger.info(f"✅ Поток завершён (длина: {produced})")
+                    return
+                
+                logger.warning(f"⚠️ Пустой ответ на попытке {attempt + 1}")
                 if attempt < max_retries - 1:
-                    logger.info(f"🔄 Повтор через {retry_delay} сек...")
-                    time.sleep(retry_delay)
-                    retry_delay *= 2  # Увеличиваем задержку
+                    GEMINI_RETRIES.inc("empty")
+                    await asyncio.sleep(backoff_delay(attempt))
                     continue
+                raise GenerationFailed(EMPTY_REPLY, "empty")
+            
+            except GenerationFailed:
+                raise
+            
+            except Exception as e:
+                # Поток открылся и оборвался - это тоже сбой модели
+                if response is not None:
+                    self.breaker.record_failure(classify(e))
+                    GEMINI_ERRORS.inc(GEMINI_MODEL, classify(e))
+                
+                # Часть ответа уже у пользователя - повторять поздно. Неполный
+                # ответ - тоже неудача: ни в историю, ни в кэш, ни в лимит
+                if produced:
+                    logger.error(f"❌ Поток оборвался: {e}")
+                    raise GenerationFailed(INTERRUPTED, classify(e)) from e
+                
+                error_reply = self._error_reply(e, attempt, max_retries)
+                if error_reply:
+                    raise GenerationFailed(error_reply, classify(e)) from e
+                
+                if attempt < max_retries - 1:
+                    GEMINI_RETRIES.inc(classify(e))
+                    delay = backoff_delay(attempt)
+                    logger.info(f"🔄 Повтор через {delay:.1f} сек...")
+                    await asyncio.sleep(delay)
         
-        # Все попытки исчерпаны
         logger.error(f"❌ Все {max_retries} попытки исчерпаны")
-        return "😔 Ошибка после 3 попыток. Попробуй:\n1️⃣ /clear - очистить историю\n2️⃣ Написать короче\n3️⃣ Подождать минуту"
-    
-    def _build_context(self, message: str, history: list, user_plan: str) -> str:
-        """Формирование контекста для Gemini"""
-        full_context = f"{self.system_prompt}\n\n"
-        full_context += f"[ИНФОРМАЦИЯ: Тариф '{user_plan}']\n\n"
-        
-        # Добавляем историю (только последние сообщения)
-        if history and len(history) > 0:
-            full_context += "=== История ===\n"
-            for role, content in history[-4:]:  # Берём только 4 последних
-                if role == "user":
-                    full_context += f"👤: {content[:200]}\n"  # Обрезаем длинные сообщения
-                else:
-                    full_context += f"🤖: {content[:200]}\n"
-            full_context += "=== Конец ===\n\n"
-        
-        # Текущее сообщение
-        full_context += f"👤: {message}\n🤖:"
-        
-        return full_context
-    
-    def _clean_response(self, text: str) -> str:
-        """Очистка ответа от артефактов"""
-        text = text.replace("🤖 Ассистент:", "").strip()
-        text = text.replace("Ассистент:", "").strip()
-        text = text.replace("🤖:", "").strip()
-        return text
-    
-    def test_connection(self) -> bool:
+        raise GenerationFailed(RETRIES_EXHAUSTED.format(max_retries=max_retries))
+    
+    def _track_inflight(self, key, entry, task):
+        """Запомнить выполняющийся запрос до завершения его задачи"""
+        self._inflight[key] = entry
+        
+        def forget(_):
+            if self._inflight.get(key) is entry:
+                del self._inflight[key]
+        
+        task.add_done_callback(forget)
+    
+    def _error_reply(self, e: Exception, attempt: int, max_retries: int):
+        """Сообщение об ошибке для пользователя или None, если стоит повторить"""
+        if isinstance(e, AdmissionTimeout):
+            return "😔 Сейчас очень много запросов, очередь не дошла. Попробуй через минуту! ⏰"
+        
+        # Проверяем тип ошибки (по классу исключения, не по тексту)
+        kind = classify(e)
+        logger.error(f"❌ Ошибка на попытке {attempt + 1} ({kind}): {e}")
+        
+        if kind == OPEN:
+            # Модель лежит - не ждём таймаутов, отвечаем сразу
+            return "😔 Gemini сейчас недоступен. Попробуй через пару минут! ⏰"
+        
+        elif kind == RATE_LIMIT:
+            if self.admission:
+                # Квота кончилась раньше расчётной - повтор встанет в очередь
+                self.admission.throttle(retry_after(e))
+                return None
+            return "😔 Превышен лимит запросов к Gemini API. Попробуй через минуту! ⏰"
+        
+        elif kind == NOT_FOUND:
+            return f"😔 Модель {GEMINI_MODEL} не найдена. Проверь config.py!"
+        
+        elif kind == INVALID:
+            # Повтор того же запроса ничего не изменит
+            return "😔 Gemini не принял запрос. Попробуй /clear и напиши по-другому!"
+        
+        elif kind == TIMEOUT:
+            logger.warning(f"⏱️ Таймаут на попытке {attempt + 1}")
+            if attempt == max_retries - 1:
+                return "😔 Превышено время ожидания. Попробуй /clear или напиши короче!"
+        
+        return None
+    
+    async def _request(self, user_plan: str, contents: list, template: str = None, stream: bool = False,
+                       on_queued=None, attempt: int = 0):
+        """
+        Запрос к backend с закэшированным префиксом, если он есть
+        
+        Сначала ждём допуска в пределах квоты (по тарифу). Обычный запрос,
+        который отвечает дольше p95, дублируется (если квота позволяет) -
+        берём тот ответ, что придёт первым.
+        """
+        system_instruction = self.system_prompt
+        prefix_contents = [{"role": "user", "parts": [template]}] if template else []
+        tokens = self._count_tokens(system_instruction, prefix_contents + contents)
+        
+        if self.admission:
+            ADMISSION_WAIT.observe(await self.admission.acquire(user_plan, tokens, on_queued), user_plan)
+        
+        prefix = await self.prefixes.get(system_instruction, prefix_contents) if self.prefixes else None
+        
+        async def call():
+            return await self._call(system_instruction, contents, prefix_contents, prefix, stream, attempt)
+        
+        # Поток уже показывается пользователю - его не дублируем
+        delay = self.latency.hedge_delay() if HEDGE_ENABLED and not stream else None
+        if delay is None:
+            return await call()
+        
+        allow_hedge = (lambda: self.admission.try_acquire(tokens)) if self.admission else None
+        response, hedge_sent = await hedged(call, delay, allow_hedge)
+        if hedge_sent:
+            self.hedges += 1
+            logger.info(f"🏇 Нет ответа за {delay:.1f} сек - отправлен дублирующий запрос")
+        return response
+    
+    async def _call(self, system_instruction: str, contents: list, prefix_contents: list = (),
+                    prefix=None, stream: bool = False, attempt: int = 0):
+        """
+        Один запрос к backend через предохранитель модели
+        
+        Префикс вытеснили - сразу повторяем тот же запрос целиком.
+        
+        Raises:
+            CircuitOpen: модель недавно много раз подряд не отвечала
+        """
+        try:
+            self.breaker.before_call()
+        except CircuitOpen:
+            GEMINI_ERRORS.inc(GEMINI_MODEL, OPEN)
+            raise
+        started = time.monotonic()
+        outcome = "ok"
+        try:
+            if prefix:
+                try:
+                    response = await self.backend.generate(system_instruction, contents, stream=stream, prefix=prefix)
+                except PrefixEvicted:
+                    logger.warning(f"♻️ Префикс {prefix.name} вытеснен, запрос без кэша")
+                    self.prefixes.evicted(prefix)
+                    prefix = None
+            if not prefix:
+                response = await self.backend.generate(system_instruction, list(prefix_contents) + contents,
+                                                       stream=stream)
+        except asyncio.CancelledError:
+            # Проиграл хедж или пользователь ушёл - о модели это ничего не говорит
+            outcome = "cancelled"
+            self.breaker.release()
+            raise
+        except Exception as e:
+            outcome = classify(e)
+            self.breaker.record_failure(outcome)
+            GEMINI_ERRORS.inc(GEMINI_MODEL, outcome)
+            raise
+        finally:
+            # Таймауты и 429 - как раз самые долгие попытки, их время тоже нужно
+            elapsed = time.monotonic() - started
+            GEMINI_SECONDS.observe(elapsed, GEMINI_MODEL, attempt + 1, "true" if stream else "false", outcome)
+        
+        self.breaker.record_success()
+        if not stream:
+            self.latency.add(elapsed)
+        return response
+    
+    @staticmethod
+    def _count_tokens(system_instruction: str, contents: list) -> int:
+        """Оценка входных токенов запроса (для квоты)"""
+        return estimate_tokens(system_instruction) + sum(
+            estimate_tokens(part) for content in contents for part in content["parts"]
+        )
+    
+    def _finalize_response(self, text: str) -> str:
+        """Обрезка готового ответа"""
+        ai_response = text.strip()
+        
+        # Обрезка
+        if len(ai_response) > MAX_MESSAGE_LENGTH:
+            ai_response = ai_response[:MAX_MESSAGE_LENGTH] + "\n\n...(обрезано)"
+        
+        return ai_response
+    
+    def _build_context(self, message: str, history: list, user_plan: str, summary: str = None,
+                       template: str = None) -> list:
+        """
+        Формирование contents для Gemini в пределах бюджета тарифа
+        
+        Правила бота и шаблон команды идут префиксом, но в бюджет
+        входят тоже - их токены всё равно оплачиваются. Тариф - отдельной
+        частью перед самим сообщением.
+        """
+        budget = CONTEXT_TOKEN_BUDGET.get(user_plan, CONTEXT_TOKEN_BUDGET["free"])
+        plan_note = PLAN_NOTE.format(plan=user_plan)
+        system_tokens = estimate_tokens(self.system_prompt) + estimate_tokens(plan_note)
+        if template:
+            system_tokens += estimate_tokens(template)
+        context = build_contents(history, message, budget - system_tokens, summary)
+        context.contents[-1]["parts"].insert(-1, plan_note)
+        
+        logger.info(f"📏 Контекст: ~{system_tokens + context.tokens}/{budget} токенов, "
+                    f"истории: {context.history_used} сообщ.")
+        return context.contents
+    
+    async def summarize(self, previous: str, turns: list):
+        """
+        Свернуть старые сообщения в краткую память о пользователе
+        
+        Args:
+            previous: прошлая сводка (или None)
+            turns: [(role, content), ...] от старых к новым
+        
+        Returns:
+            str | None: новая сводка или None при ошибке
+        """
+        lines = []
+        if previous:
+            lines += ["Текущая сводка:", previous, ""]
+        lines.append("Новые сообщения:")
+        for role, content in turns:
+            lines.append(f"{'Пользователь' if role == 'user' else 'Бот'}: {content}")
+        
+        contents = [{"role": "user", "parts": ["\n".join(lines)]}]
+        try:
+            # Фоновая задача - в очереди после всех пользователей
+            if self.admission:
+                await self.admission.acquire(None, self._count_tokens(self.summary_instruction, contents))
+            response = await self._call(self.summary_instruction, contents)
+            summary = response.text.strip() if response and response.text else None
+        except Exception as e:
+            logger.error(f"❌ Не удалось обновить сводку: {e}")
+            return None
+        
+        return summary[:SUMMARY_MAX_CHARS] if summary else None
+    
+    async def test_connection(self) -> bool:
         """Тест подключения"""
         try:
-            response = self.model.generate_content(
-                "Скажи привет",
-                request_options={'timeout': 10}
+            response = await self.backend.generate(
+                self.system_prompt,
+                [{"role": "user", "parts": ["Скажи привет"]}],
+                timeout=10
             )
             return response and response.text is not None
         except Exception as e:
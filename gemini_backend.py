@@ -0,0 +1,332 @@
+# gemini_backend.py - бэкенды генерации и кэш статического префикса промпта
+import asyncio
+import datetime
+import hashlib
+import json
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import Optional
+import google.generativeai as genai
+from google.api_core.exceptions import NotFound
+from config import (GEMINI_API_KEY, PREFIX_CACHE_TTL, PREFIX_CACHE_REFRESH_MARGIN,
+                    PREFIX_CACHE_MIN_TOKENS, PREFIX_CACHE_RETRY_AFTER)
+from utils.context_builder import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+
+class PrefixEvicted(Exception):
+    """Закэшированный префикс удалён на стороне API (истёк или вытеснен)"""
+
+
+@dataclass
+class PrefixHandle:
+    """Ссылка на закэшированный префикс (system_instruction + статичные contents)"""
+    name: str
+    expires_at: float  # time.time()
+    tokens: int
+
+
+def _contents_tokens(contents: list) -> int:
+    return sum(estimate_tokens(part) for item in contents for part in item["parts"])
+
+
+# ===========================================
+# НАСТОЯЩИЙ GEMINI
+# ===========================================
+
+class GenaiBackend:
+    """Генерация через google.generativeai (модели создаются один раз)"""
+    
+    def __init__(self, model_name: str, generation_config: dict):
+        genai.configure(api_key=GEMINI_API_KEY)
+        self.model_name = model_name
+        self.generation_config = generation_config
+        self._models = {}         # system_instruction -> GenerativeModel
+        self._cached_models = {}  # имя префикса -> GenerativeModel поверх него
+    
+    def model(self, system_instruction: str):
+        """Модель с системными правилами (создаётся один раз)"""
+        model = self._models.get(system_instruction)
+        if model is None:
+            model = genai.GenerativeModel(
+                self.model_name,
+                generation_config=self.generation_config,
+                system_instruction=system_instruction
+            )
+            self._models[system_instruction] = model
+        return model
+    
+    async def generate(self, system_instruction: str, contents: list, stream: bool = False,
+                       prefix: PrefixHandle = None, timeout: float = 30):
+        """
+        Запрос к Gemini
+        
+        С prefix system_instruction и статичная часть уже лежат на стороне
+        API, в contents - только то, что идёт после них.
+        
+        Raises:
+            PrefixEvicted: префикс больше не существует
+        """
+        model = self._cached_models.get(prefix.name) if prefix else None
+        if prefix and model is None:
+            raise PrefixEvicted(prefix.name)
+        
+        try:
+            return await (model or self.model(system_instruction)).generate_content_async(
+                contents,
+                stream=stream,
+                request_options={'timeout': timeout}
+            )
+        except NotFound as e:
+            if prefix:
+                self._cached_models.pop(prefix.name, None)
+                raise PrefixEvicted(prefix.name) from e
+            raise
+    
+    async def create_prefix(self, system_instruction: str, contents: list, ttl: float) -> PrefixHandle:
+        """Закэшировать префикс на ttl секунд"""
+        cache = await asyncio.to_thread(
+            genai.caching.CachedContent.create,
+            model=self.model_name,
+            system_instruction=system_instruction,
+            contents=contents or None,
+            ttl=datetime.timedelta(seconds=ttl)
+        )
+        self._cached_models[cache.name] = genai.GenerativeModel.from_cached_content(
+            cached_content=cache,
+            generation_config=self.generation_config
+        )
+        tokens = cache.usage_metadata.total_token_count if cache.usage_metadata else 0
+        return PrefixHandle(cache.name, cache.expire_time.timestamp(), tokens)
+    
+    async def refresh_prefix(self, handle: PrefixHandle, ttl: float) -> PrefixHandle:
+        """Продлить префикс ещё на ttl секунд"""
+        try:
+            cache = await asyncio.to_thread(genai.caching.CachedContent.get, handle.name)
+            await asyncio.to_thread(cache.update, ttl=datetime.timedelta(seconds=ttl))
+        except NotFound as e:
+            self._cached_models.pop(handle.name, None)
+            raise PrefixEvicted(handle.name) from e
+        return PrefixHandle(handle.name, cache.expire_time.timestamp(), handle.tokens)
+    
+    async def delete_prefix(self, handle: PrefixHandle):
+        """Удалить префикс (хранение оплачивается, пока он жив)"""
+        self._cached_models.pop(handle.name, None)
+        cache = await asyncio.to_thread(genai.caching.CachedContent.get, handle.name)
+        await asyncio.to_thread(cache.delete)
+
+
+# ===========================================
+# ЛОКАЛЬНЫЙ БЭКЕНД ДЛЯ ПРОВЕРОК БЕЗ СЕТИ
+# ===========================================
+
+@dataclass
+class FakeResponse:
+    """Ответ/кусок потока с тем же интерфейсом, что у genai (.text)"""
+    text: str
+
+
+@dataclass
+class FakeBackend:
+    """
+    Имитация Gemini без сети
+    
+    Отвечает reply(contents) с задержкой latency, кэширует префиксы как
+    настоящий API (истекают по ttl, можно вытеснить через evict) и
+    считает, сколько входных токенов ушло мимо кэша и через него.
+    """
+    latency: float = 0.05
+    chunk_size: int = 40
+    reply: object = None
+    min_prefix_tokens: int = 0
+    calls: int = 0
+    input_tokens: int = 0
+    cached_tokens: int = 0
+    prefixes: dict = field(default_factory=dict)  # имя -> (expires_at, tokens)
+    
+    async def generate(self, system_instruction: str, contents: list, stream: bool = False,
+                       prefix: PrefixHandle = None, timeout: float = 30):
+        self.calls += 1
+        if prefix:
+            entry = self.prefixes.get(prefix.name)
+            if entry is None or entry[0] <= time.time():
+                self.prefixes.pop(prefix.name, None)
+                raise PrefixEvicted(prefix.name)
+            self.cached_tokens += entry[1]
+        else:
+            self.input_tokens += estimate_tokens(system_instruction)
+        self.input_tokens += _contents_tokens(contents)
+        
+        await asyncio.sleep(self._delay())
+        text = self.reply(contents) if self.reply else f"Ответ на: {contents[-1]['parts'][-1][:50]}"
+        if not stream:
+            return FakeResponse(text)
+        return self._stream(text)
+    
+    def _delay(self) -> float:
+        """Задержка ответа (в наследниках - случайная)"""
+        return self.latency
+    
+    async def _stream(self, text: str):
+        for start in range(0, len(text), self.chunk_size):
+            await asyncio.sleep(self.latency / 10)
+            yield FakeResponse(text[start:start + self.chunk_size])
+    
+    async def create_prefix(self, system_instruction: str, contents: list, ttl: float) -> PrefixHandle:
+        tokens = estimate_tokens(system_instruction) + _contents_tokens(contents)
+        if tokens < self.min_prefix_tokens:
+            raise ValueError(f"Префикс слишком короткий: {tokens} токенов")
+        
+        name = f"cachedContents/fake-{len(self.prefixes) + self.calls}-{time.monotonic_ns()}"
+        self.prefixes[name] = (time.time() + ttl, tokens)
+        return PrefixHandle(name, time.time() + ttl, tokens)
+    
+    async def refresh_prefix(self, handle: PrefixHandle, ttl: float) -> PrefixHandle:
+        if handle.name not in self.prefixes:
+            raise PrefixEvicted(handle.name)
+        self.prefixes[handle.name] = (time.time() + ttl, handle.tokens)
+        return PrefixHandle(handle.name, time.time() + ttl, handle.tokens)
+    
+    async def delete_prefix(self, handle: PrefixHandle):
+        self.prefixes.pop(handle.name, None)
+    
+    def evict(self, name: str = None):
+        """Вытеснить префикс (или все) - как будто его удалил API"""
+        if name:
+            self.prefixes.pop(name, None)
+        else:
+            self.prefixes.clear()
+
+
+# ===========================================
+# КЭШ ПРЕФИКСОВ
+# ===========================================
+
+class PrefixCache:
+    """
+    Переиспользование статичного начала промпта
+    
+    Каждый запрос начинается с одинаковых правил бота (и шаблона
+    футбольной команды). Такой префикс создаётся в API один раз,
+    продлевается в фоне, когда до истечения остаётся меньше
+    refresh_margin, и пересоздаётся, если API его вытеснил.
+    Короткие префиксы (меньше min_tokens) не кэшируются вовсе.
+    """
+    
+    def __init__(self, backend, ttl: float = PREFIX_CACHE_TTL,
+                 refresh_margin: float = PREFIX_CACHE_REFRESH_MARGIN,
+                 min_tokens: int = PREFIX_CACHE_MIN_TOKENS,
+                 retry_after: float = PREFIX_CACHE_RETRY_AFTER):
+        self.backend = backend
+        self.ttl = ttl
+        self.refresh_margin = refresh_margin
+        self.min_tokens = min_tokens
+        self.retry_after = retry_after
+        self._handles = {}   # ключ -> PrefixHandle
+        self._pending = {}   # ключ -> Future создания/продления
+        self._failed = {}    # ключ -> time.time(), до которого не пробуем снова
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.evictions = 0
+        self.skipped = 0
+        self._reported_short = False
+    
+    async def get(self, system_instruction: str, contents: list = None) -> Optional[PrefixHandle]:
+        """
+        Префикс для запроса
+        
+        Returns:
+            PrefixHandle | None: None - отправлять всё целиком
+        """
+        contents = contents or []
+        tokens = estimate_tokens(system_instruction) + _contents_tokens(contents)
+        if tokens < self.min_tokens:
+            self.skipped += 1
+            if not self._reported_short:
+                self._reported_short = True
+                logger.info(f"🧊 Префикс ~{tokens} токенов короче минимума {self.min_tokens} - "
+                            f"отправляем целиком, без кэша")
+            return None
+        
+        key = hashlib.sha1(
+            json.dumps([system_instruction, contents], ensure_ascii=False).encode("utf-8")
+        ).hexdigest()
+        now = time.time()
+        
+        if self._failed.get(key, 0) > now:
+            self.skipped += 1
+            return None
+        
+        handle = self._handles.get(key)
+        if handle and handle.expires_at > now:
+            self.hits += 1
+            # Скоро истечёт - продлеваем в фоне, а пока пользуемся текущим
+            if handle.expires_at - now <= self.refresh_margin:
+                self._update(key, handle, system_instruction, contents)
+            return handle
+        
+        self.misses += 1
+        # shield: отмена одного запроса не отменяет создание для остальных
+        return await asyncio.shield(self._update(key, None, system_instruction, contents))
+    
+    def evicted(self, handle: PrefixHandle):
+        """API сообщил, что префикса больше нет"""
+        self.evictions += 1
+        for key, current in list(self._handles.items()):
+            if current.name == handle.name:
+                del self._handles[key]
+    
+    async def close(self):
+        """Удалить все префиксы (при остановке бота)"""
+        handles, self._handles = list(self._handles.values()), {}
+        for handle in handles:
+            try:
+                await self.backend.delete_prefix(handle)
+            except Exception as e:
+                logger.warning(f"⚠️ Не удалось удалить префикс {handle.name}: {e}")
+    
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+    
+    def _update(self, key: str, handle: Optional[PrefixHandle], system_instruction: str, contents: list):
+        """Создать/продлить префикс (одна операция на ключ)"""
+        future = self._pending.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self._do_update(key, handle, system_instruction, contents))
+            self._pending[key] = future
+            future.add_done_callback(lambda _: self._pending.pop(key, None))
+        return future
+    
+    async def _do_update(self, key: str, handle: Optional[PrefixHandle], system_instruction: str,
+                         contents: list) -> Optional[PrefixHandle]:
+        try:
+            new_handle = None
+            if handle:
+                try:
+                    new_handle = await self.backend.refresh_prefix(handle, self.ttl)
+                    self.refreshes += 1
+                except PrefixEvicted:
+                    self.evictions += 1
+            
+            if new_handle is None:
+                new_handle = await self.backend.create_prefix(system_instruction, contents, self.ttl)
+                logger.info(f"🧊 Префикс закэширован: {new_handle.name} (~{new_handle.tokens} токенов)")
+        except Exception as e:
+            if handle:
+                # Старый префикс ещё жив - продлим при следующем запросе
+                logger.warning(f"⚠️ Не удалось продлить префикс {handle.name}: {e}")
+                return handle
+            
+            # Например, префикс короче минимума модели - не долбим API каждый запрос
+            logger.warning(f"⚠️ Префикс не закэширован, пробуем через {self.retry_after} сек: {e}")
+            self._failed[key] = time.time() + self.retry_after
+            self._handles.pop(key, None)
+            return None
+        
+        self._handles[key] = new_handle
+        return new_handle
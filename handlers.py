@@ -1,32 +1,89 @@
 # handlers.py - обработчики с PRO тарифом и футбольными командами
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import TelegramError
 from telegram.ext import ContextTypes
-from datetime import datetime
-from gemini_api import GeminiAPI
+from gemini_api import GeminiAPI, GenerationFailed
 from firebase_service import DatabaseService
-from utils.formatter import format_code, clean_response
-from utils.chunker import split_message
-from config import FREE_DAILY_LIMIT, PRO_DAILY_LIMIT, PREMIUM_PRICES, ADMIN_IDS
+from user_cache import UserCache
+from response_cache import ResponseCache, make_cache_key
+from utils.formatter import clean_response
+from utils.renderer import render_chunks
+from streaming import MessageStreamer
+from admission import TokenBucket
+from summarizer import ConversationSummarizer
+from metrics import QUOTA_REJECTIONS, REPLY_CHUNKS, watch_bot
+from config import (FREE_DAILY_LIMIT, PRO_DAILY_LIMIT, PREMIUM_PRICES, ADMIN_IDS, STREAM_RESPONSES,
+                    STREAM_EDIT_RATE, STREAM_EDIT_BURST, SUMMARY_ENABLED)
 import logging
+import time
 
 logger = logging.getLogger(__name__)
 
 
+class QueueNotice:
+    """Сообщение «ты в очереди» - одно на запрос, правится при сдвиге очереди"""
+    
+    def __init__(self, message):
+        self.origin = message
+        self.message = None
+    
+    async def show(self, position: int):
+        text = f"⏳ Сейчас много запросов, ты в очереди: {position}-й. Ответ скоро будет!"
+        try:
+            if self.message:
+                await self.message.edit_text(text)
+            else:
+                self.message = await self.origin.reply_text(text, disable_notification=True)
+        except TelegramError as e:
+            logger.warning(f"⚠️ Не удалось показать место в очереди: {e}")
+    
+    async def clear(self):
+        """Очередь пройдена - сообщение больше не нужно"""
+        if self.message:
+            try:
+                await self.message.delete()
+            except TelegramError:
+                pass
+            self.message = None
+
+
 class BotHandlers:
-    def __init__(self):
-        self.gemini = GeminiAPI()
-        self.db = DatabaseService()
+    def __init__(self, gemini: GeminiAPI = None, db: DatabaseService = None):
+        self.gemini = gemini or GeminiAPI()
+        self.db = db or DatabaseService()
+        self.users = UserCache(self.db)
+        self.response_cache = ResponseCache(self.db)
+        self.summaries = ConversationSummarizer(self.db, self.gemini)
+        # Правки потоковых ответов всех пользователей - в общем лимите Telegram
+        self.edit_limiter = TokenBucket(STREAM_EDIT_RATE * 60, capacity=STREAM_EDIT_BURST)
         logger.info("✅ Обработчики v2.0 с PRO тарифом")
     
+    async def startup(self, app):
+        """Запуск бота: фоновая запись кэша пользователей и истории"""
+        self.users.start()
+        self.db.writes.start()
+        watch_bot(app, self)
+        self.db.purge_expired_responses(time.time())
+    
+    async def shutdown(self, app):
+        """Остановка бота: дописываем кэш и историю, закрываем базу"""
+        await self.summaries.stop()
+        if self.gemini.admission:
+            await self.gemini.admission.stop()
+        if self.gemini.prefixes:
+            await self.gemini.prefixes.close()
+        await self.users.stop()
+        await self.db.writes.stop()
+        self.db.close()
+    
     async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Команда /start"""
         user_id = update.effective_user.id
         username = update.effective_user.username or "Unknown"
         
-        user = self.db.get_user(user_id)
+        user = self.users.get(user_id)
         if not user:
-            self.db.create_user(user_id, username)
-            user = self.db.get_user(user_id)
+            user = self.users.create(user_id, username)
         
         plan_info = self._get_plan_info(user)
         
@@ -58,50 +115,45 @@ class BotHandlers:
     
     def _get_plan_info(self, user):
         """Информация о тарифе с PRO"""
-        plan = user['plan']
+        plan = user.plan
         
         if plan == 'vip':
             return "💎 Тариф: VIP (Навсегда) | ∞ запросов ✨"
         
-        if plan == 'premium':
-            if user['premium_expires']:
-                expires = datetime.fromisoformat(user['premium_expires'])
-                days = (expires - datetime.now()).days
-                if days > 0:
-                    return f"⭐ Тариф: PREMIUM ({days} дней) | ∞ запросов"
+        days = self.users.days_left(user)
+        
+        if plan == 'premium' and days > 0:
+            return f"⭐ Тариф: PREMIUM ({days} дней) | ∞ запросов"
         
         # 🔥 PRO тариф
-        if plan == 'pro':
-            if user['premium_expires']:
-                expires = datetime.fromisoformat(user['premium_expires'])
-                days = (expires - datetime.now()).days
-                if days > 0:
-                    remaining = self.db.get_remaining_requests(user['user_id'])
-                    return f"🔥 Тариф: PRO ({days} дней) | {remaining}/{PRO_DAILY_LIMIT} запросов"
+        remaining = self.users.remaining(user.user_id)
+        if plan == 'pro' and days > 0:
+            return f"🔥 Тариф: PRO ({days} дней) | {remaining}/{PRO_DAILY_LIMIT} запросов"
         
         # FREE
-        remaining = self.db.get_remaining_requests(user['user_id'])
         return f"🆓 Тариф: FREE | {remaining}/{FREE_DAILY_LIMIT} запросов"
     
     async def handle_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработка сообщений с улучшенной обработкой ошибок"""
+        await self._process_request(update, update.message.text)
+    
+    async def _process_request(self, update: Update, message_text: str,
+                               command: str = None, command_args: str = None, template: str = None):
+        """
+        Запрос к Gemini: лимит, генерация, отправка, история
+        
+        Для футбольных команд (command) сначала смотрим кэш ответов:
+        попадание обходится без Gemini, но засчитывается в лимит и
+        сохраняется в историю.
+        template - статичный шаблон команды, message_text - только запрос.
+        """
         user_id = update.effective_user.id
-        message_text = update.message.text
         
-        user = self.db.get_user(user_id)
+        user = self.users.get(user_id)
         if not user:
             await update.message.reply_text("⚠️ Нажми /start")
             return
         
-        remaining = self.db.get_remaining_requests(user_id)
-        if remaining <= 0:
-            keyboard = [[InlineKeyboardButton("⭐ Купить Premium", callback_data="upgrade")]]
-            await update.message.reply_text(
-                "❌ Лимит исчерпан! /upgrade для безлимита",
-                reply_markup=InlineKeyboardMarkup(keyboard)
-            )
-            return
-        
         # Проверка длины сообщения
         if len(message_text) > 2000:
             await update.message.reply_text(
@@ -110,45 +162,43 @@ class BotHandlers:
             )
             return
         
-        await update.message.chat.send_action("typing")
+        # Резервируем запрос: проверка лимита и списание - одна операция
+        reservation = self.users.reserve(user_id)
+        if not reservation:
+            QUOTA_REJECTIONS.inc(user.plan)
+            keyboard = [[InlineKeyboardButton("⭐ Купить Premium", callback_data="upgrade")]]
+            await update.message.reply_text(
+                "❌ Лимит исчерпан! /upgrade для безлимита",
+                reply_markup=InlineKeyboardMarkup(keyboard)
+            )
+            return
         
         try:
-            history = self.db.get_conversation_history(user_id)
-            
-            # 🔥 Генерация ответа
-            user_plan = user['plan']
-            ai_response = self.gemini.generate_response(message_text, history, user_plan)
-            
-            # Проверка на ошибку
-            if not ai_response or "😔" in ai_response[:10]:
-                # Это сообщение об ошибке, отправляем как есть
-                await update.message.reply_text(ai_response)
-                return
-            
-            # Нормальный ответ - форматируем
-            ai_response = clean_response(ai_response)
-            formatted = format_code(ai_response)
-            chunks = split_message(formatted)
-            
-            for chunk in chunks:
-                try:
-                    await update.message.reply_text(
-                        chunk,
-                        parse_mode='Markdown',
-                        disable_web_page_preview=True
-                    )
-                except:
-                    # Если Markdown не работает
-                    await update.message.reply_text(chunk)
+            # ⚡ Готовый ответ из кэша - Gemini не нужен
+            cached = self.response_cache.get(command, command_args) if command else None
+            if cached:
+                ai_response = cached
+                await self._send_formatted(update, ai_response)
+            else:
+                ai_response = await self._generate(update, message_text, reservation, user.plan,
+                                                   command, command_args, template)
+                if ai_response is None:
+                    return
             
             # Сохраняем в историю только успешные ответы
             self.db.save_message(user_id, 'user', message_text)
             self.db.save_message(user_id, 'assistant', ai_response)
             
-            # Уменьшаем лимит
-            if user['plan'] in ['free', 'pro']:
-                self.db.use_request(user_id)
-                remaining = self.db.get_remaining_requests(user_id)
+            # Старая часть диалога сворачивается в сводку уже после ответа
+            if SUMMARY_ENABLED:
+                self.summaries.schedule(user_id)
+            
+            if command and not cached:
+                self.response_cache.put(command, command_args, ai_response)
+            
+            # Ответ доставлен - запрос засчитан окончательно
+            remaining = self.users.commit(reservation)
+            if reservation['counted']:
                 if remaining <= 3 and remaining > 0:
                     await update.message.reply_text(
                         f"⚠️ Осталось: {remaining} запросов",
@@ -157,6 +207,7 @@ class BotHandlers:
         
         except Exception as e:
             logger.error(f"❌ Критическая ошибка: {e}", exc_info=True)
+            self.users.refund(reservation)
             await update.message.reply_text(
                 "😔 Произошла ошибка. Попробуй:\n"
                 "1️⃣ /clear - очистить историю\n"
@@ -164,6 +215,76 @@ class BotHandlers:
                 "3️⃣ Подождать минуту"
             )
     
+    async def _generate(self, update: Update, message_text: str, reservation: dict, user_plan: str,
+                        command: str = None, command_args: str = None, template: str = None):
+        """
+        Сгенерировать ответ и показать его пользователю
+        
+        Returns:
+            str | None: очищенный ответ (None - генерация не удалась, ошибка
+                уже показана, резерв возвращён)
+        """
+        user_id = update.effective_user.id
+        await update.message.chat.send_action("typing")
+        
+        # Ответ на команду не зависит от диалога - так его можно кэшировать
+        history = None if command else self.db.get_conversation_history(user_id)
+        summary = self.summaries.get(user_id) if SUMMARY_ENABLED and not command else None
+        
+        # Одинаковые команды разных пользователей - одна генерация
+        coalesce_key = make_cache_key(command, command_args) if command else None
+        
+        # Если упрёмся в квоту API - покажем место в очереди
+        notice = QueueNotice(update.message)
+        
+        if STREAM_RESPONSES:
+            # Показываем ответ по мере генерации
+            streamer = MessageStreamer(update.message, limiter=self.edit_limiter)
+            stream = self.gemini.stream_response(message_text, history, user_plan, coalesce_key, summary,
+                                                 template, notice.show)
+            try:
+                async for delta in stream:
+                    await notice.clear()
+                    await streamer.push(delta)
+            except GenerationFailed as e:
+                # Ответа нет или он оборвался - показываем ошибку (после уже
+                # показанной части), запрос не засчитываем
+                await notice.clear()
+                await streamer.push(e.reply)
+                await streamer.finish()
+                self.users.refund(reservation)
+                return None
+            ai_response = await streamer.finish()
+            REPLY_CHUNKS.observe(len(streamer.messages))
+            return clean_response(ai_response)
+        
+        try:
+            ai_response = await self.gemini.generate_response(message_text, history, user_plan,
+                                                              coalesce_key, summary, template, notice.show)
+        except GenerationFailed as e:
+            # Ответа нет - показываем ошибку так же, как в потоке, запрос не засчитываем
+            await notice.clear()
+            self.users.refund(reservation)
+            await self._send_formatted(update, e.reply)
+            return None
+        await notice.clear()
+        
+        # Нормальный ответ - форматируем
+        ai_response = clean_response(ai_response)
+        await self._send_formatted(update, ai_response)
+        return ai_response
+    
+    async def _send_formatted(self, update: Update, text: str):
+        """Отправить ответ частями: разметка уже разобрана в сущности, повторная отправка не нужна"""
+        chunks = render_chunks(text)
+        REPLY_CHUNKS.observe(len(chunks))
+        for chunk in chunks:
+            await update.message.reply_text(
+                chunk.text,
+                entities=chunk.entities,
+                disable_web_page_preview=True
+            )
+    
     # ⚽ ФУТБОЛЬНЫЕ КОМАНДЫ
     
     async def player_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -173,7 +294,8 @@ class BotHandlers:
             return
         
         player_name = " ".join(context.args)
-        prompt = f"""⚽ Расскажи о футболисте {player_name}:
+        # Шаблон одинаковый для всех - он кэшируется вместе с правилами бота
+        template = """⚽ Расскажи о футболисте из запроса:
 
 📊 Основная информация:
 - Полное имя и возраст
@@ -191,8 +313,8 @@ class BotHandlers:
 
 ⚠️ Если данные могут быть неточными - уточни это!"""
         
-        update.message.text = prompt
-        await self.handle_message(update, context)
+        await self._process_request(update, f"Футболист: {player_name}", command="player",
+                                    command_args=player_name, template=template)
     
     async def club_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Команда /club - информация о клубе"""
@@ -201,7 +323,7 @@ class BotHandlers:
             return
         
         club_name = " ".join(context.args)
-        prompt = f"""⚽ Расскажи о клубе {club_name}:
+        template = """⚽ Расскажи о клубе из запроса:
 
 🏟️ Основная информация:
 - Страна и лига
@@ -219,8 +341,8 @@ class BotHandlers:
 
 ⚠️ Используй последние известные данные, если что-то могло измениться - уточни!"""
         
-        update.message.text = prompt
-        await self.handle_message(update, context)
+        await self._process_request(update, f"Клуб: {club_name}", command="club",
+                                    command_args=club_name, template=template)
     
     async def compare_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Команда /compare - сравнение игроков"""
@@ -236,9 +358,7 @@ class BotHandlers:
             return
         
         p1, p2 = players[0].strip(), players[1].strip()
-        prompt = f"""⚽ СРАВНИ футболистов:
-
-🔵 {p1.upper()}  VS  🔴 {p2.upper()}
+        template = """⚽ СРАВНИ футболистов из запроса (🔵 первый VS 🔴 второй):
 
 📊 Сравнение по параметрам:
 
@@ -261,8 +381,8 @@ class BotHandlers:
 
 ⚠️ Используй известные данные, если что-то неточно - укажи!"""
         
-        update.message.text = prompt
-        await self.handle_message(update, context)
+        await self._process_request(update, f"🔵 {p1.upper()}  VS  🔴 {p2.upper()}", command="compare",
+                                    command_args=text, template=template)
     
     async def match_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Команда /match - информация о матче"""
@@ -271,7 +391,7 @@ class BotHandlers:
             return
         
         text = " ".join(context.args)
-        prompt = f"""⚽ Расскажи о матче {text}:
+        template = """⚽ Расскажи о матче из запроса:
 
 📊 История противостояния:
 - Статистика личных встреч (примерная)
@@ -289,8 +409,8 @@ class BotHandlers:
 
 ⚠️ Используй известные данные!"""
         
-        update.message.text = prompt
-        await self.handle_message(update, context)
+        await self._process_request(update, f"Матч: {text}", command="match",
+                                    command_args=text, template=template)
     
     async def prediction_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Команда /predict - прогноз на матч"""
@@ -299,7 +419,7 @@ class BotHandlers:
             return
         
         match = " ".join(context.args)
-        prompt = f"""⚽ Дай прогноз на матч {match}:
+        template = """⚽ Дай прогноз на матч из запроса:
 
 📊 Анализ команд:
 - Общий уровень команд
@@ -319,8 +439,8 @@ class BotHandlers:
 ⚠️ Это развлекательный прогноз на основе общих знаний!
 Для точных данных проверяй свежую статистику перед матчем!"""
         
-        update.message.text = prompt
-        await self.handle_message(update, context)
+        await self._process_request(update, f"Матч: {match}", command="predict",
+                                    command_args=match, template=template)
     
     # ОСТАЛЬНЫЕ КОМАНДЫ
     
@@ -333,6 +453,8 @@ class BotHandlers:
             return
         
         promo_code = context.args[0].upper()
+        # Сначала дописываем кэш: промокод меняет тариф прямо в базе
+        self.users.invalidate(user_id)
         result = self.db.activate_promocode(user_id, promo_code)
         
         if result['success']:
@@ -390,27 +512,28 @@ class BotHandlers:
     async def stats(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Статистика"""
         user_id = update.effective_user.id
-        user = self.db.get_user(user_id)
+        user = self.users.get(user_id)
         
         if not user:
             await update.message.reply_text("⚠️ /start")
             return
         
         stats = self.db.get_user_stats(user_id)
-        remaining = self.db.get_remaining_requests(user_id)
+        remaining = self.users.remaining(user_id)
         
         text = f"""📊 Статистика
 
 👤 ID: {user_id}
-📝 Тариф: {user['plan'].upper()}
+📝 Тариф: {user.plan.upper()}
 💬 Сообщений: {stats['total_messages']}
-📊 Осталось: {remaining if user['plan'] in ['free', 'pro'] else '∞'}"""
+📊 Осталось: {remaining if self.users.daily_limit(user) is not None else '∞'}"""
         
         await update.message.reply_text(text)
     
     async def clear_history(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Очистка истории"""
         user_id = update.effective_user.id
+        self.summaries.forget(user_id)
         self.db.clear_history(user_id)
         await update.message.reply_text("🗑️ История очищена!")
     
@@ -442,18 +565,18 @@ class BotHandlers:
         
         elif query.data == "stats":
             user_id = query.from_user.id
-            user = self.db.get_user(user_id)
+            user = self.users.get(user_id)
             
             if user:
                 stats = self.db.get_user_stats(user_id)
-                remaining = self.db.get_remaining_requests(user_id)
+                remaining = self.users.remaining(user_id)
                 
                 text = f"""📊 Статистика
 
 👤 ID: {user_id}
-📝 Тариф: {user['plan'].upper()}
+📝 Тариф: {user.plan.upper()}
 💬 Сообщений: {stats['total_messages']}
-📊 Осталось: {remaining if user['plan'] in ['free', 'pro'] else '∞'}"""
+📊 Осталось: {remaining if self.users.daily_limit(user) is not None else '∞'}"""
                 
                 await query.message.reply_text(text)
         
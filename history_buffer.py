@@ -0,0 +1,45 @@
+# history_buffer.py - последние сообщения пользователей в памяти
+from collections import OrderedDict, deque
+from typing import Optional
+from config import MAX_HISTORY, HISTORY_CACHE_USERS
+
+
+class HistoryBuffer:
+    """
+    Кольцевой буфер истории для каждого пользователя
+    
+    На пользователя хранится не больше max_turns последних сообщений,
+    самих пользователей - не больше max_users (давно молчавшие
+    вытесняются). Буфер заполняется из базы при первом обращении.
+    """
+    
+    def __init__(self, max_turns: int = MAX_HISTORY, max_users: int = HISTORY_CACHE_USERS):
+        self.max_turns = max_turns
+        self.max_users = max_users
+        self._users = OrderedDict()  # user_id -> deque[(role, content)]
+    
+    def get(self, user_id: int, limit: int) -> Optional[list]:
+        """Последние limit сообщений или None, если пользователя нет в памяти"""
+        turns = self._users.get(user_id)
+        if turns is None or limit > self.max_turns:
+            return None
+        
+        self._users.move_to_end(user_id)
+        return list(turns)[-limit:] if limit else []
+    
+    def fill(self, user_id: int, messages: list):
+        """Загрузить историю из базы (от старых к новым)"""
+        self._users[user_id] = deque(messages, maxlen=self.max_turns)
+        self._users.move_to_end(user_id)
+        if len(self._users) > self.max_users:
+            self._users.popitem(last=False)
+    
+    def append(self, user_id: int, role: str, content: str):
+        """Добавить сообщение (если пользователь уже в памяти)"""
+        turns = self._users.get(user_id)
+        if turns is not None:
+            turns.append((role, content))
+    
+    def drop(self, user_id: int):
+        """Забыть историю пользователя"""
+        self._users.pop(user_id, None)
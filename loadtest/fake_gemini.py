@@ -0,0 +1,103 @@
+# loadtest/fake_gemini.py - фейковый Gemini со случайной задержкой и ошибками
+import asyncio
+import random
+import time
+from dataclasses import dataclass, field
+from google.api_core.exceptions import (ResourceExhausted, DeadlineExceeded, InternalServerError,
+                                        ServiceUnavailable)
+from gemini_backend import FakeBackend
+
+# Ошибки, которые умеет имитировать ChaosBackend (те же типы, что бросает API)
+ERRORS = {
+    "429": lambda: ResourceExhausted("Resource has been exhausted (e.g. check quota)."),
+    "500": lambda: InternalServerError("An internal error has occurred."),
+    "503": lambda: ServiceUnavailable("The model is overloaded. Please try again later."),
+    "timeout": lambda: DeadlineExceeded("Deadline Exceeded"),
+    # Поток обрывается после первого куска (без потока - обычная 503)
+    "midstream": lambda: ServiceUnavailable("The model is overloaded. Please try again later."),
+}
+
+# Кирпичики ответа: обычный текст, эмодзи, код
+SENTENCES = [
+    "Го разберём! 🔥",
+    "Месси провёл за Барселону 778 матчей и забил 672 гола.",
+    "Это один из самых титулованных клубов Европы 🏆",
+    "Если данные могут быть неточными — лучше проверь свежую статистику.",
+    "Окей бро, щас помогу! 💪",
+    "Вот держи пример:\n```python\ndef goals(stats):\n    return sum(s['goals'] for s in stats)\n```",
+    "Главное — стабильность формы и здоровье игроков ⚽",
+]
+
+
+@dataclass
+class ChaosBackend(FakeBackend):
+    """
+    FakeBackend с реалистичным поведением
+    
+    Задержка - логнормальная с медианой latency и разбросом latency_sigma,
+    ошибки выпадают с вероятностями из errors ({"429": 0.01, ...}).
+    Время каждого успешного вызова (до последнего куска) - в latencies.
+    """
+    latency: float = 0.8
+    latency_sigma: float = 0.5
+    errors: dict = field(default_factory=dict)
+    reply_chars: int = 1200
+    seed: int = None
+    latencies: list = field(default_factory=list)
+    failures: dict = field(default_factory=dict)
+    
+    def __post_init__(self):
+        self._random = random.Random(self.seed)
+        if self.reply is None:
+            self.reply = self._make_reply
+    
+    async def generate(self, system_instruction: str, contents: list, stream: bool = False,
+                       prefix=None, timeout: float = 30):
+        kind = self._pick_error()
+        if kind == "midstream" and stream:
+            response = await super().generate(system_instruction, contents, stream, prefix, timeout)
+            return self._broken(response, kind)
+        if kind:
+            # Ошибка приходит не мгновенно
+            await asyncio.sleep(self._delay() / 2)
+            self.failures[kind] = self.failures.get(kind, 0) + 1
+            raise ERRORS[kind]()
+        
+        started = time.perf_counter()
+        response = await super().generate(system_instruction, contents, stream, prefix, timeout)
+        if not stream:
+            self.latencies.append(time.perf_counter() - started)
+            return response
+        return self._timed(response, started)
+    
+    async def _timed(self, chunks, started: float):
+        async for chunk in chunks:
+            yield chunk
+        self.latencies.append(time.perf_counter() - started)
+    
+    async def _broken(self, chunks, kind: str):
+        async for chunk in chunks:
+            yield chunk
+            break
+        self.failures[kind] = self.failures.get(kind, 0) + 1
+        raise ERRORS[kind]()
+    
+    def _delay(self) -> float:
+        return self._random.lognormvariate(0, self.latency_sigma) * self.latency
+    
+    def _pick_error(self):
+        roll = self._random.random()
+        for kind, probability in self.errors.items():
+            if roll < probability:
+                return kind
+            roll -= probability
+        return None
+    
+    def _make_reply(self, contents: list) -> str:
+        parts = []
+        size = 0
+        while size < self.reply_chars:
+            sentence = self._random.choice(SENTENCES)
+            parts.append(sentence)
+            size += len(sentence) + 1
+        return " ".join(parts)
@@ -0,0 +1,245 @@
+# loadtest/fake_telegram.py - локальная замена Telegram Bot API для нагрузочного теста
+import asyncio
+import json
+import logging
+import time
+from urllib.parse import parse_qsl, urlsplit
+
+logger = logging.getLogger(__name__)
+
+# Параметры, которые PTB передаёт как JSON-строку (остальные - как есть)
+JSON_PARAMS = {"reply_markup", "entities", "allowed_updates", "link_preview_options", "reply_parameters"}
+
+BOT_USER = {"id": 100000, "is_bot": True, "first_name": "LoadTestBot", "username": "loadtest_bot"}
+
+
+class FakeTelegramServer:
+    """
+    Минимальный HTTP-сервер с методами Bot API
+    
+    Бот подключается к нему через base_url. Апдейты кладёт драйвер
+    (push_message), бот забирает их через getUpdates (long polling)
+    или, после setWebhook, получает POST-ом на свой url - с секретом
+    в заголовке и не больше max_connections запросов одновременно.
+    Всё, что бот отправляет/правит, записывается и передаётся в
+    on_reply(chat_id, method, params, ts).
+    """
+    
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, on_reply=None):
+        self.host = host
+        self.port = port
+        self.on_reply = on_reply
+        self.calls = {}          # метод -> сколько раз вызван
+        self.delivered = {}      # update_id -> когда отдан боту
+        self._updates = []
+        self._has_updates = asyncio.Event()
+        self._next_update_id = 1
+        self._next_message_id = 1
+        self._server = None
+        self.webhook = None          # параметры setWebhook
+        self.webhook_errors = 0
+        self._webhook_slots = None
+        self._deliveries = set()
+    
+    @property
+    def base_url(self) -> str:
+        """base_url для Application.builder()"""
+        return f"http://{self.host}:{self.port}/bot"
+    
+    async def start(self):
+        self._server = await asyncio.start_server(self._serve, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        logger.info(f"🧪 Фейковый Telegram: {self.base_url}")
+    
+    async def stop(self):
+        for task in list(self._deliveries):
+            task.cancel()
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+    
+    # ========================================
+    # АПДЕЙТЫ ОТ "ПОЛЬЗОВАТЕЛЕЙ"
+    # ========================================
+    
+    def push_message(self, user_id: int, text: str) -> int:
+        """
+        Сообщение пользователя боту
+        
+        Returns:
+            int: update_id
+        """
+        update_id = self._next_update_id
+        self._next_update_id += 1
+        
+        message = {
+            "message_id": self._new_message_id(),
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"User{user_id}",
+                     "username": f"user{user_id}"},
+            "text": text,
+        }
+        if text.startswith("/"):
+            command = text.split()[0]
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(command)}]
+        
+        update = {"update_id": update_id, "message": message}
+        if self.webhook:
+            task = asyncio.ensure_future(self._deliver(update))
+            self._deliveries.add(task)
+            task.add_done_callback(self._deliveries.discard)
+        else:
+            self._updates.append(update)
+            self._has_updates.set()
+        return update_id
+    
+    async def _deliver(self, update: dict):
+        """POST апдейта на webhook бота, как это делает Telegram"""
+        async with self._webhook_slots:
+            self.delivered.setdefault(update["update_id"], time.perf_counter())
+            url = urlsplit(self.webhook["url"])
+            body = json.dumps(update, ensure_ascii=False).encode("utf-8")
+            headers = [
+                f"POST {url.path or '/'} HTTP/1.1",
+                f"Host: {url.netloc}",
+                "Content-Type: application/json",
+                f"Content-Length: {len(body)}",
+                "Connection: close",
+            ]
+            if self.webhook.get("secret_token"):
+                headers.append(f"X-Telegram-Bot-Api-Secret-Token: {self.webhook['secret_token']}")
+            
+            try:
+                reader, writer = await asyncio.open_connection(url.hostname, url.port or 80)
+                writer.write(("\r\n".join(headers) + "\r\n\r\n").encode("latin-1") + body)
+                await writer.drain()
+                status = await reader.readline()
+                writer.close()
+            except OSError as e:
+                logger.warning(f"⚠️ Webhook недоступен: {e}")
+                self.webhook_errors += 1
+                return
+            
+            if b" 200 " not in status:
+                logger.warning(f"⚠️ Webhook ответил {status.decode('latin-1').strip()}")
+                self.webhook_errors += 1
+    
+    # ========================================
+    # HTTP
+    # ========================================
+    
+    async def _serve(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                
+                _, path, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                method = path.rsplit("/", 1)[-1]
+                result = await self._call(method, self._params(body, headers.get("content-type", "")))
+                
+                payload = json.dumps(result, ensure_ascii=False).encode("utf-8")
+                writer.write(
+                    b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+                    b"Content-Length: %d\r\n\r\n" % len(payload) + payload
+                )
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            # Бот отключился или сервер останавливается посреди long polling
+            pass
+        finally:
+            writer.close()
+    
+    @staticmethod
+    def _params(body: bytes, content_type: str) -> dict:
+        """Параметры запроса: JSON или form-urlencoded"""
+        if not body:
+            return {}
+        if content_type.startswith("application/json"):
+            return json.loads(body)
+        
+        params = {}
+        for name, value in parse_qsl(body.decode("utf-8"), keep_blank_values=True):
+            params[name] = json.loads(value) if name in JSON_PARAMS else value
+        return params
+    
+    # ========================================
+    # МЕТОДЫ BOT API
+    # ========================================
+    
+    async def _call(self, method: str, params: dict) -> dict:
+        self.calls[method] = self.calls.get(method, 0) + 1
+        
+        if method == "getMe":
+            return {"ok": True, "result": BOT_USER}
+        if method == "getUpdates":
+            return {"ok": True, "result": await self._get_updates(params)}
+        if method in ("sendMessage", "editMessageText"):
+            return {"ok": True, "result": self._reply(method, params)}
+        if method == "setWebhook":
+            self.webhook = params
+            self._webhook_slots = asyncio.Semaphore(int(params.get("max_connections") or 40))
+            return {"ok": True, "result": True}
+        if method == "deleteWebhook":
+            self.webhook = None
+            return {"ok": True, "result": True}
+        if method in ("sendChatAction", "answerCallbackQuery", "deleteMessage", "setMyCommands",
+                      "close", "logOut"):
+            return {"ok": True, "result": True}
+        
+        logger.warning(f"⚠️ Фейковый Telegram: неизвестный метод {method}")
+        return {"ok": False, "error_code": 404, "description": "Not Found"}
+    
+    async def _get_updates(self, params: dict) -> list:
+        offset = int(params.get("offset") or 0)
+        limit = int(params.get("limit") or 100)
+        timeout = float(params.get("timeout") or 0)
+        
+        # Подтверждённые апдейты больше не отдаём
+        self._updates = [u for u in self._updates if u["update_id"] >= offset]
+        if not self._updates and timeout:
+            self._has_updates.clear()
+            try:
+                await asyncio.wait_for(self._has_updates.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        
+        batch = self._updates[:limit]
+        now = time.perf_counter()
+        for update in batch:
+            self.delivered.setdefault(update["update_id"], now)
+        return batch
+    
+    def _reply(self, method: str, params: dict) -> dict:
+        chat_id = int(params["chat_id"])
+        message_id = int(params["message_id"]) if method == "editMessageText" else self._new_message_id()
+        
+        if self.on_reply:
+            self.on_reply(chat_id, method, params, time.perf_counter())
+        
+        message = {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": BOT_USER,
+            "text": params.get("text", ""),
+        }
+        if method == "editMessageText":
+            message["edit_date"] = int(time.time())
+        return message
+    
+    def _new_message_id(self) -> int:
+        message_id = self._next_message_id
+        self._next_message_id += 1
+        return message_id
@@ -0,0 +1,290 @@
+# loadtest/run.py - нагрузочный тест бота целиком (фейковые Telegram и Gemini)
+#
+#   python -m loadtest.run --users 50 --duration 60
+#   python -m loadtest.run --users 200 --latency 1.5 --errors 429=0.02,timeout=0.01 --json baseline.json
+#   python -m loadtest.run --users 50 --mode webhook
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import tempfile
+import time
+from telegram.ext import Application
+from admission import AdmissionController
+from bot import build_application, allowed_updates
+from firebase_service import DatabaseService
+from gemini_api import GeminiAPI
+from gemini_backend import PrefixCache
+from handlers import BotHandlers
+from loadtest.fake_gemini import ChaosBackend
+from loadtest.fake_telegram import FakeTelegramServer
+
+logger = logging.getLogger(__name__)
+
+TOKEN = "123456:LOADTEST"
+PROMO_CODE = "LOADTEST"
+WEBHOOK_SECRET = "loadtest-secret"
+
+# Что пишут пользователи: тип сообщения -> доля
+MIX = {
+    "text": 0.6,
+    "player": 0.2,
+    "compare": 0.1,
+    "promo": 0.1,
+}
+PLAYERS = ["Месси", "Роналду", "Холанд", "Мбаппе", "Салах", "Винисиус", "Беллингем", "Кейн"]
+QUESTIONS = [
+    "Привет! Как дела?",
+    "Кто выиграл ЛЧ в 2022?",
+    "Напиши функцию на python для подсчёта голов",
+    "Какая тактика лучше против высокого прессинга?",
+    "Расскажи анекдот про футбол 😄",
+]
+
+
+def percentile(values: list, p: float) -> float:
+    """Перцентиль методом ближайшего ранга"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(p / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+class Recorder:
+    """Время каждого апдейта по этапам"""
+    
+    def __init__(self):
+        self.enqueued = {}       # update_id -> ts
+        self.dispatched = {}     # update_id -> ts (начало обработки ботом)
+        self.finished = {}       # update_id -> ts (обработка завершена)
+        self.first_reply = {}    # update_id -> ts первого ответа в чат
+        self._pending = {}       # chat_id -> update_id, ждущий ответа
+        self._waiters = {}       # update_id -> Future
+        self.errors = 0
+    
+    def enqueue(self, chat_id: int, update_id: int):
+        self.enqueued[update_id] = time.perf_counter()
+        self._pending[chat_id] = update_id
+        self._waiters[update_id] = asyncio.get_running_loop().create_future()
+    
+    def on_reply(self, chat_id: int, method: str, params: dict, ts: float):
+        update_id = self._pending.get(chat_id)
+        if update_id is None:
+            return
+        if method == "sendMessage":
+            self.first_reply.setdefault(update_id, ts)
+            if str(params.get("text", "")).startswith("😔"):
+                self.errors += 1
+    
+    def on_start(self, update_id: int):
+        self.dispatched[update_id] = time.perf_counter()
+    
+    def on_finish(self, update_id: int):
+        self.finished[update_id] = time.perf_counter()
+        waiter = self._waiters.pop(update_id, None)
+        if waiter and not waiter.done():
+            waiter.set_result(None)
+    
+    async def wait(self, update_id: int, timeout: float):
+        await asyncio.wait_for(self._waiters[update_id], timeout)
+
+
+class InstrumentedApplication(Application):
+    """Application, который сообщает о начале и конце обработки каждого апдейта"""
+    
+    def __init__(self, *args, recorder: Recorder, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.recorder = recorder
+    
+    async def process_update(self, update):
+        self.recorder.on_start(update.update_id)
+        try:
+            await super().process_update(update)
+        finally:
+            self.recorder.on_finish(update.update_id)
+
+
+async def simulate_user(user_id: int, server: FakeTelegramServer, recorder: Recorder,
+                        deadline: float, think: float, rng: random.Random):
+    """Один пользователь: /start, промокод, дальше - сообщения по MIX до deadline"""
+    async def send(text: str):
+        update_id = server.push_message(user_id, text)
+        recorder.enqueue(user_id, update_id)
+        try:
+            await recorder.wait(update_id, timeout=120)
+        except asyncio.TimeoutError:
+            logger.warning(f"⏱️ Апдейт {update_id} не обработан за 120 сек")
+    
+    await send("/start")
+    await send(f"/promo {PROMO_CODE}")
+    
+    kinds, weights = list(MIX), list(MIX.values())
+    while time.perf_counter() < deadline:
+        kind = rng.choices(kinds, weights)[0]
+        if kind == "player":
+            await send(f"/player {rng.choice(PLAYERS)}")
+        elif kind == "compare":
+            first, second = rng.sample(PLAYERS, 2)
+            await send(f"/compare {first} vs {second}")
+        elif kind == "promo":
+            await send(f"/promo WRONG{rng.randint(1, 999)}")
+        else:
+            await send(rng.choice(QUESTIONS))
+        
+        await asyncio.sleep(rng.expovariate(1 / think) if think else 0)
+
+
+def build_report(args, recorder: Recorder, server: FakeTelegramServer, backend: ChaosBackend,
+                 prefixes: PrefixCache, elapsed: float) -> dict:
+    stages = {"queue": [], "dispatch": [], "first_reply": [], "total": []}
+    for update_id, enqueued in recorder.enqueued.items():
+        delivered = server.delivered.get(update_id)
+        started = recorder.dispatched.get(update_id)
+        finished = recorder.finished.get(update_id)
+        if delivered:
+            stages["queue"].append(delivered - enqueued)
+        if delivered and started:
+            stages["dispatch"].append(started - delivered)
+        if update_id in recorder.first_reply:
+            stages["first_reply"].append(recorder.first_reply[update_id] - enqueued)
+        if finished:
+            stages["total"].append(finished - enqueued)
+    stages["gemini"] = backend.latencies
+    
+    prefix_cache = None
+    if prefixes:
+        prefix_cache = {"hits": prefixes.hits, "misses": prefixes.misses,
+                        "hit_rate": round(prefixes.hit_rate, 3)}
+    
+    completed = len(recorder.finished)
+    return {
+        "users": args.users,
+        "mode": args.mode,
+        "duration": round(elapsed, 2),
+        "completed": completed,
+        "throughput": round(completed / elapsed, 2) if elapsed else 0,
+        "error_replies": recorder.errors,
+        "gemini_failures": backend.failures,
+        "telegram_calls": server.calls,
+        "prefix_cache": prefix_cache,
+        "stages": {
+            name: {
+                "n": len(values),
+                "p50": round(percentile(values, 50) * 1000, 1),
+                "p95": round(percentile(values, 95) * 1000, 1),
+                "p99": round(percentile(values, 99) * 1000, 1),
+            }
+            for name, values in stages.items()
+        },
+    }
+
+
+def print_report(report: dict):
+    print(f"\n📊 Нагрузочный тест ({report['mode']}): {report['users']} польз., {report['duration']} сек")
+    print(f"✅ Обработано: {report['completed']} апдейтов ({report['throughput']}/сек)")
+    print(f"😔 Ответов с ошибкой: {report['error_replies']}, сбоев Gemini: {report['gemini_failures']}")
+    print(f"📨 Вызовы Telegram: {report['telegram_calls']}")
+    cache = report["prefix_cache"]
+    if cache:
+        print(f"🧩 Кэш префикса: hit rate {cache['hit_rate']:.0%} "
+              f"({cache['hits']} попаданий, {cache['misses']} промахов)\n")
+    else:
+        print("🧩 Кэш префикса: выключен\n")
+    print(f"{'Этап':<12} {'n':>7} {'p50, мс':>10} {'p95, мс':>10} {'p99, мс':>10}")
+    for name, stage in report["stages"].items():
+        print(f"{name:<12} {stage['n']:>7} {stage['p50']:>10} {stage['p95']:>10} {stage['p99']:>10}")
+
+
+async def run(args) -> dict:
+    recorder = Recorder()
+    server = FakeTelegramServer(on_reply=recorder.on_reply)
+    await server.start()
+    
+    errors = {}
+    for item in filter(None, args.errors.split(",")):
+        kind, _, probability = item.partition("=")
+        errors[kind] = float(probability)
+    backend = ChaosBackend(latency=args.latency, latency_sigma=args.sigma, errors=errors,
+                           reply_chars=args.reply_chars, seed=args.seed)
+    
+    db_dir = tempfile.mkdtemp(prefix="loadtest-")
+    db = DatabaseService(os.path.join(db_dir, "loadtest.db"))
+    db.create_promocode(PROMO_CODE, "vip", uses=args.users)
+    gemini = GeminiAPI(backend=backend)
+    if args.rpm:
+        # Квота меньше нагрузки - проверяем очередь по тарифам
+        gemini.admission = AdmissionController(rpm=args.rpm)
+    handlers = BotHandlers(gemini=gemini, db=db)
+    
+    builder = (
+        Application.builder()
+        .token(TOKEN)
+        .base_url(server.base_url)
+        .application_class(InstrumentedApplication, kwargs={"recorder": recorder})
+    )
+    app = build_application(handlers, builder)
+    
+    async with app:
+        await handlers.startup(app)
+        await app.start()
+        if args.mode == "webhook":
+            port = args.webhook_port
+            await app.updater.start_webhook(
+                listen="127.0.0.1", port=port, url_path="telegram",
+                webhook_url=f"http://127.0.0.1:{port}/telegram",
+                secret_token=WEBHOOK_SECRET, max_connections=args.max_connections,
+                allowed_updates=allowed_updates(app)
+            )
+        else:
+            await app.updater.start_polling(poll_interval=0, timeout=1, allowed_updates=allowed_updates(app))
+        
+        rng = random.Random(args.seed)
+        started = time.perf_counter()
+        deadline = started + args.duration
+        await asyncio.gather(*[
+            simulate_user(10_000 + i, server, recorder, deadline, args.think, random.Random(rng.random()))
+            for i in range(args.users)
+        ])
+        elapsed = time.perf_counter() - started
+        
+        await app.updater.stop()
+        await app.stop()
+        await handlers.shutdown(app)
+    
+    await server.stop()
+    return build_report(args, recorder, server, backend, gemini.prefixes, elapsed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота")
+    parser.add_argument("--users", type=int, default=20, help="одновременных пользователей")
+    parser.add_argument("--duration", type=float, default=30, help="длительность, сек")
+    parser.add_argument("--think", type=float, default=1.0, help="средняя пауза пользователя, сек")
+    parser.add_argument("--latency", type=float, default=0.8, help="медиана задержки Gemini, сек")
+    parser.add_argument("--sigma", type=float, default=0.5, help="разброс задержки (логнормальный)")
+    parser.add_argument("--errors", default="", help="ошибки Gemini, например 429=0.02,timeout=0.01")
+    parser.add_argument("--reply-chars", type=int, default=1200, help="длина ответа Gemini")
+    parser.add_argument("--rpm", type=int, default=0, help="квота Gemini, запросов в минуту (0 - из config)")
+    parser.add_argument("--mode", choices=["polling", "webhook"], default="polling", help="как бот получает апдейты")
+    parser.add_argument("--webhook-port", type=int, default=18443, help="порт webhook бота")
+    parser.add_argument("--max-connections", type=int, default=40, help="соединений webhook одновременно")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="сохранить отчёт в файл")
+    args = parser.parse_args()
+    
+    # bot.py настраивает INFO-логи - на каждый апдейт это слишком шумно
+    logging.getLogger().setLevel(logging.WARNING)
+    report = asyncio.run(run(args))
+    print_report(report)
+    
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\n💾 Отчёт сохранён: {args.json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+# loadtest/scenarios.py - проверки поведения бота при сбоях (фейковые Telegram и Gemini)
+#
+#   python -m loadtest.scenarios
+#
+# Каждый сценарий - отдельный бот с чистой базой. Код выхода 1, если
+# хоть одна проверка не прошла.
+import asyncio
+import logging
+import os
+import sys
+import tempfile
+from telegram.ext import Application
+from bot import build_application
+from firebase_service import DatabaseService
+from gemini_api import GeminiAPI, INTERRUPTED
+from handlers import BotHandlers
+from loadtest.fake_gemini import ChaosBackend
+from loadtest.fake_telegram import FakeTelegramServer
+from loadtest.run import TOKEN, Recorder, InstrumentedApplication
+from utils.chunker import MAX_MESSAGE_LENGTH, split_message, split_first, utf16_len
+
+logger = logging.getLogger(__name__)
+
+USER_ID = 20_000
+
+
+class Chat(Recorder):
+    """Recorder, который помнит последний текст, показанный в чате"""
+    
+    def __init__(self):
+        super().__init__()
+        self.last_text = None
+    
+    def on_reply(self, chat_id: int, method: str, params: dict, ts: float):
+        super().on_reply(chat_id, method, params, ts)
+        if method in ("sendMessage", "editMessageText"):
+            self.last_text = str(params.get("text", ""))
+
+
+class Bot:
+    """Бот на фейковых Telegram и Gemini: отправить сообщение и дождаться обработки"""
+    
+    def __init__(self, errors: dict):
+        self.chat = Chat()
+        self.server = FakeTelegramServer(on_reply=self.chat.on_reply)
+        self.backend = ChaosBackend(latency=0.05, latency_sigma=0.1, errors=errors, reply_chars=600, seed=1)
+        db_dir = tempfile.mkdtemp(prefix="scenario-")
+        self.handlers = BotHandlers(gemini=GeminiAPI(backend=self.backend),
+                                    db=DatabaseService(os.path.join(db_dir, "scenario.db")))
+        self.app = None
+    
+    async def __aenter__(self):
+        await self.server.start()
+        builder = (
+            Application.builder()
+            .token(TOKEN)
+            .base_url(self.server.base_url)
+            .application_class(InstrumentedApplication, kwargs={"recorder": self.chat})
+        )
+        self.app = build_application(self.handlers, builder, retention=False)
+        await self.app.initialize()
+        await self.handlers.startup(self.app)
+        await self.app.start()
+        await self.app.updater.start_polling(poll_interval=0, timeout=1)
+        return self
+    
+    async def __aexit__(self, *exc_info):
+        await self.app.updater.stop()
+        await self.app.stop()
+        await self.handlers.shutdown(self.app)
+        await self.app.shutdown()
+        await self.server.stop()
+    
+    async def send(self, text: str):
+        update_id = self.server.push_message(USER_ID, text)
+        self.chat.enqueue(USER_ID, update_id)
+        await self.chat.wait(update_id, timeout=30)
+
+
+# ===========================================
+# СЦЕНАРИИ
+# ===========================================
+
+async def stream_breaks_on_command(check):
+    """Поток команды оборвался после первого куска"""
+    async with Bot({"midstream": 1.0}) as bot:
+        await bot.send("/start")
+        remaining = bot.handlers.users.remaining(USER_ID)
+        await bot.send("/player Месси")
+        
+        check("пользователь видит, что ответ прерван", (bot.chat.last_text or "").endswith(INTERRUPTED.strip()))
+        check("запрос возвращён в лимит", bot.handlers.users.remaining(USER_ID) == remaining)
+        check("неполный ответ не в кэше", bot.handlers.response_cache.get("player", "Месси") is None)
+        check("неполный ответ не в истории", not bot.handlers.db.get_conversation_history(USER_ID))
+
+
+async def stream_breaks_in_dialog(check):
+    """Поток ответа в диалоге оборвался после первого куска"""
+    async with Bot({"midstream": 1.0}) as bot:
+        await bot.send("/start")
+        remaining = bot.handlers.users.remaining(USER_ID)
+        await bot.send("Кто выиграл ЛЧ в 2022?")
+        
+        check("запрос возвращён в лимит", bot.handlers.users.remaining(USER_ID) == remaining)
+        check("неполный ответ не в истории", not bot.handlers.db.get_conversation_history(USER_ID))
+
+
+async def stream_completes(check):
+    """Контроль: без сбоев ответ засчитан, закэширован и сохранён"""
+    async with Bot({}) as bot:
+        await bot.send("/start")
+        remaining = bot.handlers.users.remaining(USER_ID)
+        await bot.send("/player Месси")
+        
+        check("запрос засчитан", bot.handlers.users.remaining(USER_ID) == remaining - 1)
+        check("ответ в кэше", bot.handlers.response_cache.get("player", "Месси") is not None)
+        check("ответ в истории", len(bot.handlers.db.get_conversation_history(USER_ID)) == 2)
+
+
+async def cache_hit_counted(check):
+    """Ответ из кэша не зовёт Gemini, но засчитывается в лимит"""
+    async with Bot({}) as bot:
+        await bot.send("/start")
+        await bot.send("/player Месси")
+        remaining = bot.handlers.users.remaining(USER_ID)
+        calls = len(bot.backend.latencies)
+        await bot.send("/player Месси")
+        
+        check("Gemini не вызывался", len(bot.backend.latencies) == calls)
+        check("запрос засчитан", bot.handlers.users.remaining(USER_ID) == remaining - 1)
+        
+        for _ in range(bot.handlers.users.remaining(USER_ID)):
+            await bot.send("/player Месси")
+        await bot.send("/player Месси")
+        check("без лимита кэш не отдаётся", "Лимит исчерпан" in (bot.chat.last_text or ""))
+
+
+async def fence_on_message_limit(check):
+    """Длинный блок кода, чей ```python приходится на самый конец сообщения"""
+    code = "\n".join(f"print({i})" for i in range(800))
+    for padding in (4080, 4083, 4086):
+        text = "a" * padding + "\n```python\n" + code + "\n```"
+        parts = split_message(text)
+        _, rest = split_first(text)
+        lines = [line for part in parts for line in part.split("\n") if line.startswith("print")]
+        
+        check(f"{padding}: части не длиннее лимита", all(len(part) <= MAX_MESSAGE_LENGTH for part in parts))
+        check(f"{padding}: блок кода открывается заново целиком",
+              all(part.startswith("```python\nprint(") for part in parts[1:]))
+        check(f"{padding}: строки кода не порваны", lines == code.split("\n"))
+        check(f"{padding}: split_first переносит блок целиком", rest.lstrip().startswith("```python\nprint(0)\n"))
+
+
+async def fence_long_language(check):
+    """Блок кода с длинным языком: переоткрытие не должно съесть лимит"""
+    limit = 151
+    cases = {
+        "язык длиннее 32 символов": "x = 1\n```" + "long" * 40 + "\n",
+        "язык на пределе": "x = 1\n```" + "l" * 32 + "\n" + "\n".join(f"print({i})" for i in range(50)) + "\n```",
+    }
+    for name, text in cases.items():
+        parts = split_message(text, limit)
+        check(f"{name}: части не длиннее лимита", all(utf16_len(part) <= limit for part in parts))
+        check(f"{name}: частей немного", len(parts) <= len(text) // (limit // 2) + 1)
+
+
+SCENARIOS = [stream_breaks_on_command, stream_breaks_in_dialog, stream_completes, cache_hit_counted,
+             fence_on_message_limit, fence_long_language]
+
+
+async def run() -> int:
+    failed = 0
+    for scenario in SCENARIOS:
+        print(f"\n🧪 {scenario.__doc__}")
+        
+        def check(name: str, ok: bool):
+            nonlocal failed
+            print(f"  {'✅' if ok else '❌'} {name}")
+            failed += not ok
+        
+        await scenario(check)
+    
+    print(f"\n{'✅ Все проверки прошли' if not failed else f'❌ Не прошло проверок: {failed}'}")
+    return failed
+
+
+def main():
+    # bot.py настраивает INFO-логи - для проверок это слишком шумно
+    logging.getLogger().setLevel(logging.WARNING)
+    sys.exit(1 if asyncio.run(run()) else 0)
+
+
+if __name__ == "__main__":
+    main()
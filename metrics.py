@@ -0,0 +1,305 @@
+# metrics.py - счётчики и гистограммы в формате Prometheus
+import logging
+import threading
+import time
+from bisect import bisect_left
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from telegram.request import HTTPXRequest
+from config import METRICS_ENABLED, METRICS_HOST, METRICS_PORT
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограмм (сек)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+DB_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+CHUNK_BUCKETS = (1, 2, 3, 4, 6, 8, 12)
+
+REGISTRY = []  # все метрики в порядке объявления
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_number(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """
+    Метрика с метками
+    
+    Значения пишутся без блокировок: всё, что их меняет, работает в цикле
+    событий (или в вызванном из него синхронном коде), а поток HTTP-сервера
+    только читает копию. Значение можно не копить, а брать из компонента
+    при каждом запросе /metrics (set_function) - так уже посчитанное
+    (глубина очереди, admission.timeouts) не стоит ничего на горячем пути.
+    """
+    
+    kind = "untyped"
+    
+    def __init__(self, name: str, documentation: str, labels: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._functions = {}  # значения меток -> () -> число
+        REGISTRY.append(self)
+    
+    def set_function(self, function, *labels):
+        """Брать значение у function() при каждом запросе /metrics"""
+        self._functions[labels] = function
+    
+    def _label_text(self, values: tuple, extra: str = "") -> str:
+        pairs = [f'{name}="{_escape(value)}"' for name, value in zip(self.labels, values)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+    
+    def _function_samples(self):
+        for labels, function in list(self._functions.items()):
+            try:
+                value = function()
+            except Exception as e:
+                logger.warning(f"⚠️ Метрика {self.name}: {e}")
+                continue
+            yield f"{self.name}{self._label_text(labels)} {_format_number(value)}"
+    
+    def samples(self):
+        """Строки значений в текстовом формате Prometheus"""
+        return self._function_samples()
+
+
+class Counter(Metric):
+    """Только растёт (имя - с _total)"""
+    
+    kind = "counter"
+    
+    def __init__(self, name: str, documentation: str, labels: tuple = ()):
+        super().__init__(name, documentation, labels)
+        self._values = {}
+    
+    def inc(self, *labels, amount: float = 1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+    
+    def samples(self):
+        for labels, value in list(self._values.items()):
+            yield f"{self.name}{self._label_text(labels)} {_format_number(value)}"
+        yield from self._function_samples()
+
+
+class Gauge(Metric):
+    """Текущее значение (обычно - через set_function)"""
+    
+    kind = "gauge"
+    
+    def __init__(self, name: str, documentation: str, labels: tuple = ()):
+        super().__init__(name, documentation, labels)
+        self._values = {}
+    
+    def set(self, value: float, *labels):
+        self._values[labels] = value
+    
+    def samples(self):
+        for labels, value in list(self._values.items()):
+            yield f"{self.name}{self._label_text(labels)} {_format_number(value)}"
+        yield from self._function_samples()
+
+
+class Histogram(Metric):
+    """
+    Распределение значений по корзинам
+    
+    observe - поиск корзины bisect-ом и два сложения; накопительные суммы
+    по корзинам считаются только при выдаче.
+    """
+    
+    kind = "histogram"
+    
+    def __init__(self, name: str, documentation: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+        self._series = {}  # значения меток -> [счётчики корзин (+ последняя +Inf), сумма]
+    
+    def observe(self, value: float, *labels):
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+    
+    def samples(self):
+        for labels, (counts, total) in list(self._series.items()):
+            counts = list(counts)
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = f'le="{_format_number(bound)}"'
+                yield f"{self.name}_bucket{self._label_text(labels, le)} {cumulative}"
+            yield f"{self.name}_sum{self._label_text(labels)} {_format_number(total)}"
+            yield f"{self.name}_count{self._label_text(labels)} {cumulative}"
+
+
+def render() -> str:
+    """Все метрики в текстовом формате Prometheus 0.0.4"""
+    lines = []
+    for metric in REGISTRY:
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(metric.samples())
+    return "\n".join(lines) + "\n"
+
+
+# ===========================================
+# МЕТРИКИ БОТА
+# ===========================================
+
+# Обработка апдейтов
+UPDATE_SECONDS = Histogram("update_seconds", "Обработка апдейта целиком (после ожидания своей очереди)")
+ACTIVE_USERS = Gauge("update_active_users", "Пользователи с апдейтами в обработке или в очереди")
+
+# Gemini
+GEMINI_SECONDS = Histogram("gemini_request_seconds", "Попытка запроса к Gemini (поток - до открытия) по исходу",
+                           ("model", "attempt", "stream", "outcome"))
+GEMINI_ERRORS = Counter("gemini_errors_total", "Ошибки запросов к Gemini по классам", ("model", "kind"))
+GEMINI_RETRIES = Counter("gemini_retries_total", "Повторы запросов к Gemini по причине", ("reason",))
+GEMINI_HEDGES = Counter("gemini_hedges_total", "Дублирующие (хедж) запросы к Gemini")
+CIRCUIT_OPEN = Gauge("gemini_circuit_open", "Предохранитель модели разомкнут (1) или замкнут (0)", ("model",))
+CIRCUIT_OPENED = Counter("gemini_circuit_opened_total", "Сколько раз размыкался предохранитель", ("model",))
+
+# Очередь к Gemini
+ADMISSION_WAIT = Histogram("admission_wait_seconds", "Ожидание допуска к Gemini", ("plan",))
+ADMISSION_DEPTH = Gauge("admission_queue_depth", "Запросы, ждущие квоту Gemini")
+ADMISSION_TIMEOUTS = Counter("admission_timeouts_total", "Запросы, не дождавшиеся очереди")
+ADMISSION_THROTTLED = Counter("admission_throttled_total", "Паузы допуска после 429 от API")
+
+# Квота пользователей
+QUOTA_REJECTIONS = Counter("quota_rejections_total", "Отказы по дневному лимиту", ("plan",))
+
+# Кэш ответов на команды
+RESPONSE_CACHE_HITS = Counter("response_cache_hits_total", "Ответы на команды, отданные из кэша")
+RESPONSE_CACHE_MISSES = Counter("response_cache_misses_total", "Команды, которых не было в кэше")
+PREFIX_CACHE_HITS = Counter("prefix_cache_hits_total", "Запросы к Gemini с уже закэшированным префиксом")
+PREFIX_CACHE_MISSES = Counter("prefix_cache_misses_total", "Запросы к Gemini, префикс которых пришлось создавать")
+
+# База
+DB_SECONDS = Histogram("db_call_seconds", "Время метода DatabaseService", ("method",), buckets=DB_BUCKETS)
+WRITE_QUEUE_DEPTH = Gauge("db_write_queue_depth", "Сообщения истории, ждущие записи в базу")
+
+# Telegram
+TELEGRAM_SECONDS = Histogram("telegram_request_seconds", "Запрос к Bot API (кроме getUpdates)", ("method",))
+REPLY_CHUNKS = Histogram("reply_chunks", "Сообщений в одном ответе", buckets=CHUNK_BUCKETS)
+
+# Процессы-обработчики (только у приёмщика)
+WORKER_QUEUE_DEPTH = Gauge("worker_queue_depth", "Апдейты, ждущие процесс-обработчик", ("worker",))
+UPDATES_DISPATCHED = Counter("updates_dispatched_total", "Апдейты, переданные обработчикам")
+WORKER_RESTARTS = Counter("worker_restarts_total", "Перезапуски упавших обработчиков")
+
+
+def watch_bot(app, handlers):
+    """Очереди и уже посчитанные счётчики компонентов бота -> метрики"""
+    processor = app.update_processor
+    ACTIVE_USERS.set_function(lambda: getattr(processor, "active_users", 0))
+    WRITE_QUEUE_DEPTH.set_function(lambda: handlers.db.writes.depth)
+    RESPONSE_CACHE_HITS.set_function(lambda: handlers.response_cache.hits)
+    RESPONSE_CACHE_MISSES.set_function(lambda: handlers.response_cache.misses)
+    
+    gemini = handlers.gemini
+    GEMINI_HEDGES.set_function(lambda: gemini.hedges)
+    CIRCUIT_OPEN.set_function(lambda: int(gemini.breaker.state != gemini.breaker.CLOSED), gemini.breaker.name)
+    CIRCUIT_OPENED.set_function(lambda: gemini.breaker.opened, gemini.breaker.name)
+    if gemini.prefixes:
+        PREFIX_CACHE_HITS.set_function(lambda: gemini.prefixes.hits)
+        PREFIX_CACHE_MISSES.set_function(lambda: gemini.prefixes.misses)
+    if gemini.admission:
+        ADMISSION_DEPTH.set_function(lambda: gemini.admission.depth)
+        ADMISSION_TIMEOUTS.set_function(lambda: gemini.admission.timeouts)
+        ADMISSION_THROTTLED.set_function(lambda: gemini.admission.throttled)
+
+
+# ===========================================
+# ЗАМЕРЫ
+# ===========================================
+
+def timed(histogram: Histogram, label: str):
+    """Декоратор: время вызова функции в histogram с меткой label"""
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - started, label)
+        return wrapper
+    return decorator
+
+
+def timed_methods(histogram: Histogram):
+    """
+    Декоратор класса: время каждого публичного метода (метка - имя метода)
+    
+    При METRICS_ENABLED = False класс не меняется - ни одного лишнего вызова.
+    """
+    def decorator(cls):
+        if not METRICS_ENABLED:
+            return cls
+        for name, attribute in list(vars(cls).items()):
+            if not name.startswith("_") and callable(attribute):
+                setattr(cls, name, timed(histogram, name)(attribute))
+        return cls
+    return decorator
+
+
+class TimedRequest(HTTPXRequest):
+    """HTTPXRequest, замеряющий каждый запрос к Bot API по имени метода"""
+    
+    async def do_request(self, url: str, method: str, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await super().do_request(url, method, *args, **kwargs)
+        finally:
+            # В url - токен, в метку идёт только имя метода
+            TELEGRAM_SECONDS.observe(time.perf_counter() - started, url.rsplit("/", 1)[-1])
+
+
+# ===========================================
+# HTTP
+# ===========================================
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def log_message(self, format, *args):
+        # Prometheus ходит каждые 15 сек - в логе бота это не нужно
+        pass
+
+
+def start_server(port: int = METRICS_PORT, host: str = METRICS_HOST):
+    """
+    GET http://host:port/metrics в фоновом потоке
+    
+    Returns:
+        ThreadingHTTPServer | None: сервер (None - метрики выключены или порт занят)
+    """
+    if not METRICS_ENABLED:
+        return None
+    try:
+        server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    except OSError as e:
+        logger.error(f"❌ Метрики: не удалось занять {host}:{port} ({e})")
+        return None
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    logger.info(f"📈 Метрики: http://{host}:{port}/metrics")
+    return server
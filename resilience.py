@@ -0,0 +1,230 @@
+# resilience.py - классификация ошибок, повторы с джиттером, предохранитель, хеджирование
+import asyncio
+import logging
+import random
+import time
+from collections import deque
+from google.api_core import exceptions as api_errors
+from config import (RETRY_BASE_DELAY, RETRY_MAX_DELAY, CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_TIMEOUT,
+                    CIRCUIT_HALF_OPEN_PROBES, HEDGE_PERCENTILE, HEDGE_MIN_SAMPLES, HEDGE_MIN_DELAY)
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitOpen(Exception):
+    """Предохранитель разомкнут - к модели сейчас не ходим"""
+
+
+# ===========================================
+# КЛАССЫ ОШИБОК
+# ===========================================
+
+RATE_LIMIT = "rate_limit"    # 429: квота
+NOT_FOUND = "not_found"      # 404: нет модели
+TIMEOUT = "timeout"          # 504 / таймаут клиента
+UNAVAILABLE = "unavailable"  # 500, 503: сбой на стороне API
+INVALID = "invalid"          # 400, 403: запрос не пройдёт и со второго раза
+OPEN = "circuit_open"
+OTHER = "other"
+
+# Тип исключения -> класс (проверяются по порядку, подклассы раньше)
+ERROR_TYPES = [
+    (CircuitOpen, OPEN),
+    (api_errors.TooManyRequests, RATE_LIMIT),     # и ResourceExhausted
+    (api_errors.NotFound, NOT_FOUND),
+    (api_errors.GatewayTimeout, TIMEOUT),         # и DeadlineExceeded ("504 Deadline Exceeded")
+    (asyncio.TimeoutError, TIMEOUT),
+    (TimeoutError, TIMEOUT),
+    (api_errors.ServerError, UNAVAILABLE),        # 500, 501, 502, 503
+    (api_errors.BadRequest, INVALID),             # и InvalidArgument
+    (api_errors.Forbidden, INVALID),              # и PermissionDenied
+    (api_errors.Unauthorized, INVALID),           # и Unauthenticated
+]
+
+# Что говорит о проблемах самой модели (и размыкает предохранитель)
+TRIPPING = {TIMEOUT, UNAVAILABLE}
+
+
+def classify(error: Exception) -> str:
+    """Класс ошибки по её типу, а не по тексту"""
+    for error_type, kind in ERROR_TYPES:
+        if isinstance(error, error_type):
+            return kind
+    return OTHER
+
+
+def retry_after(error: Exception):
+    """
+    Сколько API просит подождать перед повтором
+    
+    Gemini кладёт это в google.rpc.RetryInfo среди деталей ошибки (REST -
+    словарь с retryDelay "12s", gRPC - protobuf с retry_delay), HTTP -
+    ещё и в заголовок Retry-After.
+    
+    Returns:
+        float | None: секунды (None - API не сказал)
+    """
+    try:
+        for detail in getattr(error, "details", None) or ():
+            if isinstance(detail, dict):
+                if detail.get("@type", "").endswith("google.rpc.RetryInfo") and detail.get("retryDelay"):
+                    return float(detail["retryDelay"].rstrip("s"))
+            elif getattr(detail, "retry_delay", None) is not None:
+                return detail.retry_delay.seconds + detail.retry_delay.nanos / 1e9
+        
+        headers = getattr(getattr(error, "response", None), "headers", None)
+        value = headers.get("Retry-After") if headers else None
+        if value and value.strip().isdigit():
+            return float(value)
+    except (AttributeError, TypeError, ValueError):
+        pass
+    return None
+
+
+def backoff_delay(attempt: int, base: float = RETRY_BASE_DELAY, cap: float = RETRY_MAX_DELAY) -> float:
+    """
+    Пауза перед повтором: full jitter
+    
+    Случайная от 0 до base * 2^attempt (не больше cap) - повторы многих
+    пользователей после общего сбоя не приходят в API одной волной.
+    """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+# ===========================================
+# ПРЕДОХРАНИТЕЛЬ
+# ===========================================
+
+class CircuitBreaker:
+    """
+    Предохранитель на модель
+    
+    После failure_threshold сбоев подряд (таймауты, 5xx) размыкается:
+    запросы сразу получают CircuitOpen, не дожидаясь таймаута. Через
+    reset_timeout пропускает half_open_probes пробных запросов: успех -
+    замыкается, сбой - снова размыкается на reset_timeout.
+    """
+    
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+    
+    def __init__(self, name: str, failure_threshold: int = CIRCUIT_FAILURE_THRESHOLD,
+                 reset_timeout: float = CIRCUIT_RESET_TIMEOUT, half_open_probes: int = CIRCUIT_HALF_OPEN_PROBES):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.half_open_probes = half_open_probes
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened = 0       # сколько раз размыкался
+        self._opened_at = 0.0
+        self._probes = 0      # пробных запросов в полёте
+    
+    def before_call(self):
+        """
+        Можно ли сейчас идти к модели
+        
+        Raises:
+            CircuitOpen: предохранитель разомкнут
+        """
+        if self.state == self.OPEN:
+            if time.monotonic() - self._opened_at < self.reset_timeout:
+                raise CircuitOpen(self.name)
+            self.state = self.HALF_OPEN
+            self._probes = 0
+            logger.info(f"🔌 {self.name}: пробуем восстановиться")
+        
+        if self.state == self.HALF_OPEN:
+            if self._probes >= self.half_open_probes:
+                raise CircuitOpen(self.name)
+            self._probes += 1
+    
+    def record_success(self):
+        if self.state != self.CLOSED:
+            logger.info(f"✅ {self.name}: предохранитель замкнут")
+        self.state = self.CLOSED
+        self.failures = 0
+    
+    def release(self):
+        """Запрос отменён, не дождавшись ответа (проиграл хедж) - проба не в счёт"""
+        if self.state == self.HALF_OPEN:
+            self._probes = max(0, self._probes - 1)
+    
+    def record_failure(self, kind: str):
+        if kind not in TRIPPING:
+            # Ошибка запроса, а не модели - о её здоровье ничего не говорит
+            self.release()
+            return
+        
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                self.opened += 1
+                logger.error(f"🔌 {self.name}: предохранитель разомкнут на {self.reset_timeout} сек "
+                             f"({self.failures} сбоев подряд)")
+            self.state = self.OPEN
+            self._opened_at = time.monotonic()
+
+
+# ===========================================
+# ХЕДЖИРОВАНИЕ
+# ===========================================
+
+class LatencyTracker:
+    """Скользящее окно времён ответа для порога хеджирования"""
+    
+    def __init__(self, size: int = 200, percentile: float = HEDGE_PERCENTILE,
+                 min_samples: int = HEDGE_MIN_SAMPLES, min_delay: float = HEDGE_MIN_DELAY):
+        self._samples = deque(maxlen=size)
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+    
+    def add(self, seconds: float):
+        self._samples.append(seconds)
+    
+    def hedge_delay(self):
+        """Через сколько секунд слать второй запрос (None - пока мало данных)"""
+        if len(self._samples) < self.min_samples:
+            return None
+        ordered = sorted(self._samples)
+        index = min(len(ordered) - 1, int(len(ordered) * self.percentile / 100))
+        return max(self.min_delay, ordered[index])
+
+
+async def hedged(call, delay: float, allow_hedge=None):
+    """
+    Выполнить call(), а если за delay ответа нет - параллельно ещё один
+    
+    Побеждает первый успешный ответ, второй запрос отменяется. Если
+    первый упал до того, как ушёл второй, ошибка пробрасывается сразу.
+    
+    Args:
+        call: async () -> результат
+        delay: порог (обычно p95 времени ответа)
+        allow_hedge: () -> bool - можно ли тратить квоту на второй запрос
+    
+    Returns:
+        tuple: (результат, был ли отправлен второй запрос)
+    """
+    first = asyncio.ensure_future(call())
+    pending = {first}
+    error = None
+    try:
+        done, _ = await asyncio.wait(pending, timeout=delay)
+        if done or (allow_hedge and not allow_hedge()):
+            return await first, False
+        
+        pending.add(asyncio.ensure_future(call()))
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result(), True
+                error = task.exception()
+        raise error
+    finally:
+        # Проигравший (или всё, если нас самих отменили) не должен висеть
+        for task in pending:
+            task.cancel()
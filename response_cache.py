@@ -0,0 +1,113 @@
+# response_cache.py - кэш ответов для футбольных команд
+import logging
+import re
+import time
+from collections import OrderedDict
+from typing import Optional
+from config import RESPONSE_CACHE_TTL, RESPONSE_CACHE_MAX_BYTES, RESPONSE_CACHE_PERSISTENT
+
+logger = logging.getLogger(__name__)
+
+# Команды вида "А vs Б": порядок сторон не важен
+VS_COMMANDS = ("match", "compare")
+VS_SPLIT = re.compile(r"\s+(?:vs\.?|против)\s+")
+
+
+def make_cache_key(command: str, args: str) -> str:
+    """
+    Ключ кэша: команда + нормализованные аргументы
+    
+    Регистр, лишние пробелы и ё/е не важны, для "А vs Б" -
+    ещё и порядок сторон.
+    """
+    text = " ".join(args.lower().replace("ё", "е").split())
+    
+    if command in VS_COMMANDS:
+        sides = VS_SPLIT.split(text)
+        if len(sides) == 2:
+            text = " vs ".join(sorted(side.strip() for side in sides))
+    
+    return f"{command}:{text}"
+
+
+class ResponseCache:
+    """
+    LRU + TTL кэш готовых ответов
+    
+    Память ограничена RESPONSE_CACHE_MAX_BYTES, у каждой команды свой
+    TTL (RESPONSE_CACHE_TTL). Если включён RESPONSE_CACHE_PERSISTENT,
+    ответы дублируются в SQLite и переживают перезапуск.
+    """
+    
+    def __init__(self, db=None, ttls: dict = RESPONSE_CACHE_TTL,
+                 max_bytes: int = RESPONSE_CACHE_MAX_BYTES,
+                 persistent: bool = RESPONSE_CACHE_PERSISTENT):
+        self.db = db if persistent else None
+        self.ttls = ttls
+        self.max_bytes = max_bytes
+        self._items = OrderedDict()  # key -> (expires_at, text, size)
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+    
+    def is_cacheable(self, command: str) -> bool:
+        return command in self.ttls
+    
+    def get(self, command: str, args: str) -> Optional[str]:
+        """Ответ из кэша или None"""
+        if not self.is_cacheable(command):
+            return None
+        
+        key = make_cache_key(command, args)
+        now = time.time()
+        
+        item = self._items.get(key)
+        if item and item[0] > now:
+            self._items.move_to_end(key)
+            self.hits += 1
+            return item[1]
+        if item:
+            self._drop(key)
+        
+        # Второй уровень - SQLite
+        if self.db:
+            row = self.db.get_cached_response(key, now)
+            if row:
+                self._store(key, row['response'], row['expires_at'])
+                self.hits += 1
+                return row['response']
+        
+        self.misses += 1
+        return None
+    
+    def put(self, command: str, args: str, text: str):
+        """Сохранить ответ"""
+        if not self.is_cacheable(command):
+            return
+        
+        key = make_cache_key(command, args)
+        expires_at = time.time() + self.ttls[command]
+        self._store(key, text, expires_at)
+        
+        if self.db:
+            self.db.save_cached_response(key, command, text, expires_at)
+    
+    def _store(self, key: str, text: str, expires_at: float):
+        if key in self._items:
+            self._drop(key)
+        
+        size = len(text.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        
+        self._items[key] = (expires_at, text, size)
+        self._bytes += size
+        
+        # Вытесняем самые давние, пока не влезем в лимит памяти
+        while self._bytes > self.max_bytes:
+            old_key = next(iter(self._items))
+            self._drop(old_key)
+    
+    def _drop(self, key: str):
+        _, _, size = self._items.pop(key)
+        self._bytes -= size
@@ -0,0 +1,70 @@
+# retention.py - чистка старой истории диалогов
+import asyncio
+import logging
+from config import (RETENTION_KEEP_MESSAGES, RETENTION_ARCHIVE, RETENTION_BATCH_SIZE,
+                    RETENTION_SCAN_USERS, RETENTION_VACUUM_PAGES)
+
+logger = logging.getLogger(__name__)
+
+
+async def run_retention(db, keep: int = RETENTION_KEEP_MESSAGES,
+                        batch_size: int = RETENTION_BATCH_SIZE,
+                        archive: bool = RETENTION_ARCHIVE,
+                        scan_users: int = RETENTION_SCAN_USERS) -> int:
+    """
+    Оставить каждому пользователю только keep последних сообщений
+    
+    Подсчёт сообщений идёт страницами по scan_users пользователей,
+    удаление - короткими пачками, между ними управление возвращается
+    боту: ни запись новых сообщений, ни чаты не ждут чистку.
+    
+    Returns:
+        int: сколько сообщений удалено
+    """
+    total = 0
+    after_user_id = -1
+    while True:
+        users, after_user_id = db.users_over_history_limit(keep, after_user_id, scan_users)
+        if after_user_id is None:
+            break
+        await asyncio.sleep(0)
+        
+        for user_id in users:
+            while True:
+                deleted = db.trim_history(user_id, keep, batch_size, archive)
+                total += deleted
+                await asyncio.sleep(0)
+                if deleted < batch_size:
+                    break
+    
+    if total and db.incremental_vacuum(RETENTION_VACUUM_PAGES):
+        logger.info("🧹 Свободное место возвращено (incremental vacuum)")
+    
+    logger.info(f"🧹 Чистка истории: удалено {total} сообщений")
+    return total
+
+
+async def retention_job(context):
+    """Задача для JobQueue (data = DatabaseService)"""
+    try:
+        await run_retention(context.job.data)
+    except Exception as e:
+        logger.error(f"❌ Ошибка чистки истории: {e}", exc_info=True)
+
+
+if __name__ == "__main__":
+    # Ручной запуск: python retention.py [--vacuum]
+    import sys
+    from firebase_service import DatabaseService
+    
+    logging.basicConfig(level=logging.INFO)
+    db = DatabaseService()
+    asyncio.run(run_retention(db))
+    
+    if "--vacuum" in sys.argv:
+        # Однократно: полное сжатие и перевод старой базы на incremental vacuum
+        print("⏳ VACUUM... (бот лучше остановить)")
+        db.vacuum()
+    
+    db.close()
+    print("✅ Готово")
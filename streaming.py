@@ -0,0 +1,154 @@
+# streaming.py - потоковая отправка ответа с правкой сообщений
+import asyncio
+import logging
+import time
+from telegram.error import BadRequest, RetryAfter
+from config import STREAM_EDIT_INTERVAL
+from utils.chunker import MAX_MESSAGE_LENGTH, split_first, utf16_len
+from utils.formatter import clean_response
+from utils.renderer import render
+
+logger = logging.getLogger(__name__)
+
+
+class MessageStreamer:
+    """
+    Показывает ответ пользователю по мере генерации
+    
+    Первый кусок отправляется сразу, дальше сообщение правится не чаще
+    раза в STREAM_EDIT_INTERVAL секунд. Если текст перестаёт влезать
+    в одно сообщение, продолжение уходит новым сообщением.
+    
+    limiter - общее на весь бот ведро (admission.TokenBucket) под лимит
+    Telegram: промежуточная правка без токена пропускается, новое
+    сообщение и последняя правка части ждут токен. RetryAfter - запасной
+    вариант: пропускается только промежуточная правка, остальное ждём и
+    повторяем; если и это не вышло - RetryAfter уходит наверх, а не
+    теряет текст молча.
+    """
+    
+    def __init__(self, message, edit_interval: float = STREAM_EDIT_INTERVAL,
+                 max_length: int = MAX_MESSAGE_LENGTH, limiter=None):
+        self.origin = message          # сообщение пользователя, на которое отвечаем
+        self.edit_interval = edit_interval
+        self.limiter = limiter
+        self.max_length = max_length
+        self.parts = []                # текст каждого нашего сообщения
+        self._received = []            # ответ как есть (без переоткрытых ```)
+        self.messages = []             # отправленные сообщения Telegram
+        self._shown = ""               # что сейчас видно в последнем сообщении
+        self._next_edit = 0.0
+    
+    @property
+    def text(self) -> str:
+        """Весь полученный текст"""
+        return "".join(self._received)
+    
+    async def push(self, delta: str):
+        """Добавить кусок ответа"""
+        self._received.append(delta)
+        if not self.parts:
+            self.parts.append("")
+        self.parts[-1] += delta
+        
+        # Не влезает - закрываем сообщение и начинаем новое
+        while utf16_len(self.parts[-1]) > self.max_length:
+            head, tail = split_first(self.parts[-1], self.max_length)
+            self.parts[-1] = head
+            await self._flush(force=True)
+            self.parts.append(tail)
+            self._shown = ""
+        
+        await self._flush()
+    
+    async def finish(self) -> str:
+        """
+        Дописать остаток и оформить сообщения (Markdown -> сущности)
+        
+        Returns:
+            str: весь текст ответа
+        """
+        await self._flush(force=True)
+        
+        for message, part in zip(self.messages, self.parts):
+            rendered = render(clean_response(part))
+            if not rendered.text:
+                continue
+            await self._acquire(required=True)
+            try:
+                await self._retry(lambda: message.edit_text(
+                    rendered.text,
+                    entities=rendered.entities,
+                    disable_web_page_preview=True
+                ))
+            except BadRequest as e:
+                # Текст без разметки совпал с уже показанным - это не ошибка
+                if "not modified" not in str(e).lower():
+                    raise
+        
+        return self.text
+    
+    async def _flush(self, force: bool = False):
+        """Отправить или обновить последнее сообщение (с учётом лимитов)"""
+        current = self.parts[-1] if self.parts else ""
+        if not current.strip() or current == self._shown:
+            return
+        
+        now = time.monotonic()
+        is_new = len(self.messages) < len(self.parts)
+        
+        # Новое сообщение отправляем сразу, правки - не чаще интервала
+        if not is_new and not force and now < self._next_edit:
+            return
+        if not await self._acquire(required=is_new or force):
+            return
+        
+        try:
+            if is_new:
+                self.messages.append(await self._retry(lambda: self.origin.reply_text(current)))
+            elif force:
+                await self._retry(lambda: self.messages[-1].edit_text(current))
+            else:
+                await self.messages[-1].edit_text(current)
+        except RetryAfter as e:
+            if is_new or force:
+                # Лимит пережидали и упёрлись снова - без этого сообщения часть
+                # ответа потеряется, так что запрос не удался
+                raise
+            # Упёрлись в лимит - просто откладываем следующую правку
+            logger.warning(f"⏳ Лимит правок Telegram, пауза {e.retry_after} сек")
+            self._next_edit = now + e.retry_after
+            return
+        except BadRequest as e:
+            if "not modified" not in str(e).lower():
+                raise
+        
+        self._shown = current
+        self._next_edit = now + self.edit_interval
+    
+    async def _acquire(self, required: bool) -> bool:
+        """
+        Токен общего лимита правок
+        
+        Returns:
+            bool: можно отправлять (обязательная отправка ждёт токен, промежуточная - нет)
+        """
+        if self.limiter is None:
+            return True
+        now = time.monotonic()
+        delay = self.limiter.wait_time(1, now)
+        if delay > 0 and not required:
+            return False
+        # Токен берём сразу (в долг): ждущие отправки встают друг за другом, а не просыпаются разом
+        self.limiter.take(1, now)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        return True
+    
+    async def _retry(self, call):
+        """Выполнить запрос, один раз переждав RetryAfter"""
+        try:
+            return await call()
+        except RetryAfter as e:
+            await asyncio.sleep(e.retry_after)
+            return await call()
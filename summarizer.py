@@ -0,0 +1,111 @@
+# summarizer.py - долгая память: сводка старой части диалога
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Optional
+from config import (MAX_HISTORY, SUMMARY_TRIGGER_MESSAGES, SUMMARY_BATCH_MESSAGES,
+                    SUMMARY_CACHE_USERS)
+
+logger = logging.getLogger(__name__)
+
+# Длинные ответы в сводку целиком не нужны
+SUMMARY_TURN_CHARS = 500
+
+
+class ConversationSummarizer:
+    """
+    Сводка диалога для каждого пользователя
+    
+    В промпт идут только последние MAX_HISTORY сообщений. Всё, что
+    старше, пачками по SUMMARY_TRIGGER_MESSAGES+ сворачивается в короткую
+    сводку (имя, предпочтения, факты) и хранится в user_summaries.
+    Обновление идёт фоновой задачей уже после ответа пользователю.
+    """
+    
+    def __init__(self, db, gemini, trigger: int = SUMMARY_TRIGGER_MESSAGES,
+                 batch: int = SUMMARY_BATCH_MESSAGES, max_users: int = SUMMARY_CACHE_USERS):
+        self.db = db
+        self.gemini = gemini
+        self.trigger = trigger
+        self.batch = batch
+        self.max_users = max_users
+        self._summaries = OrderedDict()  # user_id -> (summary, last_message_id) (LRU)
+        self._fresh = {}                 # user_id -> новых сообщений с прошлой проверки
+        self._tasks = {}                 # user_id -> задача обновления
+    
+    def get(self, user_id: int) -> Optional[str]:
+        """Текущая сводка пользователя (или None)"""
+        return self._load(user_id)[0]
+    
+    def schedule(self, user_id: int, added: int = 2):
+        """
+        Учесть новые сообщения и при необходимости обновить сводку в фоне
+        
+        В базу ходим только раз в trigger сообщений, чтобы не сбрасывать
+        очередь записи истории на каждом ответе.
+        """
+        fresh = self._fresh.get(user_id, 0) + added
+        if fresh < self.trigger or user_id in self._tasks:
+            self._fresh[user_id] = fresh
+            return
+        
+        self._fresh.pop(user_id, None)
+        task = asyncio.create_task(self._refresh(user_id))
+        self._tasks[user_id] = task
+        task.add_done_callback(
+            lambda t: self._tasks.pop(user_id, None) if self._tasks.get(user_id) is t else None
+        )
+    
+    def forget(self, user_id: int):
+        """Забыть сводку (после /clear)"""
+        task = self._tasks.pop(user_id, None)
+        if task:
+            task.cancel()
+        self._summaries.pop(user_id, None)
+        self._fresh.pop(user_id, None)
+    
+    async def stop(self):
+        """Отменить незаконченные обновления"""
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    
+    def _load(self, user_id: int) -> tuple:
+        item = self._summaries.get(user_id)
+        if item is not None:
+            self._summaries.move_to_end(user_id)
+            return item
+        
+        row = self.db.get_summary(user_id)
+        item = (row['summary'], row['last_message_id']) if row else (None, 0)
+        self._remember(user_id, item)
+        return item
+    
+    def _remember(self, user_id: int, item: tuple):
+        self._summaries[user_id] = item
+        self._summaries.move_to_end(user_id)
+        if len(self._summaries) > self.max_users:
+            old_user_id, _ = self._summaries.popitem(last=False)
+            self._fresh.pop(old_user_id, None)
+    
+    async def _refresh(self, user_id: int):
+        try:
+            summary, last_id = self._load(user_id)
+            rows = self.db.get_unsummarized_messages(user_id, last_id, MAX_HISTORY, self.batch)
+            if len(rows) < self.trigger:
+                return
+            
+            turns = [(row['role'], row['content'][:SUMMARY_TURN_CHARS]) for row in rows]
+            new_summary = await self.gemini.summarize(summary, turns)
+            if not new_summary:
+                return
+            
+            last_id = rows[-1]['id']
+            self.db.save_summary(user_id, new_summary, last_id)
+            self._remember(user_id, (new_summary, last_id))
+            logger.info(f"🧠 Сводка обновлена для {user_id}: +{len(rows)} сообщ.")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"❌ Ошибка обновления сводки для {user_id}: {e}")
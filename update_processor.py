@@ -0,0 +1,81 @@
+# update_processor.py - параллельная обработка апдейтов с порядком внутри пользователя
+import asyncio
+import logging
+import time
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+from config import CONCURRENT_UPDATES
+from metrics import UPDATE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """
+    Разные пользователи обрабатываются параллельно (до max_concurrent_updates),
+    апдейты одного пользователя - строго по очереди
+    
+    Иначе быстрое второе сообщение обгоняет первое, а /clear может
+    проскочить между генерацией и save_message. Блокировка пользователя
+    берётся до общего семафора: апдейт, который всё равно ждёт своей
+    очереди, не занимает место, нужное другим пользователям.
+    
+    В таблице блокировок только пользователи, у которых сейчас есть
+    апдейты в обработке, - она не растёт с числом пользователей бота.
+    """
+    
+    def __init__(self, max_concurrent_updates: int = CONCURRENT_UPDATES):
+        super().__init__(max_concurrent_updates)
+        self._locks = {}  # user_id -> [asyncio.Lock, сколько апдейтов держат/ждут]
+    
+    @property
+    def active_users(self) -> int:
+        """У скольких пользователей апдейты в обработке или в очереди"""
+        return len(self._locks)
+    
+    async def process_update(self, update: object, coroutine) -> None:
+        # BaseUpdateProcessor.process_update помечен @final, но семафор он берёт
+        # первым, а нам нужно сначала дождаться своей очереди
+        user_id = self._user_id(update)
+        if user_id is None:
+            async with self._semaphore:
+                await self.do_process_update(update, coroutine)
+            return
+        
+        entry = self._locks.get(user_id)
+        if entry is None:
+            entry = self._locks[user_id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                async with self._semaphore:
+                    await self.do_process_update(update, coroutine)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[user_id]
+    
+    async def do_process_update(self, update: object, coroutine) -> None:
+        started = time.perf_counter()
+        try:
+            await coroutine
+        finally:
+            UPDATE_SECONDS.observe(time.perf_counter() - started)
+    
+    async def initialize(self) -> None:
+        pass
+    
+    async def shutdown(self) -> None:
+        if self._locks:
+            logger.warning(f"⚠️ Остановка: апдейты в обработке у {len(self._locks)} пользователей")
+    
+    @staticmethod
+    def _user_id(update: object):
+        """Чьи апдейты упорядочиваем: пользователь, иначе чат"""
+        if not isinstance(update, Update):
+            return None
+        if update.effective_user:
+            return update.effective_user.id
+        if update.effective_chat:
+            return update.effective_chat.id
+        return None
@@ -0,0 +1,249 @@
+# user_cache.py - пользователи и тарифы в памяти с отложенной записью в базу
+import asyncio
+import logging
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Optional
+from config import FREE_DAILY_LIMIT, PRO_DAILY_LIMIT, USER_CACHE_SIZE, USER_CACHE_FLUSH_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+UNLIMITED = 999999  # "бесконечные" запросы для VIP/Premium
+
+
+@dataclass
+class UserState:
+    """Пользователь с уже разобранным тарифом"""
+    user_id: int
+    username: str
+    plan: str
+    premium_expires: Optional[datetime]
+    daily_requests: int
+    last_request_date: str
+    
+    @classmethod
+    def from_row(cls, row: dict):
+        expires = row['premium_expires']
+        return cls(
+            user_id=row['user_id'],
+            username=row['username'],
+            plan=row['plan'] or 'free',
+            premium_expires=datetime.fromisoformat(expires) if expires else None,
+            daily_requests=row['daily_requests'] or 0,
+            last_request_date=row['last_request_date']
+        )
+    
+    def as_row(self) -> tuple:
+        """Значения для DatabaseService.save_user_states"""
+        expires = self.premium_expires.isoformat() if self.premium_expires else None
+        return (self.plan, expires, self.daily_requests, self.last_request_date, self.user_id)
+
+
+class UserCache:
+    """
+    Кэш пользователей перед DatabaseService
+    
+    Единственное место, где считается логика тарифов для чтения: срок
+    Premium/PRO, дневной лимит и его сброс. Изменения копятся в памяти
+    и пишутся в базу пачкой раз в USER_CACHE_FLUSH_INTERVAL секунд.
+    
+    Списание запросов идёт мимо отложенной записи - через атомарный
+    резерв в базе (reserve/commit/refund), а кэш лишь повторяет
+    значения, которые вернула база.
+    """
+    
+    def __init__(self, db, max_size: int = USER_CACHE_SIZE,
+                 flush_interval: float = USER_CACHE_FLUSH_INTERVAL):
+        self.db = db
+        self.max_size = max_size
+        self.flush_interval = flush_interval
+        self._users = OrderedDict()  # user_id -> UserState (LRU)
+        self._dirty = {}             # user_id -> UserState, ещё не записанные
+        self._task = None
+    
+    # ========================================
+    # ЧТЕНИЕ
+    # ========================================
+    
+    def get(self, user_id: int) -> Optional[UserState]:
+        """Пользователь из кэша (при промахе - из базы)"""
+        state = self._users.get(user_id)
+        if state is None:
+            # Вытесненный, но ещё не записанный пользователь новее базы
+            state = self._dirty.get(user_id)
+            if state is None:
+                row = self.db.get_user(user_id)
+                if not row:
+                    return None
+                state = UserState.from_row(row)
+            self._remember(state)
+        else:
+            self._users.move_to_end(user_id)
+        
+        self._evaluate(state)
+        return state
+    
+    def create(self, user_id: int, username: str) -> UserState:
+        """Создать пользователя (пишется в базу сразу)"""
+        self.db.create_user(user_id, username)
+        return self.get(user_id)
+    
+    def daily_limit(self, state: UserState) -> Optional[int]:
+        """Дневной лимит тарифа (None - без лимита)"""
+        if state.plan == 'vip':
+            return None
+        if state.plan == 'premium' and state.premium_expires:
+            return None
+        if state.plan == 'pro' and state.premium_expires:
+            return PRO_DAILY_LIMIT
+        return FREE_DAILY_LIMIT
+    
+    def days_left(self, state: UserState) -> int:
+        """Сколько дней осталось у Premium/PRO"""
+        if not state.premium_expires:
+            return 0
+        return (state.premium_expires - datetime.now()).days
+    
+    def remaining(self, user_id: int) -> int:
+        """Оставшиеся запросы на сегодня"""
+        state = self.get(user_id)
+        if not state:
+            return 0
+        
+        limit = self.daily_limit(state)
+        if limit is None:
+            return UNLIMITED
+        return max(0, limit - state.daily_requests)
+    
+    # ========================================
+    # ИЗМЕНЕНИЯ
+    # ========================================
+    
+    def reserve(self, user_id: int):
+        """
+        Занять запрос (атомарно, в базе)
+        
+        Returns:
+            dict | None: резерв или None, если лимит исчерпан
+        """
+        reservation = self.db.reserve_request(user_id)
+        if reservation:
+            self._apply(user_id, reservation)
+        return reservation
+    
+    def commit(self, reservation: dict) -> int:
+        """
+        Подтвердить резерв
+        
+        Returns:
+            int: сколько запросов осталось
+        """
+        self.db.commit_request(reservation)
+        return self.remaining(reservation['user_id'])
+    
+    def refund(self, reservation: dict):
+        """Вернуть резерв (ответ не получен)"""
+        if not self.db.refund_request(reservation):
+            return
+        
+        state = self._users.get(reservation['user_id']) or self._dirty.get(reservation['user_id'])
+        if state and state.last_request_date == reservation['last_request_date']:
+            state.daily_requests -= 1
+    
+    def _apply(self, user_id: int, reservation: dict):
+        """Обновить кэш значениями, которые вернула база"""
+        state = self._users.get(user_id) or self._dirty.get(user_id)
+        if state is None:
+            return
+        
+        expires = reservation['premium_expires']
+        state.plan = reservation['plan']
+        state.premium_expires = datetime.fromisoformat(expires) if expires else None
+        state.daily_requests = reservation['daily_requests']
+        state.last_request_date = reservation['last_request_date']
+    
+    def invalidate(self, user_id: int):
+        """
+        Записать изменения пользователя и убрать его из кэша
+        
+        Вызывать ДО того, как тариф меняют напрямую в базе (промокоды),
+        иначе отложенная запись затрёт новые значения.
+        """
+        state = self._dirty.pop(user_id, None)
+        if state:
+            self.db.save_user_states([state.as_row()])
+        self._users.pop(user_id, None)
+    
+    def _evaluate(self, state: UserState):
+        """Истечение тарифа и сброс дневного счётчика"""
+        now = datetime.now()
+        
+        if state.plan in ('premium', 'pro') and state.premium_expires and state.premium_expires <= now:
+            state.plan = 'free'
+            state.premium_expires = None
+            self._mark_dirty(state)
+        
+        today = now.strftime("%Y-%m-%d")
+        if state.last_request_date != today:
+            state.daily_requests = 0
+            state.last_request_date = today
+            self._mark_dirty(state)
+    
+    def _remember(self, state: UserState):
+        self._users[state.user_id] = state
+        if len(self._users) > self.max_size:
+            # Грязные записи остаются в _dirty до следующей записи
+            self._users.popitem(last=False)
+    
+    def _mark_dirty(self, state: UserState):
+        self._dirty[state.user_id] = state
+    
+    # ========================================
+    # ОТЛОЖЕННАЯ ЗАПИСЬ
+    # ========================================
+    
+    @property
+    def pending(self) -> int:
+        """Сколько пользователей ждут записи"""
+        return len(self._dirty)
+    
+    def flush(self):
+        """
+        Записать все накопленные изменения одной транзакцией
+        
+        Выполняется в потоке event loop: одна пачка UPDATE занимает
+        миллисекунды, зато запись не может обогнать invalidate().
+        """
+        if not self._dirty:
+            return
+        
+        batch, self._dirty = self._dirty, {}
+        try:
+            self.db.save_user_states([state.as_row() for state in batch.values()])
+        except Exception as e:
+            logger.error(f"❌ Не удалось записать пользователей: {e}")
+            # Вернём в очередь, запишем в следующий раз
+            for user_id, state in batch.items():
+                self._dirty.setdefault(user_id, state)
+    
+    def start(self):
+        """Запустить фоновую запись"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._flush_loop())
+    
+    async def stop(self):
+        """Остановить фоновую запись и дописать остаток"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self.flush()
+    
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            self.flush()
@@ -1,104 +1,231 @@
 # utils/chunker.py - разбивка длинных сообщений
 import re
 
-MAX_MESSAGE_LENGTH = 4096  # лимит Telegram
+MAX_MESSAGE_LENGTH = 4096  # лимит Telegram (в единицах UTF-16!)
+
+# Начало блока кода: ```язык\n (язык длиннее 32 символов - не язык, а текст)
+FENCE_OPEN = re.compile(r"```([\w+#.-]{0,32})\n")
+
+# Где резать, в порядке предпочтения (после разделителя)
+PARAGRAPH_BREAKS = ("\n\n", "\n")
+SENTENCE_ENDS = (". ", "! ", "? ", "… ")
+
+
+def utf16_len(text: str) -> int:
+    """Длина так, как её считает Telegram: эмодзи вне BMP - 2 единицы"""
+    return len(text.encode("utf-16-le")) // 2
+
+
+def _fit(text: str, start: int, budget: int) -> int:
+    """Наибольший end, при котором text[start:end] влезает в budget единиц UTF-16"""
+    # Каждый символ - минимум одна единица, так что дальше start + budget не уйдём
+    window = text[start:start + budget]
+    encoded = window.encode("utf-16-le")
+    if len(encoded) <= 2 * budget:
+        return start + len(window)
+
+    # Обратно декодируем ровно budget единиц; половинку суррогатной пары отбрасываем
+    return start + len(encoded[:2 * budget].decode("utf-16-le", errors="ignore"))
+
+
+def _find_fences(text: str) -> list:
+    """Блоки кода [(start, end, язык), ...]; незакрытый блок - до конца текста"""
+    fences = []
+    pos = text.find("```")
+    while pos != -1:
+        opening = FENCE_OPEN.match(text, pos)
+        if not opening:
+            pos = text.find("```", pos + 3)
+            continue
+
+        closing = text.find("```", opening.end())
+        end = len(text) if closing == -1 else closing + 3
+        fences.append((pos, end, opening.group(1)))
+        pos = text.find("```", end)
+    return fences
+
+
+def _boundary(text: str, lo: int, hi: int) -> int:
+    """Лучшая граница в text[lo:hi]: абзац, строка, предложение, слово (или hi)"""
+    for separator in PARAGRAPH_BREAKS:
+        pos = text.rfind(separator, lo, hi)
+        if pos != -1:
+            return pos + len(separator)
+
+    pos = max(text.rfind(separator, lo, hi) for separator in SENTENCE_ENDS)
+    if pos != -1:
+        return pos + 2
+
+    pos = text.rfind(" ", lo, hi)
+    return pos + 1 if pos != -1 else hi
+
+
+def _reopen(lang: str, max_length: int) -> str:
+    """Строка, открывающая блок кода заново в следующей части"""
+    prefix = f"```{lang}\n"
+    if utf16_len(prefix) + 4 > max_length // 4:
+        # С языком и закрывающими ``` под сам код почти не осталось бы места
+        return "```\n"
+    return prefix
+
+
+def _spans(text: str, max_length: int):
+    """
+    Один проход по тексту: (start, end, prefix, suffix) каждой части
+
+    Часть = prefix + text[start:end] + suffix. Блок кода, который влезает
+    в одно сообщение, целиком переносится в следующую часть; более длинный
+    режется по строке, закрывается ``` и открывается заново в следующей.
+    """
+    fences = _find_fences(text)
+    # Незакрытый блок в конце текста (оборванный ответ) - закроем сами
+    unclosed = bool(fences) and fences[-1][1] == len(text) and not text.endswith("```")
+    fits = {}  # индекс блока -> влезает ли он в одно сообщение
+    first_fence = 0
+    start, prefix = 0, ""
+
+    while True:
+        budget = max_length - utf16_len(prefix)
+        end = _fit(text, start, budget)
+        if end >= len(text) and unclosed:
+            # Последней части нужно место под закрывающие ```
+            end = _fit(text, start, budget - 4)
+        if end >= len(text):
+            yield start, len(text), prefix, "\n```" if unclosed else ""
+            return
+
+        cut = _boundary(text, start + (end - start) // 2, end)
+
+        # Блок кода, внутрь которого попал разрез
+        while first_fence < len(fences) and fences[first_fence][1] <= start:
+            first_fence += 1
+        fence = None
+        for index in range(first_fence, len(fences)):
+            fence_start, fence_end, lang = fences[index]
+            if fence_start >= cut:
+                break
+            if fence_end > cut:
+                fence = index
+                break
+
+        if fence is None:
+            yield start, cut, prefix, ""
+            start, prefix = cut, ""
+            continue
+
+        fence_start, fence_end, lang = fences[fence]
+        if fence not in fits:
+            fits[fence] = utf16_len(text[fence_start:fence_end]) <= max_length
+
+        if fence_end <= end:
+            # Блок заканчивается в этом же окне - режем сразу после него
+            yield start, fence_end, prefix, ""
+            start, prefix = fence_end, ""
+            continue
+
+        if fence_start > start and fits[fence]:
+            # Блок влезет в следующее сообщение целиком
+            yield start, fence_start, prefix, ""
+            start, prefix = fence_start, ""
+            continue
+
+        # Блок длиннее сообщения - режем по строке, закрываем и открываем заново
+        body = text.index("\n", fence_start) + 1
+        end = _fit(text, start, max(1, budget - 4))
+        newline = text.rfind("\n", max(start, body), end)
+        if newline == -1 and fence_start > start:
+            # В окно не влезла ни одна строка кода (или даже сам ```язык) -
+            # переносим блок в следующую часть вместе с открывающей строкой
+            yield start, fence_start, prefix, ""
+            start, prefix = fence_start, ""
+            continue
+        cut = newline + 1 if newline != -1 else end
+        yield start, cut, prefix, "```" if text[cut - 1] == "\n" else "\n```"
+        start, prefix = cut, _reopen(lang, max_length)
+
+
+def plain_spans(text: str, max_length: int = MAX_MESSAGE_LENGTH, blocks: list = ()):
+    """
+    (start, end) частей текста без Markdown (уже разобранного, см. utils.renderer)
+
+    blocks - отсортированные (start, end) кусков, которые лучше не резать
+    (блоки кода): влезающий в одно сообщение блок переносится целиком.
+    """
+    start, first_block = 0, 0
+    while start < len(text):
+        end = _fit(text, start, max_length)
+        if end >= len(text):
+            yield start, len(text)
+            return
+
+        cut = _boundary(text, start + (end - start) // 2, end)
+
+        while first_block < len(blocks) and blocks[first_block][1] <= start:
+            first_block += 1
+        for block_start, block_end in blocks[first_block:]:
+            if block_start >= cut:
+                break
+            if block_end > cut:
+                if block_start > start and utf16_len(text[block_start:block_end]) <= max_length:
+                    cut = block_start
+                break
+
+        yield start, cut
+        start = cut
+
+
+def iter_chunks(text: str, max_length: int = MAX_MESSAGE_LENGTH):
+    """
+    Генератор частей сообщения не длиннее max_length единиц UTF-16
+
+    Режет по абзацам, строкам, предложениям или словам и никогда не
+    оставляет блок кода незакрытым.
+    """
+    for start, end, prefix, suffix in _spans(text, max_length):
+        chunk = (prefix + text[start:end] + suffix) if prefix or suffix else text[start:end]
+        chunk = chunk.strip()
+        if chunk:
+            yield chunk
 
 
 def split_message(text: str, max_length: int = MAX_MESSAGE_LENGTH) -> list:
     """
-    Разбивает длинное сообщение на части по 4096 символов
-    
-    Старается разбивать по параграфам или предложениям
-    
+    Разбивает длинное сообщение на части по 4096 единиц UTF-16
+
+    Старается разбивать по параграфам или предложениям, блоки кода
+    не разрывает (см. iter_chunks)
+
     Args:
         text: текст для разбивки
         max_length: максимальная длина одного сообщения
-    
+
     Returns:
         list: список частей текста
     """
-    if len(text) <= max_length:
-        return [text]
-    
-    chunks = []
-    current_chunk = ""
-    
-    # Разбиваем по параграфам
-    paragraphs = text.split('\n\n')
-    
-    for paragraph in paragraphs:
-        # Если параграф слишком длинный, разбиваем по предложениям
-        if len(paragraph) > max_length:
-            sentences = re.split(r'(?<=[.!?])\s+', paragraph)
-            
-            for sentence in sentences:
-                # Если предложение слишком длинное, режем принудительно
-                if len(sentence) > max_length:
-                    for i in range(0, len(sentence), max_length - 100):
-                        chunk = sentence[i:i + max_length - 100]
-                        chunks.append(chunk)
-                    continue
-                
-                if len(current_chunk) + len(sentence) + 1 <= max_length:
-                    current_chunk += sentence + " "
-                else:
-                    if current_chunk:
-                        chunks.append(current_chunk.strip())
-                    current_chunk = sentence + " "
-        
-        else:
-            # Добавляем параграф целиком
-            if len(current_chunk) + len(paragraph) + 2 <= max_length:
-                current_chunk += paragraph + "\n\n"
-            else:
-                if current_chunk:
-                    chunks.append(current_chunk.strip())
-                current_chunk = paragraph + "\n\n"
-    
-    # Добавляем последний chunk
-    if current_chunk:
-        chunks.append(current_chunk.strip())
-    
-    return chunks
+    return list(iter_chunks(text, max_length))
 
 
 def split_by_code_blocks(text: str, max_length: int = MAX_MESSAGE_LENGTH) -> list:
     """
     Разбивка с учётом блоков кода
-    
-    Гарантирует, что блоки кода не будут разорваны
+
+    Гарантирует, что блоки кода не будут разорваны (то же, что split_message)
     """
-    chunks = []
-    current = ""
-    
-    # Найти все блоки кода
-    code_blocks = re.finditer(r'```[\w]*\n.*?```', text, re.DOTALL)
-    last_end = 0
-    
-    for match in code_blocks:
-        # Текст до блока кода
-        before = text[last_end:match.start()]
-        code_block = match.group()
-        
-        # Если текст + код влезает
-        if len(current + before + code_block) <= max_length:
-            current += before + code_block
-        else:
-            # Сохраняем текущий chunk
-            if current + before:
-                chunks.append((current + before).strip())
-            current = code_block
-        
-        last_end = match.end()
-    
-    # Оставшийся текст
-    remaining = text[last_end:]
-    if len(current + remaining) <= max_length:
-        chunks.append((current + remaining).strip())
-    else:
-        if current:
-            chunks.append(current.strip())
-        if remaining:
-            chunks.extend(split_message(remaining, max_length))
-    
-    return [c for c in chunks if c]
\ No newline at end of file
+    return split_message(text, max_length)
+
+
+def split_first(text: str, max_length: int = MAX_MESSAGE_LENGTH) -> tuple:
+    """
+    Отрезать первую часть (для потоковой отправки)
+
+    Returns:
+        tuple: (первая часть, остаток) - остаток уже с переоткрытым блоком кода
+    """
+    spans = _spans(text, max_length)
+    start, end, prefix, suffix = next(spans)
+    head = prefix + text[start:end] + suffix
+
+    following = next(spans, None)
+    if following is None:
+        return head, ""
+    return head, following[2] + text[following[0]:]
@@ -0,0 +1,120 @@
+# utils/context_builder.py - сборка запроса в пределах бюджета токенов
+import re
+from dataclasses import dataclass
+
+# Грубая оценка: ~4 байта UTF-8 на токен
+# (латиница ~4 символа, кириллица ~2 символа, эмодзи ~1 токен)
+BYTES_PER_TOKEN = 4
+
+# Меньше этого обрезанный кусок истории не имеет смысла
+MIN_TURN_TOKENS = 40
+
+TRUNCATED_MARK = " …"
+
+# Границы, по которым можно резать: конец блока кода, абзац, предложение, строка, слово
+BOUNDARIES = [
+    re.compile(r"```[ \t]*\n"),
+    re.compile(r"\n\n"),
+    re.compile(r"[.!?…](?:\s|$)"),
+    re.compile(r"\n"),
+    re.compile(r"\s"),
+]
+
+
+@dataclass
+class PromptContext:
+    """Собранные contents для Gemini и их оценка в токенах"""
+    contents: list
+    tokens: int
+    history_used: int  # сколько сообщений истории вошло
+
+
+def estimate_tokens(text: str) -> int:
+    """Оценка числа токенов"""
+    return -(-len(text.encode("utf-8")) // BYTES_PER_TOKEN)
+
+
+def truncate_to_tokens(text: str, budget: int) -> str:
+    """
+    Обрезать текст до budget токенов
+
+    Режет по ближайшей границе (блок кода, абзац, предложение, строка, слово)
+    и никогда не оставляет незакрытый блок ```.
+    """
+    if estimate_tokens(text) <= budget:
+        return text
+
+    # Самый длинный префикс, который влезает в бюджет
+    limit = max(0, budget * BYTES_PER_TOKEN - len(TRUNCATED_MARK.encode("utf-8")) - 4)
+    cut = len(text.encode("utf-8")[:limit].decode("utf-8", errors="ignore"))
+
+    # Отступаем к последней естественной границе (если она не слишком далеко)
+    head = text[:cut]
+    for pattern in BOUNDARIES:
+        ends = [m.end() for m in pattern.finditer(head)]
+        if ends and ends[-1] >= cut // 2:
+            head = head[:ends[-1]]
+            break
+
+    # Не оставляем открытый блок кода
+    if head.count("```") % 2:
+        fence_start = head.rfind("```")
+        if fence_start >= len(head) // 2:
+            head = head[:fence_start]
+        else:
+            # Блок длинный - режем внутри по строке и закрываем его
+            newline = text.rfind("\n", fence_start, cut)
+            head = text[:newline if newline > fence_start else cut].rstrip() + "\n```"
+
+    return head.rstrip() + TRUNCATED_MARK
+
+
+def build_contents(history: list, message: str, budget: int, summary: str = None) -> PromptContext:
+    """
+    Собрать contents для Gemini: история по ролям + новое сообщение
+
+    Системные правила сюда не входят - они задаются моделью как
+    system_instruction, поэтому budget - это то, что осталось после них.
+    История добавляется с самых новых сообщений, пока хватает бюджета;
+    последнее влезающее сообщение может быть обрезано по границе.
+
+    Args:
+        history: [(role, content), ...] от старых к новым
+        message: новое сообщение пользователя
+        budget: бюджет токенов на историю, сводку и сообщение
+        summary: сводка старой части диалога (идёт первой)
+    """
+    memory = f"[ПАМЯТЬ О ПОЛЬЗОВАТЕЛЕ]\n{summary}" if summary else None
+    left = budget - estimate_tokens(message) - (estimate_tokens(memory) if memory else 0)
+
+    turns = []
+    for role, content in reversed(history or []):
+        cost = estimate_tokens(content)
+
+        if cost <= left:
+            turns.append((role, content))
+            left -= cost
+            continue
+
+        # Не влезает целиком - берём начало, если от него будет толк
+        if left >= MIN_TURN_TOKENS:
+            turns.append((role, truncate_to_tokens(content, left)))
+        break
+
+    contents = []
+
+    def add(role: str, text: str):
+        # Подряд идущие реплики одной роли - одно сообщение из нескольких частей
+        if contents and contents[-1]["role"] == role:
+            contents[-1]["parts"].append(text)
+        else:
+            contents.append({"role": role, "parts": [text]})
+
+    if memory:
+        add("user", memory)
+    for role, content in reversed(turns):
+        add("user" if role == "user" else "model", content)
+    add("user", message)
+
+    tokens = sum(estimate_tokens(part) for item in contents for part in item["parts"])
+    return PromptContext(contents=contents, tokens=tokens, history_used=len(turns))
@@ -56,13 +56,7 @@ def clean_response(text: str) -> str:
     
     - Удаляет множественные пустые строки
     - Удаляет пробелы в конце строк
-    - Удаляет артефакты промпта
     """
-    # Удаление артефактов промпта
-    text = text.replace("🤖 Ассистент:", "").strip()
-    text = text.replace("Ассистент:", "").strip()
-    text = text.replace("👤 Пользователь:", "").strip()
-    
     # Удаление пробелов в конце строк
     text = '\n'.join(line.rstrip() for line in text.split('\n'))
     
@@ -0,0 +1,202 @@
+# utils/renderer.py - Markdown ответа -> текст + MessageEntity для Telegram
+import re
+from bisect import bisect_left
+from dataclasses import dataclass
+from telegram import MessageEntity
+from utils.chunker import MAX_MESSAGE_LENGTH, plain_spans
+
+# Где вообще может начинаться разметка - дальше regex-ом проверяем только эти места
+SPECIAL = re.compile(r"[`\[*_~\\#]")
+
+# Разметка в позиции-кандидате: первая подошедшая альтернатива побеждает
+TOKEN = re.compile(r"""
+    (?P<fence>```(?P<lang>[\w+\#.-]*)\n)
+  | `(?P<code_inline>[^`\n]+)`
+  | \[(?P<link_text>[^\]\n]+)\]\((?P<url>https?://[^\s)]+)\)
+  | \*\*(?P<bold>(?!\s)[^\n]+?(?<!\s))\*\*
+  | __(?P<bold_alt>(?!\s)[^\n]+?(?<!\s))__
+  | ~~(?P<strike>(?!\s)[^\n]+?(?<!\s))~~
+  | ^[ \t]*\#{1,6}[ \t]+(?P<heading>[^\n]+)
+  | ^(?P<indent>[ \t]*)\*[ \t]+
+  | (?<![\w*])\*(?P<star>[^*\s](?:[^*\n]*?[^*\s])?)\*(?![\w*])
+  | (?<!\w)_(?P<italic>[^_\s](?:[^_\n]*?[^_\s])?)_(?!\w)
+  | \\(?P<escaped>[\\`*_\[\]~\#])
+""", re.VERBOSE | re.MULTILINE)
+
+# Группа с текстом -> тип сущности (текст внутри разбирается дальше)
+NESTED = {
+    "bold": MessageEntity.BOLD,
+    "bold_alt": MessageEntity.BOLD,
+    "star": MessageEntity.BOLD,       # *текст* - жирный, как в Telegram Markdown
+    "heading": MessageEntity.BOLD,
+    "italic": MessageEntity.ITALIC,
+    "strike": MessageEntity.STRIKETHROUGH,
+    "link_text": MessageEntity.TEXT_LINK,
+}
+
+# Символы вне BMP - в UTF-16 занимают 2 единицы
+ASTRAL = re.compile("[\U00010000-\U0010FFFF]")
+
+
+@dataclass
+class RenderedText:
+    """Текст сообщения и его разметка (смещения в единицах UTF-16)"""
+    text: str
+    entities: list
+
+
+def _tokens(markdown: str):
+    """(совпадение TOKEN, где кончается разметка) по порядку, без наложений"""
+    pos = 0
+    while True:
+        candidate = SPECIAL.search(markdown, pos)
+        if not candidate:
+            return
+        at = candidate.start()
+
+        match = None
+        if markdown[at] in "*#":
+            # Заголовок или пункт списка с отступом - разбираем от начала строки
+            line_start = markdown.rfind("\n", 0, at) + 1
+            if pos <= line_start < at and markdown[line_start:at].isspace():
+                match = TOKEN.match(markdown, line_start)
+        match = match or TOKEN.match(markdown, at)
+
+        if not match:
+            pos = at + 1
+            continue
+
+        pos = match.end()
+        if match.lastgroup == "fence":
+            # Конец блока кода ищем просто find-ом; незакрытый блок - до конца текста
+            closing = markdown.find("```", pos)
+            pos = len(markdown) if closing == -1 else closing + 3
+        yield match, pos
+
+
+def _parse(markdown: str, out: list, spans: list, offset: int) -> int:
+    """
+    Разобрать markdown в out (куски текста) и spans ([тип, start, end, доп.])
+
+    Смещения - в символах итогового текста. Возвращает его новую длину.
+    """
+    position = 0
+    for match, end in _tokens(markdown):
+        if match.start() > position:
+            chunk = markdown[position:match.start()]
+            out.append(chunk)
+            offset += len(chunk)
+        position = end
+
+        kind = match.lastgroup
+        if kind == "fence":
+            code = markdown[match.end():end]
+            if code.endswith("```"):
+                code = code[:-4] if code.endswith("\n```") else code[:-3]
+            if code:
+                out.append(code)
+                spans.append([MessageEntity.PRE, offset, offset + len(code), match.group("lang") or None])
+                offset += len(code)
+        elif kind == "code_inline":
+            code = match.group(kind)
+            out.append(code)
+            spans.append([MessageEntity.CODE, offset, offset + len(code), None])
+            offset += len(code)
+        elif kind == "url":
+            start = offset
+            offset = _parse(match.group("link_text"), out, spans, offset)
+            spans.append([MessageEntity.TEXT_LINK, start, offset, match.group("url")])
+        elif kind in NESTED:
+            start = offset
+            offset = _parse(match.group(kind), out, spans, offset)
+            spans.append([NESTED[kind], start, offset, None])
+        elif kind == "indent":
+            bullet = match.group("indent") + "• "
+            out.append(bullet)
+            offset += len(bullet)
+        elif kind == "escaped":
+            out.append(match.group(kind))
+            offset += 1
+
+    if position < len(markdown):
+        out.append(markdown[position:])
+        offset += len(markdown) - position
+    return offset
+
+
+def parse_markdown(markdown: str) -> tuple:
+    """
+    Markdown ответа Gemini -> (текст, [[тип, start, end, доп.], ...])
+
+    Смещения в символах Python. Разбирается один раз, без экранирования:
+    Telegram получает чистый текст и сущности, так что «сломанной»
+    разметки, из-за которой сообщение не отправится, не бывает.
+    """
+    out, spans = [], []
+    _parse(markdown, out, spans, 0)
+    return "".join(out), spans
+
+
+def _to_entities(text: str, spans: list, start: int, end: int) -> list:
+    """Сущности куска text[start:end]: обрезанные по границам, в единицах UTF-16"""
+    piece = text[start:end]
+    astral = None  # позиции символов вне BMP - ищем, только если есть сущности
+
+    def utf16(index: int) -> int:
+        return index + bisect_left(astral, index)
+
+    entities = []
+    for kind, span_start, span_end, extra in spans:
+        left, right = max(span_start, start) - start, min(span_end, end) - start
+        if left >= right or not piece[left:right].strip():
+            continue
+        if astral is None:
+            astral = [] if piece.isascii() else [match.start() for match in ASTRAL.finditer(piece)]
+        entities.append(MessageEntity(
+            kind,
+            offset=utf16(left),
+            length=utf16(right) - utf16(left),
+            url=extra if kind == MessageEntity.TEXT_LINK else None,
+            language=extra if kind == MessageEntity.PRE else None,
+        ))
+    entities.sort(key=lambda entity: (entity.offset, -entity.length))
+    return entities
+
+
+def render(markdown: str) -> RenderedText:
+    """Один кусок ответа (уже влезающий в сообщение) -> текст и сущности"""
+    chunks = render_chunks(markdown, max_length=None)
+    return chunks[0] if chunks else RenderedText("", [])
+
+
+def render_chunks(markdown: str, max_length: int = MAX_MESSAGE_LENGTH) -> list:
+    """
+    Разобрать ответ и разбить его на сообщения
+
+    Режется уже готовый текст, поэтому сущность на границе просто делится
+    на две - ни одна не пересекает границу сообщения. Блоки кода, которые
+    влезают в одно сообщение, не разрываются.
+
+    Returns:
+        list: [RenderedText, ...] - без пустых частей
+    """
+    text, spans = parse_markdown(markdown)
+    if max_length is None:
+        bounds = [(0, len(text))]
+    else:
+        blocks = sorted((start, end) for kind, start, end, _ in spans if kind == MessageEntity.PRE)
+        bounds = plain_spans(text, max_length, blocks)
+
+    chunks = []
+    for start, end in bounds:
+        # Пустые строки по краям срезаем сами, чтобы не сбить смещения
+        # (отступ первой строки оставляем - он может быть частью кода)
+        first = start
+        while first < end and text[first].isspace():
+            first += 1
+        start = max(start, text.rfind("\n", start, first) + 1)
+        while end > start and text[end - 1].isspace():
+            end -= 1
+        if start < end:
+            chunks.append(RenderedText(text[start:end], _to_entities(text, spans, start, end)))
+    return chunks
@@ -0,0 +1,263 @@
+# workers.py - несколько процессов-обработчиков, апдейты раздаются по user_id
+import asyncio
+import logging
+import multiprocessing
+import signal
+import threading
+import time
+from collections import deque
+from telegram import Update
+from telegram.ext import Application, TypeHandler
+from config import (TELEGRAM_TOKEN, GEMINI_RPM_LIMIT, GEMINI_TPM_LIMIT, STREAM_EDIT_RATE, STREAM_EDIT_BURST,
+                    WORKER_PROCESSES, WORKER_RESTART_DELAY, WORKER_RESTART_MAX_DELAY, WORKER_STOP_TIMEOUT,
+                    METRICS_PORT)
+from admission import AdmissionController, TokenBucket
+from bot import add_handlers, allowed_updates, build_application
+from firebase_service import DatabaseService
+from handlers import BotHandlers
+from metrics import WORKER_QUEUE_DEPTH, UPDATES_DISPATCHED, WORKER_RESTARTS, start_server
+from update_processor import PerUserUpdateProcessor
+
+logger = logging.getLogger(__name__)
+
+STOP = None  # в очереди обработчика: доделать начатое и выйти
+
+
+def shard(update: Update, workers: int) -> int:
+    """
+    Номер обработчика для апдейта
+    
+    Все апдейты пользователя попадают в один процесс: порядок держит его
+    PerUserUpdateProcessor, а кэш пользователя (тариф, история, сводка)
+    живёт только там.
+    """
+    user_id = PerUserUpdateProcessor._user_id(update)
+    return (user_id or 0) % workers
+
+
+# ===========================================
+# ПРОЦЕСС-ОБРАБОТЧИК
+# ===========================================
+
+def _worker_main(index: int, workers: int, inbox, taken):
+    """Точка входа процесса-обработчика"""
+    # Ctrl+C получает вся группа процессов - останавливает нас приёмщик через STOP
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(_serve(index, workers, inbox, taken))
+
+
+def _read_inbox(inbox, taken, loop, received: asyncio.Queue):
+    """
+    Поток: переносит апдейты из межпроцессной очереди в цикл событий
+    
+    Отдельный поток-демон, а не run_in_executor: если обработчик падает,
+    процесс не должен ждать выхода из заблокированного inbox.get().
+    taken - общий с приёмщиком счётчик забранных апдейтов.
+    """
+    while True:
+        data = inbox.get()
+        if data is not STOP:
+            taken.value += 1
+        loop.call_soon_threadsafe(received.put_nowait, data)
+        if data is STOP:
+            return
+
+
+async def _serve(index: int, workers: int, inbox, taken):
+    """Обычное приложение бота без Updater: апдейты приходят из inbox"""
+    handlers = BotHandlers()
+    if handlers.gemini.admission:
+        # Квота API общая на все процессы - каждому его доля
+        handlers.gemini.admission = AdmissionController(rpm=GEMINI_RPM_LIMIT / workers,
+                                                        tpm=GEMINI_TPM_LIMIT / workers)
+    # Лимит Telegram тоже общий на бота
+    handlers.edit_limiter = TokenBucket(STREAM_EDIT_RATE * 60 / workers,
+                                        capacity=max(1.0, STREAM_EDIT_BURST / workers))
+    
+    builder = Application.builder().token(TELEGRAM_TOKEN).updater(None)
+    app = build_application(handlers, builder, retention=index == 0)
+    received = asyncio.Queue()
+    threading.Thread(target=_read_inbox, args=(inbox, taken, asyncio.get_running_loop(), received),
+                     name="inbox", daemon=True).start()
+    
+    async with app:
+        await handlers.startup(app)
+        await app.start()
+        start_server(METRICS_PORT + index + 1)
+        logger.info(f"👷 Обработчик {index + 1}/{workers} запущен")
+        try:
+            while True:
+                data = await received.get()
+                if data is STOP:
+                    break
+                app.update_queue.put_nowait(Update.de_json(data, app.bot))
+        finally:
+            # stop() дожидается апдейтов, которые уже в очереди и в обработке
+            await app.stop()
+            await handlers.shutdown(app)
+    
+    logger.info(f"👷 Обработчик {index + 1}/{workers} остановлен")
+
+
+# ===========================================
+# ПРИЁМ АПДЕЙТОВ И ПРИСМОТР ЗА ОБРАБОТЧИКАМИ
+# ===========================================
+
+class WorkerPool:
+    """
+    Процессы-обработчики и очереди апдейтов к ним
+    
+    Упавший обработчик перезапускается через WORKER_RESTART_DELAY; если
+    он падает сразу после старта, пауза удваивается (до
+    WORKER_RESTART_MAX_DELAY). Апдейты, которые упавший процесс не успел
+    забрать, и пришедшие за время паузы ждут его в новой очереди; теряются
+    только те, что он уже забрал, но не доделал.
+    """
+    
+    def __init__(self, workers: int = WORKER_PROCESSES):
+        self.workers = workers
+        self._context = multiprocessing.get_context("spawn")
+        self._queues = [self._context.Queue() for _ in range(workers)]
+        # Сколько апдейтов забрал обработчик (пишет он сам) и копии ещё не забранных:
+        # из упавшей очереди их не достать - её блокировка осталась у мёртвого процесса
+        self._taken = [self._context.RawValue("q", 0) for _ in range(workers)]
+        self._sent = [0] * workers
+        self._unread = [deque() for _ in range(workers)]
+        self._processes = [None] * workers
+        self._started_at = [0.0] * workers
+        self._restart_at = [0.0] * workers
+        self._crashes = [0] * workers  # падений подряд сразу после старта
+        self._watcher = None
+        self.dispatched = 0
+        self.restarts = 0
+    
+    async def start(self, app=None):
+        """Запустить обработчики (post_init приёмщика)"""
+        for index in range(self.workers):
+            self._spawn(index)
+        self._watcher = asyncio.create_task(self._watch())
+        logger.info(f"👷 Запущено обработчиков: {self.workers}")
+        
+        UPDATES_DISPATCHED.set_function(lambda: self.dispatched)
+        WORKER_RESTARTS.set_function(lambda: self.restarts)
+        for index in range(self.workers):
+            WORKER_QUEUE_DEPTH.set_function(lambda index=index: self._queues[index].qsize(), index + 1)
+    
+    async def stop(self, app=None):
+        """Дать обработчикам доделать начатое и дождаться их (post_shutdown приёмщика)"""
+        if self._watcher:
+            self._watcher.cancel()
+            self._watcher = None
+        
+        for index, process in enumerate(self._processes):
+            if process and process.is_alive():
+                self._queues[index].put(STOP)
+        
+        deadline = time.monotonic() + WORKER_STOP_TIMEOUT
+        for index, process in enumerate(self._processes):
+            if process is None:
+                continue
+            await asyncio.to_thread(process.join, max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                logger.warning(f"⚠️ Обработчик {index + 1} не остановился за {WORKER_STOP_TIMEOUT} сек")
+                process.terminate()
+                await asyncio.to_thread(process.join)
+        logger.info(f"👷 Обработчики остановлены (апдейтов передано: {self.dispatched}, "
+                    f"перезапусков: {self.restarts})")
+    
+    async def dispatch(self, update: Update, context):
+        """Передать апдейт процессу его пользователя"""
+        index = shard(update, self.workers)
+        data = update.to_dict()
+        self._queues[index].put(data)
+        self._sent[index] += 1
+        self._unread[index].append(data)
+        self._forget_taken(index)
+        self.dispatched += 1
+    
+    def _forget_taken(self, index: int) -> deque:
+        """Выкинуть копии апдейтов, которые обработчик уже забрал; вернуть остальные"""
+        unread = self._unread[index]
+        while len(unread) > self._sent[index] - self._taken[index].value:
+            unread.popleft()
+        return unread
+    
+    def _spawn(self, index: int):
+        process = self._context.Process(
+            target=_worker_main,
+            args=(index, self.workers, self._queues[index], self._taken[index]),
+            name=f"worker-{index + 1}",
+            daemon=True,
+        )
+        process.start()
+        self._processes[index] = process
+        self._started_at[index] = time.monotonic()
+    
+    async def _watch(self):
+        """Раз в секунду проверяет обработчики и перезапускает упавшие"""
+        while True:
+            await asyncio.sleep(1)
+            now = time.monotonic()
+            for index, process in enumerate(self._processes):
+                if process is None:
+                    if now >= self._restart_at[index]:
+                        self._spawn(index)
+                        self.restarts += 1
+                    continue
+                if process.is_alive():
+                    continue
+                
+                if now - self._started_at[index] > WORKER_RESTART_MAX_DELAY:
+                    self._crashes[index] = 0
+                delay = min(WORKER_RESTART_MAX_DELAY, WORKER_RESTART_DELAY * 2 ** self._crashes[index])
+                self._crashes[index] += 1
+                logger.error(f"❌ Обработчик {index + 1} упал (код {process.exitcode}), "
+                             f"перезапуск через {delay:.0f} сек")
+                
+                # Упавший процесс оставил очередь заблокированной на чтении - берём новую
+                # и перекладываем в неё всё, что он не успел забрать
+                old = self._queues[index]
+                self._queues[index] = self._context.Queue()
+                old.close()
+                old.cancel_join_thread()
+                
+                unread = self._forget_taken(index)
+                for data in unread:
+                    self._queues[index].put(data)
+                self._sent[index] = len(unread)
+                self._taken[index].value = 0
+                if unread:
+                    logger.warning(f"📦 Обработчику {index + 1} переданы заново {len(unread)} апдейтов")
+                
+                self._processes[index] = None
+                self._restart_at[index] = now + delay
+
+
+def build_ingest(workers: int = WORKER_PROCESSES) -> tuple:
+    """
+    Приложение-приёмщик: получает апдейты (polling или webhook) и раздаёт
+    их обработчикам
+    
+    Запускается так же, как обычное приложение (run_polling/run_webhook).
+    Здесь нет ни Gemini, ни обработчиков - только Updater и очереди.
+    
+    Returns:
+        tuple: (приложение, типы апдейтов для allowed_updates)
+    """
+    # Миграции - один раз здесь, а не наперегонки в каждом обработчике
+    DatabaseService().close()
+    
+    # Обработчики регистрируем на пустом приложении только ради типов апдейтов
+    template = Application.builder().token(TELEGRAM_TOKEN).updater(None).build()
+    add_handlers(template, BotHandlers)
+    
+    pool = WorkerPool(workers)
+    app = (
+        Application.builder()
+        .token(TELEGRAM_TOKEN)
+        .post_init(pool.start)
+        .post_shutdown(pool.stop)
+        .build()
+    )
+    app.add_handler(TypeHandler(Update, pool.dispatch))
+    return app, allowed_updates(template)
@@ -0,0 +1,91 @@
+# write_queue.py - отложенная пакетная запись в базу
+import asyncio
+import logging
+from config import WRITE_BATCH_SIZE, WRITE_FLUSH_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBehindQueue:
+    """
+    Очередь строк для пакетной записи
+    
+    Строки копятся в памяти и уходят в базу одной транзакцией:
+    раз в WRITE_FLUSH_INTERVAL секунд или сразу, как наберётся
+    WRITE_BATCH_SIZE строк. Пока фоновая запись не запущена
+    (например, в admin.py), каждая строка пишется сразу.
+    """
+    
+    def __init__(self, write_batch, batch_size: int = WRITE_BATCH_SIZE,
+                 flush_interval: float = WRITE_FLUSH_INTERVAL):
+        self._write_batch = write_batch  # функция записи пачки строк
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._rows = []
+        self._task = None
+        self._wakeup = None
+    
+    @property
+    def depth(self) -> int:
+        """Сколько строк ждут записи"""
+        return len(self._rows)
+    
+    def add(self, row: tuple):
+        """Поставить строку в очередь"""
+        self._rows.append(row)
+        
+        if self._task is None:
+            self.flush()
+        elif len(self._rows) >= self.batch_size:
+            self._wakeup.set()
+    
+    def discard(self, predicate):
+        """Выбросить ещё не записанные строки, подходящие под условие"""
+        self._rows = [row for row in self._rows if not predicate(row)]
+    
+    def flush(self) -> int:
+        """
+        Записать всё накопленное одной транзакцией
+        
+        Returns:
+            int: сколько строк записано
+        """
+        if not self._rows:
+            return 0
+        
+        rows, self._rows = self._rows, []
+        try:
+            self._write_batch(rows)
+        except Exception as e:
+            logger.error(f"❌ Не удалось записать {len(rows)} строк: {e}")
+            # Не теряем: допишем со следующей пачкой
+            self._rows = rows + self._rows
+            return 0
+        
+        return len(rows)
+    
+    def start(self):
+        """Запустить фоновую запись"""
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._flush_loop())
+    
+    async def stop(self):
+        """Остановить фоновую запись и дописать остаток"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self.flush()
+    
+    async def _flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            self.flush()